@@ -0,0 +1,45 @@
+"""Add rolling conversation summary to chats.
+
+Revision ID: 0002_chat_rolling_summary
+Revises: 0001_feedback_directives
+Create Date: 2026-10-19
+"""
+
+from alembic import op
+import sqlalchemy as sa
+from sqlalchemy import inspect
+
+
+revision = "0002_chat_rolling_summary"
+down_revision = "0001_feedback_directives"
+branch_labels = None
+depends_on = None
+
+
+def _has_table(inspector, name: str) -> bool:
+    return name in inspector.get_table_names()
+
+
+def _has_column(inspector, table: str, column: str) -> bool:
+    return column in {col["name"] for col in inspector.get_columns(table)}
+
+
+def upgrade() -> None:
+    bind = op.get_bind()
+    inspector = inspect(bind)
+
+    if _has_table(inspector, "chats"):
+        if not _has_column(inspector, "chats", "summary"):
+            op.add_column("chats", sa.Column("summary", sa.Text, nullable=True))
+        if not _has_column(inspector, "chats", "summary_upto_message_id"):
+            op.add_column("chats", sa.Column("summary_upto_message_id", sa.Integer, nullable=True))
+
+
+def downgrade() -> None:
+    bind = op.get_bind()
+    inspector = inspect(bind)
+
+    if _has_table(inspector, "chats"):
+        for col in ("summary_upto_message_id", "summary"):
+            if _has_column(inspector, "chats", col):
+                op.drop_column("chats", col)
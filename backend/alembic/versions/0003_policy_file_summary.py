@@ -0,0 +1,45 @@
+"""Add precomputed document summary to policy files.
+
+Revision ID: 0003_policy_file_summary
+Revises: 0002_chat_rolling_summary
+Create Date: 2026-10-19
+"""
+
+from alembic import op
+import sqlalchemy as sa
+from sqlalchemy import inspect
+
+
+revision = "0003_policy_file_summary"
+down_revision = "0002_chat_rolling_summary"
+branch_labels = None
+depends_on = None
+
+
+def _has_table(inspector, name: str) -> bool:
+    return name in inspector.get_table_names()
+
+
+def _has_column(inspector, table: str, column: str) -> bool:
+    return column in {col["name"] for col in inspector.get_columns(table)}
+
+
+def upgrade() -> None:
+    bind = op.get_bind()
+    inspector = inspect(bind)
+
+    if _has_table(inspector, "policy_files"):
+        if not _has_column(inspector, "policy_files", "summary"):
+            op.add_column("policy_files", sa.Column("summary", sa.Text, nullable=True))
+        if not _has_column(inspector, "policy_files", "summary_hash"):
+            op.add_column("policy_files", sa.Column("summary_hash", sa.String, nullable=True))
+
+
+def downgrade() -> None:
+    bind = op.get_bind()
+    inspector = inspect(bind)
+
+    if _has_table(inspector, "policy_files"):
+        for col in ("summary_hash", "summary"):
+            if _has_column(inspector, "policy_files", col):
+                op.drop_column("policy_files", col)
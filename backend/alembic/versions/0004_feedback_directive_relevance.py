@@ -0,0 +1,48 @@
+"""Add global flag and embedding to feedback directives.
+
+Revision ID: 0004_feedback_directive_relevance
+Revises: 0003_policy_file_summary
+Create Date: 2026-10-19
+"""
+
+from alembic import op
+import sqlalchemy as sa
+from sqlalchemy import inspect
+
+
+revision = "0004_feedback_directive_relevance"
+down_revision = "0003_policy_file_summary"
+branch_labels = None
+depends_on = None
+
+
+def _has_table(inspector, name: str) -> bool:
+    return name in inspector.get_table_names()
+
+
+def _has_column(inspector, table: str, column: str) -> bool:
+    return column in {col["name"] for col in inspector.get_columns(table)}
+
+
+def upgrade() -> None:
+    bind = op.get_bind()
+    inspector = inspect(bind)
+
+    if _has_table(inspector, "feedback_directives"):
+        if not _has_column(inspector, "feedback_directives", "is_global"):
+            op.add_column(
+                "feedback_directives",
+                sa.Column("is_global", sa.Boolean, nullable=False, server_default=sa.false()),
+            )
+        if not _has_column(inspector, "feedback_directives", "embedding"):
+            op.add_column("feedback_directives", sa.Column("embedding", sa.LargeBinary, nullable=True))
+
+
+def downgrade() -> None:
+    bind = op.get_bind()
+    inspector = inspect(bind)
+
+    if _has_table(inspector, "feedback_directives"):
+        for col in ("embedding", "is_global"):
+            if _has_column(inspector, "feedback_directives", col):
+                op.drop_column("feedback_directives", col)
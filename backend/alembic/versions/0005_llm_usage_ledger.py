@@ -0,0 +1,54 @@
+"""Add LLM usage ledger table.
+
+Revision ID: 0005_llm_usage_ledger
+Revises: 0004_feedback_directive_relevance
+Create Date: 2026-10-19
+"""
+
+from alembic import op
+import sqlalchemy as sa
+from sqlalchemy import inspect
+
+
+revision = "0005_llm_usage_ledger"
+down_revision = "0004_feedback_directive_relevance"
+branch_labels = None
+depends_on = None
+
+
+def _has_table(inspector, name: str) -> bool:
+    return name in inspector.get_table_names()
+
+
+def upgrade() -> None:
+    bind = op.get_bind()
+    inspector = inspect(bind)
+
+    if not _has_table(inspector, "llm_usage"):
+        op.create_table(
+            "llm_usage",
+            sa.Column("id", sa.Integer, primary_key=True),
+            sa.Column("created_at", sa.DateTime, nullable=False),
+            sa.Column("kind", sa.String, nullable=False),
+            sa.Column("status", sa.String, nullable=False, server_default="ok"),
+            sa.Column("user_id", sa.Integer, nullable=True),
+            sa.Column("chat_id", sa.Integer, nullable=True),
+            sa.Column("answer_mode", sa.String, nullable=True),
+            sa.Column("model", sa.String, nullable=True),
+            sa.Column("prompt_tokens", sa.Integer, nullable=True),
+            sa.Column("completion_tokens", sa.Integer, nullable=True),
+            sa.Column("cached_tokens", sa.Integer, nullable=True),
+            sa.Column("latency_ms", sa.Float, nullable=False, server_default="0"),
+            sa.Column("ttft_ms", sa.Float, nullable=True),
+        )
+        op.create_index("ix_llm_usage_id", "llm_usage", ["id"])
+        op.create_index("ix_llm_usage_created_at", "llm_usage", ["created_at"])
+        op.create_index("ix_llm_usage_user_id", "llm_usage", ["user_id"])
+
+
+def downgrade() -> None:
+    bind = op.get_bind()
+    inspector = inspect(bind)
+
+    if _has_table(inspector, "llm_usage"):
+        op.drop_table("llm_usage")
@@ -13,12 +13,79 @@ class Settings(BaseSettings):
 
     LMSTUDIO_API_URL: str = "http://127.0.0.1:1234/v1/responses"
     LMSTUDIO_MODEL: str = "qwen2.5-7b-instruct-1m"
-    LMSTUDIO_TIMEOUT_SECONDS: int = 900
+    LMSTUDIO_TIMEOUT_SECONDS: int = 900  # leitura (geracao longa)
+    LMSTUDIO_CONNECT_TIMEOUT_SECONDS: float = 5.0
+    # Pool HTTP compartilhado com o LM Studio, retentativas de conexao e disjuntor
+    LLM_POOL_MAX_CONNECTIONS: int = 20
+    LLM_POOL_MAX_KEEPALIVE: int = 10
+    LLM_POOL_KEEPALIVE_SECONDS: float = 60.0
+    LLM_RETRY_ATTEMPTS: int = 2
+    LLM_RETRY_BACKOFF_SECONDS: float = 0.5
+    LLM_BREAKER_FAILURE_THRESHOLD: int = 5
+    LLM_BREAKER_RESET_SECONDS: float = 30.0
+    # Varios servidores de inferencia: "url|peso,url|peso" (vazio = so LMSTUDIO_API_URL)
+    LMSTUDIO_BACKENDS: str = ""
+    LLM_HEALTH_CHECK_SECONDS: float = 15.0  # 0 desliga a sonda ativa
+    LLM_HEALTH_CHECK_PATH: str = "/v1/models"
+    # Escalonador do LLM: geracoes simultaneas e fila de espera (cheia = 503 com Retry-After)
+    LLM_MAX_CONCURRENT_GENERATIONS: int = 4
+    LLM_QUEUE_MAX: int = 32
+    # Prazo total de uma pergunta (recuperacao + fila + geracao) e intervalo de checagem de desconexao
+    REQUEST_DEADLINE_SECONDS: float = 300.0
+    DISCONNECT_POLL_SECONDS: float = 0.5
+    # Streams SSE retomaveis: eventos em buffer por geracao, espera por reconexao e retencao apos o fim
+    STREAM_BUFFER_EVENTS: int = 2048
+    STREAM_RESUME_GRACE_SECONDS: float = 30.0
+    STREAM_RETENTION_SECONDS: float = 120.0
+    RETRIEVAL_WORKERS: int = 4
+    # Mede tempo ate o 1o token (prefill) e tokens em cache reportados pelo LM Studio
+    PROMPT_METRICS_ENABLED: bool = False
+    # Orcamento de tokens do prompt (PROMPT_TOKENIZER vazio = aproximacao por caracteres)
+    PROMPT_TOKENIZER: str = ""
+    MODEL_CONTEXT_TOKENS: int = 8192
+    PROMPT_CONTEXT_BUDGET_TOKENS: int = 2000
+    PROMPT_HISTORY_BUDGET_TOKENS: int = 2500
+    PROMPT_SAFETY_MARGIN_TOKENS: int = 256
+    # Resumo incremental por chat: o prompt leva resumo + ultimas CHAT_RECENT_MESSAGES mensagens
+    CHAT_SUMMARY_ENABLED: bool = True
+    CHAT_RECENT_MESSAGES: int = 8
+    CHAT_SUMMARY_MAX_TOKENS: int = 350
+    CHAT_SUMMARY_TURN_CHARS: int = 1500
+    # Memoria de recuperacao por chat: perguntas de seguimento pontuam primeiro os trechos e
+    # documentos citados nos ultimos turnos e so caem na busca global se o score for baixo
+    CHAT_MEMORY_ENABLED: bool = True
+    CHAT_MEMORY_TURNS: int = 3
+    CHAT_MEMORY_MAX_CHATS: int = 1000
+    CHAT_MEMORY_TTL_SECONDS: float = 3600.0
+    CHAT_MEMORY_MAX_CHUNKS: int = 400
+    CHAT_MEMORY_MIN_SCORE: float = 0.35
+    CHAT_MEMORY_FOLLOW_UP_MAX_WORDS: int = 3
+    # Perguntas identicas simultaneas (sem historico) compartilham uma unica geracao
+    SINGLEFLIGHT_ENABLED: bool = True
+    # Lote de perguntas do admin (/admin/ask/batch): encoding em lote e geracoes limitadas
+    BATCH_MAX_QUESTIONS: int = 500
+    BATCH_LLM_CONCURRENCY: int = 2
+    BATCH_ENCODE_SIZE: int = 64
+    # Resumo de cada politica gerado uma vez por hash do arquivo (map-reduce por paginas)
+    DOC_SUMMARY_ENABLED: bool = True
+    DOC_SUMMARY_CONCURRENCY: int = 2
+    DOC_SUMMARY_MAP_CHARS: int = 6000
+    DOC_SUMMARY_SERVE_DIRECT: bool = False  # True = devolve o resumo na hora, sem chamar o modelo
 
     CHECK_INTERVAL_SECONDS: int = 86400  # 24h para watcher
+    WATCHER_DEBOUNCE_MS: int = 1600
+    WATCHER_POLL_SECONDS: int = 30  # fallback por stat quando nao ha notificacoes
+    WATCHER_FORCE_POLLING: bool = False
     FINANCE_CSV_PATH: str = "data/finance.csv"
     FINANCE_REFRESH_SECONDS: int = 86400
 
+    # Extração paralela de PDFs grandes (0 = usa todos os núcleos disponíveis)
+    PDF_PARALLEL_MIN_PAGES: int = 60
+    PDF_PAGES_PER_WORKER: int = 20
+    PDF_EXTRACT_WORKERS: int = 0
+    # Similaridade (Jaccard estimado via MinHash) a partir da qual dois trechos sao quase duplicados
+    NEAR_DUP_THRESHOLD: float = 0.8
+
     SECRET_KEY: str = Field("change-me", min_length=8)
     ALGORITHM: str = "HS256"
     ACCESS_TOKEN_EXPIRE_MINUTES: int = 720
@@ -34,6 +101,14 @@ class Settings(BaseSettings):
     MAX_UPLOAD_MB: int = 20
     MAX_QUESTION_CHARS: int = 2000
     FEEDBACK_DIRECTIVES_LIMIT: int = 20
+    # Diretrizes nao globais entram so quando relevantes para a pergunta (similaridade com o texto)
+    FEEDBACK_DIRECTIVES_TOP_K: int = 3
+    FEEDBACK_DIRECTIVES_MIN_SCORE: float = 0.3
+    CONFIG_CACHE_TTL_SECONDS: int = 300  # rede de seguranca; rotas de admin invalidam na hora
+    # Ledger de uso do LLM (tokens e latencia por chamada), gravado em lote pelo worker
+    USAGE_LEDGER_ENABLED: bool = True
+    USAGE_LEDGER_FLUSH_SECONDS: float = 2.0
+    USAGE_LEDGER_RETENTION_DAYS: int = 90  # 0 = manter para sempre
 
     LOGIN_MAX_ATTEMPTS: int = 5
     LOGIN_LOCKOUT_MINUTES: int = 15
@@ -29,3 +29,25 @@ def rate_limit(request: Request, *, limit: int | None = None, window_seconds: in
 
     history.append(now)
     _hits[key] = history
+
+
+def service_busy(retry_after: int) -> HTTPException:
+    """503 com Retry-After, para quando a fila de geracao do LLM esta cheia."""
+    return HTTPException(
+        status_code=status.HTTP_503_SERVICE_UNAVAILABLE,
+        detail="Servico de IA ocupado. Tente novamente em instantes.",
+        headers={"Retry-After": str(retry_after)},
+    )
+
+
+def deadline_exceeded(stage: str) -> HTTPException:
+    """504 quando o prazo da pergunta (REQUEST_DEADLINE_SECONDS) acaba antes da resposta."""
+    return HTTPException(
+        status_code=status.HTTP_504_GATEWAY_TIMEOUT,
+        detail=f"Tempo limite da resposta excedido ({stage}). Tente novamente.",
+    )
+
+
+def client_closed_request() -> HTTPException:
+    """499 (convencao do nginx): o cliente desconectou; ninguem vai ler a resposta."""
+    return HTTPException(status_code=499, detail="Cliente desconectou")
@@ -1,96 +1,116 @@
-import hashlib
 import os
 import time
 from datetime import datetime
 from pathlib import Path
 
 from app.core.config import settings
-from app.services.ingest import ingest_all_policies, POLICY_DIR
+from app.services.doc_summary import request_document_summaries
+from app.services.ingest import ingest_policies, POLICY_DIR
 from app.services.finance_ingest import ingest_finance_csv
 
-HASH_FILE = POLICY_DIR / ".last_hash"
 CHECK_INTERVAL_SECONDS = settings.CHECK_INTERVAL_SECONDS
 _running = False
+_last_finance_run = 0.0
 
 
-def calculate_policies_hash() -> str | None:
-    """Calculate a sha256 hash of all policy files."""
+def snapshot_policies() -> dict[str, tuple[int, int]]:
+    """Fotografia barata da pasta de politicas: {arquivo: (mtime_ns, tamanho)}."""
     if not POLICY_DIR.exists():
-        return None
+        return {}
 
-    hasher = hashlib.sha256()
-
-    for root, dirs, files in os.walk(POLICY_DIR):
-        dirs[:] = [d for d in dirs if not d.startswith('.')]
-
-        for fname in sorted(files):
-            if fname.startswith('.'):
+    snapshot: dict[str, tuple[int, int]] = {}
+    with os.scandir(POLICY_DIR) as entries:
+        for entry in entries:
+            if entry.name.startswith(".") or not entry.is_file():
                 continue
+            stat = entry.stat()
+            snapshot[entry.name] = (stat.st_mtime_ns, stat.st_size)
+    return snapshot
 
-            path = Path(root) / fname
-            rel = path.relative_to(POLICY_DIR)
-
-            hasher.update(str(rel).encode("utf-8"))
-
-            with open(path, "rb") as f:
-                while True:
-                    chunk = f.read(8192)
-                    if not chunk:
-                        break
-                    hasher.update(chunk)
 
-    return hasher.hexdigest()
+def diff_snapshots(
+    previous: dict[str, tuple[int, int]],
+    current: dict[str, tuple[int, int]],
+) -> tuple[set[str], set[str]]:
+    """Retorna (alterados/novos, removidos) entre duas fotografias."""
+    changed = {name for name, stat in current.items() if previous.get(name) != stat}
+    removed = set(previous) - set(current)
+    return changed, removed
 
 
-def load_last_hash() -> str | None:
-    try:
-        return HASH_FILE.read_text(encoding="utf-8").strip()
-    except FileNotFoundError:
-        return None
-
-
-def save_last_hash(value: str | None):
-    if value is None:
+def _apply_changes(changed: set[str], removed: set[str]) -> None:
+    if not changed and not removed:
         return
-    HASH_FILE.parent.mkdir(parents=True, exist_ok=True)
-    HASH_FILE.write_text(value, encoding="utf-8")
+    print(f"\n[{datetime.now()}] [watcher] Mudanca detectada nos arquivos de politicas")
+    print(f"[watcher] Alterados: {sorted(changed)} | Removidos: {sorted(removed)}")
+    ingest_policies(changed, removed)
+    request_document_summaries()
+    print("[watcher] IA atualizada com sucesso!")
+
+
+def _maybe_refresh_finance() -> None:
+    """Ingestão financeira periódica, executada a cada despertar do watcher."""
+    global _last_finance_run
+    now_ts = time.time()
+    if now_ts - _last_finance_run >= settings.FINANCE_REFRESH_SECONDS:
+        print("[watcher] Iniciando ingestão financeira via CSV...")
+        ingest_finance_csv()
+        _last_finance_run = now_ts
+
+
+def _policy_filter(_change, path: str) -> bool:
+    # Ignora ocultos/temporarios (ex.: uploads em andamento).
+    return not Path(path).name.startswith(".")
+
+
+def _watch_with_notifications() -> None:
+    """Loop baseado em eventos do sistema de arquivos (inotify via watchfiles), com debounce."""
+    from watchfiles import watch
+
+    print("[watcher] Monitorando politicas via notificacoes do sistema de arquivos")
+    for changes in watch(
+        POLICY_DIR,
+        watch_filter=_policy_filter,
+        debounce=settings.WATCHER_DEBOUNCE_MS,
+        rust_timeout=CHECK_INTERVAL_SECONDS * 1000,
+        yield_on_timeout=True,
+        recursive=False,
+    ):
+        touched = {Path(path).name for _change, path in changes}
+        # Eventos de um mesmo lote podem se anular (ex.: cria e apaga); o estado final decide.
+        changed = {name for name in touched if (POLICY_DIR / name).is_file()}
+        _apply_changes(changed, touched - changed)
+        _maybe_refresh_finance()
+
+
+def _watch_with_stat_polling() -> None:
+    """Fallback para sistemas de arquivos sem notificacao: compara (mtime, tamanho) periodicamente."""
+    print(f"[watcher] Monitorando politicas via checagem de stat a cada {settings.WATCHER_POLL_SECONDS}s")
+    previous = snapshot_policies()
+    while True:
+        time.sleep(settings.WATCHER_POLL_SECONDS)
+        current = snapshot_policies()
+        changed, removed = diff_snapshots(previous, current)
+        _apply_changes(changed, removed)
+        previous = current
+        _maybe_refresh_finance()
 
 
 def start_policy_watcher():
-    """Run an infinite loop that reprocesses policies and ingere CSV financeiro diariamente."""
+    """Monitora a pasta de politicas (reingestão direcionada) e ingere CSV financeiro periodicamente."""
     global _running
     if _running:
         return
     _running = True
-    print("[watcher] ATHENA watcher iniciado (checagem a cada ciclo configurado)")
-
-    # Registrar hash inicial para evitar reprocessar imediatamente após o bootstrap
-    initial_hash = calculate_policies_hash()
-    if initial_hash:
-        save_last_hash(initial_hash)
-
-    last_finance_run = 0.0
-
-    while True:
-        print(f"\n[{datetime.now()}] Rodando checagem diaria...")
-
-        current_hash = calculate_policies_hash()
-        last_hash = load_last_hash()
-
-        if current_hash and current_hash != last_hash:
-            print("[watcher] Mudanca detectada nos arquivos de politicas")
-            print("[watcher] Reprocessando politicas e atualizando IA...")
-
-            ingest_all_policies()
-            save_last_hash(current_hash)
+    print("[watcher] ATHENA watcher iniciado")
 
-            print("[watcher] IA atualizada com sucesso!")
+    POLICY_DIR.mkdir(parents=True, exist_ok=True)
+    _maybe_refresh_finance()
 
-        # Ingestão financeira periódica
-        now_ts = time.time()
-        if now_ts - last_finance_run >= settings.FINANCE_REFRESH_SECONDS:
-            print("[watcher] Iniciando ingestão financeira via CSV...")
-            ingest_finance_csv()
-            last_finance_run = now_ts
+    if not settings.WATCHER_FORCE_POLLING:
+        try:
+            _watch_with_notifications()
+        except Exception as exc:  # noqa: BLE001
+            print(f"[watcher] Notificacoes indisponiveis ({exc}); usando checagem por stat.")
 
-        time.sleep(CHECK_INTERVAL_SECONDS)
+    _watch_with_stat_polling()
@@ -1,6 +1,8 @@
 from fastapi import FastAPI, HTTPException, Request
 from fastapi.middleware.cors import CORSMiddleware
 from fastapi.responses import JSONResponse
+from starlette.datastructures import MutableHeaders
+from starlette.types import ASGIApp, Message, Receive, Scope, Send
 
 import threading
 import time
@@ -10,8 +12,42 @@ from app.db.database import Base, engine
 from app.db.init_db import init_db
 from app import models  # noqa: F401 ensures models are registered
 from app.routes import admin, auth, chats, athena
+from app.services.doc_summary import attach_event_loop, request_document_summaries
 from app.services.ingest import ingest_all_policies
 from app.core.watcher import start_policy_watcher
+from app.services.llm_client import aclose_clients, start_health_probes
+from app.services.usage_ledger import flush_usage_ledger
+
+
+class SecurityHeadersMiddleware:
+    """
+    Cabecalhos de seguranca e X-Response-Time (tempo ate o inicio da resposta). Middleware ASGI
+    puro: o @app.middleware("http") embrulha o receive e esconde a desconexao do cliente de
+    request.is_disconnected(), usado para cancelar geracoes abandonadas.
+    """
+
+    def __init__(self, app: ASGIApp):
+        self.app = app
+
+    async def __call__(self, scope: Scope, receive: Receive, send: Send) -> None:
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+        start = time.perf_counter()
+
+        async def send_with_headers(message: Message) -> None:
+            if message["type"] == "http.response.start":
+                elapsed_ms = (time.perf_counter() - start) * 1000
+                headers = MutableHeaders(scope=message)
+                headers.setdefault("X-Response-Time", f"{elapsed_ms:.0f}ms")
+                if elapsed_ms > 1500:
+                    print(f"[slow] {scope['method']} {scope['path']} {elapsed_ms:.0f}ms")
+                headers.setdefault("X-Content-Type-Options", "nosniff")
+                headers.setdefault("X-Frame-Options", "DENY")
+                headers.setdefault("Referrer-Policy", "no-referrer")
+            await send(message)
+
+        await self.app(scope, receive, send_with_headers)
 
 
 def create_app() -> FastAPI:
@@ -29,20 +65,10 @@ def create_app() -> FastAPI:
         allow_credentials=allow_credentials,
         allow_methods=["*"],
         allow_headers=["*"],
+        expose_headers=["X-Athena-Sources", "X-Athena-Stream-Id", "X-Response-Time"],
     )
 
-    @app.middleware("http")
-    async def security_headers(request: Request, call_next):
-        start = time.perf_counter()
-        response = await call_next(request)
-        elapsed_ms = (time.perf_counter() - start) * 1000
-        response.headers.setdefault("X-Response-Time", f"{elapsed_ms:.0f}ms")
-        if elapsed_ms > 1500:
-            print(f"[slow] {request.method} {request.url.path} {elapsed_ms:.0f}ms")
-        response.headers.setdefault("X-Content-Type-Options", "nosniff")
-        response.headers.setdefault("X-Frame-Options", "DENY")
-        response.headers.setdefault("Referrer-Policy", "no-referrer")
-        return response
+    app.add_middleware(SecurityHeadersMiddleware)
 
     # HTTP error handler
     @app.exception_handler(HTTPException)
@@ -50,6 +76,7 @@ def create_app() -> FastAPI:
         return JSONResponse(
             status_code=exc.status_code,
             content={"success": False, "data": None, "error": exc.detail},
+            headers=getattr(exc, "headers", None),
         )
 
     # Generic error handler
@@ -64,13 +91,28 @@ def create_app() -> FastAPI:
     Base.metadata.create_all(bind=engine)
 
     # Startup events
+    @app.on_event("startup")
+    async def _attach_event_loop():
+        # Antes de _startup: o worker de resumos usa o loop para passar pelo escalonador do LLM.
+        attach_event_loop()
+
     @app.on_event("startup")
     def _startup():
         init_db()
         ingest_all_policies()
+        request_document_summaries()
         # Start watcher in background thread to reprocess policies/finance periodically
         threading.Thread(target=start_policy_watcher, daemon=True).start()
 
+    @app.on_event("startup")
+    async def _start_llm_health_probes():
+        start_health_probes()
+
+    @app.on_event("shutdown")
+    async def _shutdown():
+        await aclose_clients()
+        flush_usage_ledger()
+
     # Routers
     api_prefix = settings.API_V1_PREFIX
     app.include_router(auth.router, prefix=api_prefix, tags=["Auth"])
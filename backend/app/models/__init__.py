@@ -6,6 +6,7 @@ from app.models.action_audit import ActionAudit
 from app.models.chat_feedback import ChatFeedback
 from app.models.feedback_directive import FeedbackDirective
 from app.models.system_config import SystemConfig
+from app.models.llm_usage import LLMUsage
 __all__ = [
     "User",
     "Chat",
@@ -15,4 +16,5 @@ __all__ = [
     "ChatFeedback",
     "FeedbackDirective",
     "SystemConfig",
+    "LLMUsage",
 ]
@@ -1,6 +1,6 @@
 from datetime import datetime
 
-from sqlalchemy import DateTime, ForeignKey, Integer, String
+from sqlalchemy import DateTime, ForeignKey, Integer, String, Text
 from sqlalchemy.orm import Mapped, mapped_column, relationship
 
 from app.db.base_class import Base
@@ -13,6 +13,9 @@ class Chat(Base):
     title: Mapped[str] = mapped_column(String, nullable=False)
     user_id: Mapped[int] = mapped_column(Integer, ForeignKey("users.id"), nullable=False)
     created_at: Mapped[datetime] = mapped_column(DateTime, default=datetime.utcnow)
+    # Resumo incremental das mensagens antigas (ate summary_upto_message_id, inclusive)
+    summary: Mapped[str | None] = mapped_column(Text, nullable=True)
+    summary_upto_message_id: Mapped[int | None] = mapped_column(Integer, nullable=True)
 
     owner: Mapped["User"] = relationship("User", back_populates="chats")
     messages: Mapped[list["Message"]] = relationship(
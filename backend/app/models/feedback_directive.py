@@ -1,6 +1,6 @@
 from datetime import datetime
 
-from sqlalchemy import DateTime, ForeignKey, Integer, String, Text
+from sqlalchemy import Boolean, DateTime, ForeignKey, Integer, LargeBinary, String, Text
 from sqlalchemy.orm import Mapped, mapped_column
 
 from app.db.base_class import Base
@@ -18,3 +18,7 @@ class FeedbackDirective(Base):
     created_at: Mapped[datetime] = mapped_column(DateTime, default=datetime.utcnow)
     approved_at: Mapped[datetime | None] = mapped_column(DateTime, nullable=True)
     applied_at: Mapped[datetime | None] = mapped_column(DateTime, nullable=True)
+    # Global: entra em todo prompt. As demais so quando sao relevantes para a pergunta.
+    is_global: Mapped[bool] = mapped_column(Boolean, default=False)
+    # Vetor float32 normalizado do texto, calculado quando a diretriz e aplicada.
+    embedding: Mapped[bytes | None] = mapped_column(LargeBinary, nullable=True)
@@ -17,5 +17,8 @@ class PolicyFile(Base):
     active: Mapped[bool] = mapped_column(Boolean, default=True)
     embedding_status: Mapped[str] = mapped_column(String, default="pending")
     embedding_last_error: Mapped[str | None] = mapped_column(Text, nullable=True)
+    # Resumo pre-calculado do documento inteiro e o sha256 do arquivo de onde ele saiu
+    summary: Mapped[str | None] = mapped_column(Text, nullable=True)
+    summary_hash: Mapped[str | None] = mapped_column(String, nullable=True)
 
     user: Mapped["User"] = relationship("User", back_populates="policies")
@@ -1,13 +1,19 @@
-﻿from datetime import datetime
+﻿from collections.abc import Iterator
+from datetime import datetime
 from pathlib import Path
 from typing import List
+import codecs
 import csv
+import hashlib
 import io
+import json
 import os
 import secrets
 import string
+import tempfile
 
 from fastapi import APIRouter, Depends, File, Form, HTTPException, UploadFile
+from fastapi.concurrency import run_in_threadpool
 from fastapi.responses import StreamingResponse
 from sqlalchemy.orm import Session
 from pydantic import BaseModel
@@ -28,6 +34,7 @@ from app.models import (
 from app.schemas import Envelope
 from app.schemas.admin import (
     ActionAuditOut,
+    BatchAskRequest,
     ChatFeedbackOut,
     PolicyFileOut,
     PolicyUploadResponse,
@@ -37,9 +44,20 @@ from app.schemas.admin import (
     UserAdminOut,
     UserAdminUpdate,
 )
+from app.services.batch_qa import run_batch
+from app.services.config_cache import invalidate_config_cache
+from app.services.deadline import get_cancellation_stats
+from app.services.directives import embed_directive, get_directive_stats
+from app.services.doc_summary import request_document_summaries
 from app.services.embeddings import remove_embeddings_for_source
-from app.services.ingest import ingest_all_policies, get_ingest_status
+from app.services.ingest import ingest_all_policies, get_ingest_status, remember_file_hash
 from app.services.finance_ingest import ingest_finance_csv, load_pivot_cache, upload_finance_csv
+from app.services.generator import get_pipeline_metrics, get_prompt_metrics, get_singleflight_stats
+from app.services.llm_client import get_pool_stats
+from app.services.llm_scheduler import scheduler
+from app.services.retrieval_memory import get_retrieval_memory_stats
+from app.services.stream_registry import get_stream_stats
+from app.services.usage_ledger import get_usage_report
 
 router = APIRouter(prefix="/admin")
 
@@ -71,6 +89,62 @@ def max_upload_bytes() -> int:
     return settings.MAX_UPLOAD_MB * 1024 * 1024
 
 
+UPLOAD_CHUNK_BYTES = 1024 * 1024
+
+
+def iter_upload_chunks(file: UploadFile) -> Iterator[bytes]:
+    """Le o upload em blocos fixos, abortando com 413 assim que passar de MAX_UPLOAD_MB."""
+    limit = max_upload_bytes()
+    total = 0
+    while True:
+        chunk = file.file.read(UPLOAD_CHUNK_BYTES)
+        if not chunk:
+            break
+        total += len(chunk)
+        if total > limit:
+            raise HTTPException(status_code=413, detail="Arquivo acima do limite permitido")
+        yield chunk
+
+
+def iter_upload_lines(file: UploadFile) -> Iterator[str]:
+    """
+    Decodifica o upload (utf-8) em linhas sem carregar o arquivo inteiro na memoria.
+    Quebra so em LF (o CR de CRLF fica na linha e o csv o descarta): str.splitlines tambem
+    quebraria em form feed, separadores ASCII, NEL e U+2028, que podem estar dentro de um campo.
+    """
+    decoder = codecs.getincrementaldecoder("utf-8")(errors="ignore")
+    pending = ""
+    for chunk in iter_upload_chunks(file):
+        pending += decoder.decode(chunk)
+        *lines, pending = pending.split("\n")
+        for line in lines:
+            yield line + "\n"
+    pending += decoder.decode(b"", final=True)
+    if pending:
+        yield pending
+
+
+def receive_upload(file: UploadFile, target_dir: Path) -> tuple[Path, str]:
+    """
+    Grava o upload em um arquivo temporario oculto dentro do diretorio de destino,
+    calculando o sha256 em streaming. O chamador move o temporario para o nome final
+    com os.replace (atomico no mesmo sistema de arquivos).
+    """
+    target_dir.mkdir(parents=True, exist_ok=True)
+    hasher = hashlib.sha256()
+    fd, tmp_name = tempfile.mkstemp(prefix=".upload-", suffix=".part", dir=target_dir)
+    tmp_path = Path(tmp_name)
+    try:
+        with os.fdopen(fd, "wb") as out:
+            for chunk in iter_upload_chunks(file):
+                hasher.update(chunk)
+                out.write(chunk)
+    except BaseException:
+        tmp_path.unlink(missing_ok=True)
+        raise
+    return tmp_path, hasher.hexdigest()
+
+
 # ---------------- Users ----------------
 @router.get("/users", response_model=Envelope[List[UserAdminOut]])
 def list_users(
@@ -177,6 +251,8 @@ def delete_user(user_id: int, current_admin: User = Depends(get_current_admin),
     db.query(Chat).filter(Chat.user_id == user.id).delete(synchronize_session=False)
     db.delete(user)
     db.commit()
+    # As diretrizes do usuario foram removidas junto.
+    invalidate_config_cache()
     log_action(db, current_admin.id, "delete_user", {"user_id": user_id})
     return Envelope(success=True, data=True)
 
@@ -197,11 +273,8 @@ def upload_policy(
     if ext not in ALLOWED_EXTENSIONS:
         raise HTTPException(status_code=400, detail="Apenas PDF, DOCX ou TXT sao permitidos")
 
-    contents = file.file.read()
-    if len(contents) > max_upload_bytes():
-        raise HTTPException(status_code=413, detail="Arquivo acima do limite permitido")
+    tmp_path, file_hash = receive_upload(file, UPLOAD_DIR)
 
-    UPLOAD_DIR.mkdir(parents=True, exist_ok=True)
     safe_name = secure_filename(original)
     stored_name = safe_name
     counter = 1
@@ -211,9 +284,9 @@ def upload_policy(
         stored_name = f"{stem}_{counter}{suffix}"
         counter += 1
     stored_path = UPLOAD_DIR / stored_name
-    with stored_path.open("wb") as f:
-        f.write(contents)
 
+    # Registra no banco antes de publicar o arquivo: quando o watcher enxergar o arquivo,
+    # a politica ja existe e a ingestao direcionada nao o ignora.
     policy = PolicyFile(
         filename=stored_name,
         stored_path=str(stored_path),
@@ -223,6 +296,15 @@ def upload_policy(
     db.add(policy)
     db.commit()
     db.refresh(policy)
+    try:
+        os.replace(tmp_path, stored_path)
+    except OSError as exc:
+        tmp_path.unlink(missing_ok=True)
+        db.delete(policy)
+        db.commit()
+        raise HTTPException(status_code=500, detail="Falha ao salvar arquivo") from exc
+    # Hash ja calculado no upload: a ingestao nao precisa reler o arquivo.
+    remember_file_hash(stored_path, file_hash)
     log_action(db, current_admin.id, "upload_policy", {"policy_id": policy.id, "filename": policy.filename})
 
     return Envelope(success=True, data=PolicyUploadResponse(id=policy.id, filename=policy.filename, status="pending"))
@@ -241,6 +323,7 @@ def process_policies(
     db: Session = Depends(get_session),
 ):
     ingest_all_policies()
+    request_document_summaries()
     log_action(db, current_admin.id, "process_policies", {"policy_id": policy_id})
     return Envelope(success=True, data=True)
 
@@ -308,6 +391,7 @@ def update_config(payload: SystemConfigIn, current_admin: User = Depends(get_cur
     db.add(cfg)
     db.commit()
     db.refresh(cfg)
+    invalidate_config_cache()
     log_action(db, current_admin.id, "update_config", {"model": cfg.model_name})
     return Envelope(success=True, data=cfg)
 
@@ -361,6 +445,31 @@ def get_metrics(current_admin: User = Depends(get_current_admin), db: Session =
     )
 
 
+@router.get("/llm/metrics", response_model=Envelope[dict])
+def get_llm_metrics(_: User = Depends(get_current_admin)):
+    return Envelope(
+        success=True,
+        data={
+            **get_pool_stats(),
+            "scheduler": scheduler.stats(),
+            "prompt": get_prompt_metrics(),
+            "singleflight": get_singleflight_stats(),
+            "pipeline": get_pipeline_metrics(),
+            "cancellation": get_cancellation_stats(),
+            "streams": get_stream_stats(),
+            "retrieval_memory": get_retrieval_memory_stats(),
+            "directives": get_directive_stats(),
+        },
+    )
+
+
+@router.get("/llm/usage", response_model=Envelope[dict])
+def get_llm_usage(days: int = 7, _: User = Depends(get_current_admin), db: Session = Depends(get_session)):
+    """Consumo de tokens do ledger: por dia, modo de resposta, modelo e tipo de chamada."""
+    days = min(max(days, 1), 90)
+    return Envelope(success=True, data=get_usage_report(db, days))
+
+
 @router.get("/ingest/status", response_model=Envelope[dict])
 def ingest_status(_: User = Depends(get_current_admin), db: Session = Depends(get_session)):
     status = get_ingest_status(db)
@@ -395,6 +504,11 @@ def respond_feedback(
 
 class FeedbackDirectiveApproveIn(BaseModel):
     text: str | None = None
+    is_global: bool | None = None
+
+
+class FeedbackDirectiveScopeIn(BaseModel):
+    is_global: bool
 
 
 @router.get("/feedback/directives", response_model=Envelope[List[dict]])
@@ -420,6 +534,7 @@ def list_feedback_directives(current_admin: User = Depends(get_current_admin), d
                 "approved_by": directive.approved_by,
                 "approved_at": directive.approved_at,
                 "applied_at": directive.applied_at,
+                "is_global": directive.is_global,
                 "rating": feedback.rating,
                 "message_id": feedback.message_id,
             }
@@ -440,6 +555,10 @@ def approve_feedback_directive(
 
     if payload.text is not None:
         directive.text = payload.text
+    if payload.is_global is not None:
+        directive.is_global = payload.is_global
+    # Indexada na aprovacao: cada pergunta recebe so as diretrizes proximas do seu assunto.
+    directive.embedding = embed_directive(directive.text)
 
     now = datetime.utcnow()
     directive.status = "applied"
@@ -448,10 +567,35 @@ def approve_feedback_directive(
     directive.applied_at = now
     db.add(directive)
     db.commit()
+    invalidate_config_cache()
     log_action(db, current_admin.id, "approve_feedback_directive", {"directive_id": directive.id})
     return Envelope(success=True, data=True)
 
 
+@router.post("/feedback/directives/{directive_id}/scope", response_model=Envelope[bool])
+def set_feedback_directive_scope(
+    directive_id: int,
+    payload: FeedbackDirectiveScopeIn,
+    current_admin: User = Depends(get_current_admin),
+    db: Session = Depends(get_session),
+):
+    directive = db.query(FeedbackDirective).filter(FeedbackDirective.id == directive_id).first()
+    if not directive:
+        return Envelope(success=False, data=False, error="Diretriz nao encontrada")
+
+    directive.is_global = payload.is_global
+    db.add(directive)
+    db.commit()
+    invalidate_config_cache()
+    log_action(
+        db,
+        current_admin.id,
+        "set_feedback_directive_scope",
+        {"directive_id": directive.id, "is_global": payload.is_global},
+    )
+    return Envelope(success=True, data=True)
+
+
 @router.post("/feedback/directives/{directive_id}/reject", response_model=Envelope[bool])
 def reject_feedback_directive(
     directive_id: int,
@@ -469,10 +613,36 @@ def reject_feedback_directive(
     directive.applied_at = None
     db.add(directive)
     db.commit()
+    invalidate_config_cache()
     log_action(db, current_admin.id, "reject_feedback_directive", {"directive_id": directive.id})
     return Envelope(success=True, data=True)
 
 
+# ---------------- Batch QA ----------------
+@router.post("/ask/batch", response_model=None)
+async def ask_batch(
+    payload: BatchAskRequest,
+    current_admin: User = Depends(get_current_admin),
+    db: Session = Depends(get_session),
+):
+    """Responde uma lista de perguntas (validacao de politicas, FAQ) em JSONL, uma linha por pergunta."""
+    if not payload.questions:
+        raise HTTPException(status_code=400, detail="Nenhuma pergunta enviada.")
+    if len(payload.questions) > settings.BATCH_MAX_QUESTIONS:
+        raise HTTPException(
+            status_code=400,
+            detail=f"Lote muito grande (max {settings.BATCH_MAX_QUESTIONS} perguntas).",
+        )
+    admin_id = current_admin.id
+    await run_in_threadpool(log_action, db, admin_id, "ask_batch", {"questions": len(payload.questions)})
+
+    async def lines():
+        async for result in run_batch(payload.questions, concurrency=payload.concurrency, user_key=f"batch:{admin_id}"):
+            yield json.dumps(result, ensure_ascii=False) + "\n"
+
+    return StreamingResponse(lines(), media_type="application/x-ndjson", headers={"Cache-Control": "no-cache"})
+
+
 # ---------------- Bulk users ----------------
 @router.post("/users/bulk", response_model=Envelope[dict])
 def create_users_bulk(
@@ -480,12 +650,7 @@ def create_users_bulk(
     current_admin: User = Depends(get_current_admin),
     db: Session = Depends(get_session),
 ):
-    content = file.file.read()
-    if len(content) > max_upload_bytes():
-        raise HTTPException(status_code=413, detail="Arquivo acima do limite permitido")
-
-    text = content.decode("utf-8", errors="ignore")
-    reader = csv.DictReader(io.StringIO(text))
+    reader = csv.DictReader(iter_upload_lines(file))
     created = 0
     errors = []
     temp_passwords: list[dict] = []
@@ -558,20 +723,8 @@ def upload_finance(
     if not (file.filename or "").lower().endswith(".csv"):
         raise HTTPException(status_code=400, detail="Apenas CSV e permitido")
 
-    content = file.file.read()
-    if len(content) > max_upload_bytes():
-        raise HTTPException(status_code=413, detail="Arquivo acima do limite permitido")
-
-    temp_path = Path("data") / f"_upload_{secure_filename(file.filename or 'finance.csv')}"
-    temp_path.parent.mkdir(parents=True, exist_ok=True)
-    with temp_path.open("wb") as f:
-        f.write(content)
-
-    ok = upload_finance_csv(temp_path)
-    try:
-        temp_path.unlink(missing_ok=True)  # type: ignore[arg-type]
-    except Exception:
-        pass
+    tmp_path, _ = receive_upload(file, Path(settings.FINANCE_CSV_PATH).parent)
+    ok = upload_finance_csv(tmp_path)
 
     if not ok:
         return Envelope(success=False, data=False, error="Falha ao processar CSV financeiro")
@@ -1,9 +1,11 @@
 from fastapi import APIRouter, HTTPException, Request
 
 from app.core.config import settings
-from app.core.rate_limit import rate_limit
+from app.core.rate_limit import client_closed_request, deadline_exceeded, rate_limit, service_busy
 from app.schemas import AskRequest, AskResponse, Envelope, StatusResponse
-from app.services.generator import ChatGenerationError, generate_answer_with_history
+from app.services.deadline import ClientDisconnectedError, Deadline, DeadlineExceededError, RequestGuard
+from app.services.generator import ChatGenerationError, agenerate_answer_with_history
+from app.services.llm_scheduler import LLMQueueFullError
 
 router = APIRouter()
 
@@ -14,7 +16,7 @@ def health_check():
 
 
 @router.post("/ask", response_model=Envelope[AskResponse])
-def ask_athena(payload: AskRequest, request: Request):
+async def ask_athena(payload: AskRequest, request: Request):
     rate_limit(request)
     if not payload.question.strip():
         raise HTTPException(status_code=400, detail="Pergunta vazia.")
@@ -23,9 +25,27 @@ def ask_athena(payload: AskRequest, request: Request):
             status_code=400,
             detail=f"Pergunta muito longa (max {settings.MAX_QUESTION_CHARS} caracteres).",
         )
+    deadline = Deadline.for_request()
+    guard = RequestGuard(request, deadline)
     try:
-        result = generate_answer_with_history(payload.question, [{"role": "user", "content": payload.question}])
+        client_ip = request.client.host if request.client else "unknown"
+        result = await guard.run(
+            agenerate_answer_with_history(
+                payload.question,
+                [{"role": "user", "content": payload.question}],
+                user_key=f"ip:{client_ip}",
+                deadline=deadline,
+            )
+        )
         response = AskResponse(answer=result.get("content", ""), meta={"sources": result.get("sources", [])})
         return Envelope(success=True, data=response)
+    except LLMQueueFullError as exc:
+        raise service_busy(exc.retry_after) from exc
+    except DeadlineExceededError as exc:
+        raise deadline_exceeded(exc.stage) from exc
+    except ClientDisconnectedError as exc:
+        raise client_closed_request() from exc
     except ChatGenerationError as exc:
         raise HTTPException(status_code=400, detail=str(exc)) from exc
+    finally:
+        guard.close()
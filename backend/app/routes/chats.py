@@ -1,19 +1,43 @@
+import json
 from datetime import datetime
 
 from fastapi import APIRouter, Depends, HTTPException, Request
+from fastapi.concurrency import run_in_threadpool
 from fastapi.responses import StreamingResponse
 from sqlalchemy.orm import Session
 
 from app.core.config import settings
 from app.core.security import get_current_user
-from app.core.rate_limit import rate_limit
-from app.db.session import get_session
+from app.core.rate_limit import client_closed_request, deadline_exceeded, rate_limit, service_busy
+from app.db.session import SessionLocal, get_session
 from app.models import Chat, Message, User, ChatFeedback, FeedbackDirective
 from app.schemas import AskRequest, ChatCreate, ChatOut, ChatUpdate, Envelope, MessageOut, MessageFeedbackIn
-from app.services.generator import ChatGenerationError, generate_answer_with_history
+from app.services.chat_summary import schedule_chat_summary
+from app.services.config_cache import invalidate_config_cache
+from app.services.deadline import ClientDisconnectedError, Deadline, DeadlineExceededError, RequestGuard
+from app.services.generator import (
+    ChatGenerationError,
+    agenerate_answer_with_history,
+    astream_answer_with_history,
+    start_ask_pipeline,
+)
+from app.services.llm_scheduler import LLMQueueFullError
+from app.services.retrieval_memory import forget_chat
+from app.services.stream_registry import (
+    ResumableStream,
+    StreamNotFoundError,
+    StreamOffsetExpiredError,
+    active_stream_for_chat,
+    format_sse,
+    get_stream,
+    start_stream,
+)
 
 router = APIRouter(prefix="/chats")
 
+# Mesma janela que o generator aplica ao historico quando nao ha resumo do chat.
+_HISTORY_WINDOW_MESSAGES = 20
+
 
 def _validate_question(question: str) -> None:
     if not question.strip():
@@ -88,6 +112,9 @@ def delete_chat(
 
     db.delete(chat)
     db.commit()
+    forget_chat(chat_id)
+    # Diretrizes ligadas ao feedback do chat foram removidas junto.
+    invalidate_config_cache()
     return Envelope(success=True, data=True)
 
 
@@ -106,61 +133,170 @@ def get_messages(chat_id: int, db: Session = Depends(get_session), user: User =
     return Envelope(success=True, data=messages)
 
 
+def _ensure_chat_owner(db: Session, chat_id: int, user_id: int) -> None:
+    """404 para chat inexistente ou de outro usuario (antes de tocar na memoria de recuperacao do chat)."""
+    owned = db.query(Chat.id).filter(Chat.id == chat_id, Chat.user_id == user_id).first()
+    db.rollback()
+    if not owned:
+        raise HTTPException(status_code=404, detail="Chat nao encontrado")
+
+
+def _store_question(db: Session, chat_id: int, user_id: int, question: str) -> tuple[list[dict], str | None]:
+    """
+    Valida o chat, grava a pergunta e devolve (turnos recentes no formato do LLM, resumo do chat).
+    Com resumo, os turnos antigos ja estao nele e so a janela recente e carregada; sem resumo,
+    carrega as ultimas _HISTORY_WINDOW_MESSAGES mensagens.
+    """
+    chat = db.query(Chat).filter(Chat.id == chat_id, Chat.user_id == user_id).first()
+    if not chat:
+        raise HTTPException(status_code=404, detail="Chat nao encontrado")
+
+    _validate_question(question)
+    user_message = Message(role="user", content=question, chat_id=chat.id)
+    db.add(user_message)
+    db.flush()
+
+    query = db.query(Message).filter(Message.chat_id == chat.id)
+    summary = chat.summary if settings.CHAT_SUMMARY_ENABLED else None
+    if summary:
+        if chat.summary_upto_message_id:
+            query = query.filter(Message.id > chat.summary_upto_message_id)
+        window = settings.CHAT_RECENT_MESSAGES
+    else:
+        # Sem resumo (desligado ou ainda nao gerado) mantem a janela completa do generator.
+        window = _HISTORY_WINDOW_MESSAGES
+    recent = query.order_by(Message.id.desc()).limit(window).all()
+    history_payload = [{"role": m.role, "content": m.content} for m in reversed(recent)]
+    # O commit devolve a conexao ao pool: nenhuma conexao fica presa durante a geracao.
+    db.commit()
+    return history_payload, summary
+
+
+def _store_answer(db: Session, chat_id: int, content: str) -> Message:
+    assistant_message = Message(role="assistant", content=content, chat_id=chat_id)
+    db.add(assistant_message)
+    db.commit()
+    db.refresh(assistant_message)
+    return assistant_message
+
+
+def _store_answer_in_new_session(chat_id: int, content: str) -> int:
+    # A sessao da requisicao pode ja ter sido encerrada: persistimos com uma nova.
+    session = SessionLocal()
+    try:
+        return _store_answer(session, chat_id, content).id
+    finally:
+        session.close()
+
+
 @router.post("/{chat_id}/ask", response_model=Envelope[dict])
-def ask_chat(
+async def ask_chat(
     chat_id: int,
     payload: AskRequest,
     request: Request,
     db: Session = Depends(get_session),
     user: User = Depends(get_current_user),
 ):
+    # Rota assincrona: SQLite no threadpool, recuperacao no executor dedicado e o LLM aguardado
+    # sem ocupar thread, para que respostas lentas nao esgotem login/admin.
     rate_limit(request)
-    chat = db.query(Chat).filter(Chat.id == chat_id, Chat.user_id == user.id).first()
-    if not chat:
-        raise HTTPException(status_code=404, detail="Chat nao encontrado")
+    _validate_question(payload.question)
+    user_id = user.id
+    # O pipeline le e grava a memoria de recuperacao do chat: so comeca com o dono confirmado.
+    await run_in_threadpool(_ensure_chat_owner, db, chat_id, user_id)
+    # O prazo vale para a pergunta inteira; se o cliente sair, a geracao e cancelada.
+    deadline = Deadline.for_request()
+    guard = RequestGuard(request, deadline)
+    # Recuperacao e config comecam ja; gravar a pergunta e ler o historico roda em paralelo.
+    pipeline = start_ask_pipeline(payload.question, deadline, chat_id, user_id)
+    with pipeline.stage("history"):
+        history_payload, summary = await run_in_threadpool(_store_question, db, chat_id, user_id, payload.question)
 
     try:
-        _validate_question(payload.question)
-        user_message = Message(role="user", content=payload.question, chat_id=chat.id)
-        db.add(user_message)
-        db.commit()
-        db.refresh(user_message)
-
-        history = (
-            db.query(Message)
-            .filter(Message.chat_id == chat.id)
-            .order_by(Message.created_at.asc())
-            .all()
+        llm_response = await guard.run(
+            agenerate_answer_with_history(
+                payload.question,
+                history_payload,
+                summary=summary,
+                user_key=f"user:{user_id}",
+                pipeline=pipeline,
+                deadline=deadline,
+            )
         )
-        history_payload = [{"role": m.role, "content": m.content} for m in history]
-
-        llm_response = generate_answer_with_history(payload.question, history_payload)
-
-        assistant_message = Message(role="assistant", content=llm_response["content"], chat_id=chat.id)
-        db.add(assistant_message)
-        db.commit()
-        db.refresh(assistant_message)
+        assistant_message = await run_in_threadpool(_store_answer, db, chat_id, llm_response["content"])
+        schedule_chat_summary(chat_id)
 
         return Envelope(
             success=True,
             data={
                 "id": llm_response["id"],
                 "content": llm_response["content"],
-                "raw": llm_response.get("raw"),
                 "sources": llm_response.get("sources"),
                 "message": MessageOut.model_validate(assistant_message),
             },
         )
+    except LLMQueueFullError as exc:
+        raise service_busy(exc.retry_after) from exc
+    except DeadlineExceededError as exc:
+        await run_in_threadpool(db.rollback)
+        raise deadline_exceeded(exc.stage) from exc
+    except ClientDisconnectedError as exc:
+        await run_in_threadpool(db.rollback)
+        raise client_closed_request() from exc
     except ChatGenerationError as exc:
-        db.rollback()
+        await run_in_threadpool(db.rollback)
         raise HTTPException(status_code=400, detail=str(exc)) from exc
     except Exception as exc:  # noqa: BLE001
-        db.rollback()
+        await run_in_threadpool(db.rollback)
         raise HTTPException(status_code=500, detail="Erro ao processar a pergunta") from exc
+    finally:
+        guard.close()
+
+
+async def _open_streamed_answer(
+    chat_id: int,
+    question: str,
+    db: Session,
+    user_id: int,
+    deadline: Deadline,
+    guard: RequestGuard,
+):
+    """
+    Grava a pergunta, faz a recuperacao e abre a conexao com o LM Studio antes de responder:
+    falhas aqui ainda podem virar status HTTP adequado. Em caso de erro o guard e fechado.
+    """
+    try:
+        await run_in_threadpool(_ensure_chat_owner, db, chat_id, user_id)
+        pipeline = start_ask_pipeline(question, deadline, chat_id, user_id)
+        with pipeline.stage("history"):
+            history_payload, summary = await run_in_threadpool(_store_question, db, chat_id, user_id, question)
+        answer = await guard.run(
+            astream_answer_with_history(
+                question,
+                history_payload,
+                summary=summary,
+                user_key=f"user:{user_id}",
+                pipeline=pipeline,
+                deadline=deadline,
+            )
+        )
+        await guard.run(answer.open())
+        return answer
+    except BaseException as exc:
+        guard.close()
+        if isinstance(exc, LLMQueueFullError):
+            raise service_busy(exc.retry_after) from exc
+        if isinstance(exc, DeadlineExceededError):
+            raise deadline_exceeded(exc.stage) from exc
+        if isinstance(exc, ClientDisconnectedError):
+            raise client_closed_request() from exc
+        if isinstance(exc, ChatGenerationError):
+            raise HTTPException(status_code=400, detail=str(exc)) from exc
+        raise
 
 
 @router.post("/{chat_id}/ask/stream")
-def ask_chat_stream(
+async def ask_chat_stream(
     chat_id: int,
     payload: AskRequest,
     request: Request,
@@ -168,41 +304,123 @@ def ask_chat_stream(
     user: User = Depends(get_current_user),
 ):
     rate_limit(request)
-    chat = db.query(Chat).filter(Chat.id == chat_id, Chat.user_id == user.id).first()
-    if not chat:
-        raise HTTPException(status_code=404, detail="Chat nao encontrado")
-
     _validate_question(payload.question)
-    user_msg = Message(role="user", content=payload.question, chat_id=chat.id)
-    db.add(user_msg)
-    db.commit()
-    db.refresh(user_msg)
+    user_id = user.id
+    deadline = Deadline.for_request()
+    guard = RequestGuard(request, deadline)
+    answer = await _open_streamed_answer(chat_id, payload.question, db, user_id, deadline, guard)
 
-    history = (
-        db.query(Message)
-        .filter(Message.chat_id == chat.id)
-        .order_by(Message.created_at.asc())
-        .all()
-    )
-    history_payload = [{"role": m.role, "content": m.content} for m in history]
+    async def content_stream():
+        try:
+            # Entre um delta e outro o cliente pode sair: a iteracao e interrompida e o
+            # stream do LM Studio fechado, sem esperar o proximo envio falhar.
+            async for delta in guard.iterate(answer):
+                yield delta
+
+            await run_in_threadpool(_store_answer_in_new_session, chat_id, answer.content)
+            schedule_chat_summary(chat_id)
+
+            sources_block = answer.sources_block()
+            if sources_block:
+                yield "\n\n" + sources_block
+        except ClientDisconnectedError:
+            pass
+        except Exception as exc:  # noqa: BLE001
+            yield f"Erro: {exc}"
+        finally:
+            guard.close()
+            await answer.aclose()
+
+    # Fontes enviadas logo de inicio (antes do primeiro token), sem misturar no corpo em texto.
+    headers = {"X-Athena-Sources": json.dumps(answer.sources), "Cache-Control": "no-cache"}
+    return StreamingResponse(content_stream(), media_type="text/plain", headers=headers)
 
-    def content_stream():
+
+def _sse_response(stream: ResumableStream, request: Request, last_event_id: int) -> StreamingResponse:
+    """Envia os eventos do stream a partir de `last_event_id`; sair nao interrompe a geracao."""
+    guard = RequestGuard(request, Deadline.for_request())
+
+    async def event_stream():
+        stream.subscribe(resumed=last_event_id > 0)
         try:
-            llm_response = generate_answer_with_history(payload.question, history_payload)
-            content = llm_response["content"]
-            chunk_size = 160
+            async for event_id, event, data in guard.iterate(stream.events_after(last_event_id)):
+                yield format_sse(event_id, event, data)
+        except ClientDisconnectedError:
+            pass
+        except StreamOffsetExpiredError:
+            yield "event: error\ndata: " + json.dumps({"detail": "Retomada indisponivel; recarregue a conversa"}) + "\n\n"
+        except DeadlineExceededError as exc:
+            yield "event: error\ndata: " + json.dumps({"detail": str(exc)}) + "\n\n"
+        finally:
+            guard.close()
+            stream.unsubscribe()
+
+    headers = {"Cache-Control": "no-cache", "X-Accel-Buffering": "no", "X-Athena-Stream-Id": stream.id}
+    return StreamingResponse(event_stream(), media_type="text/event-stream", headers=headers)
+
+
+@router.post("/{chat_id}/ask/sse")
+async def ask_chat_sse(
+    chat_id: int,
+    payload: AskRequest,
+    request: Request,
+    db: Session = Depends(get_session),
+    user: User = Depends(get_current_user),
+):
+    """
+    Como /ask/stream, mas em SSE e retomavel: o primeiro evento (`meta`) traz o `stream_id`;
+    se a conexao cair, GET /chats/{id}/ask/sse/{stream_id} com Last-Event-ID continua de onde parou.
+    """
+    rate_limit(request)
+    _validate_question(payload.question)
+    user_id = user.id
+    active = active_stream_for_chat(chat_id)
+    if active is not None and active.user_id == user_id:
+        # Reenvio da mesma pergunta enquanto a anterior ainda gera: retome em vez de gerar de novo.
+        raise HTTPException(
+            status_code=409,
+            detail="Ja existe uma resposta em andamento neste chat",
+            headers={"X-Athena-Stream-Id": active.id},
+        )
+    deadline = Deadline.for_request()
+    guard = RequestGuard(request, deadline)
+    answer = await _open_streamed_answer(chat_id, payload.question, db, user_id, deadline, guard)
+    guard.close()
 
-            assistant_msg = Message(role="assistant", content=content, chat_id=chat.id)
-            db.add(assistant_msg)
-            db.commit()
+    async def on_complete(content: str) -> int:
+        message_id = await run_in_threadpool(_store_answer_in_new_session, chat_id, content)
+        schedule_chat_summary(chat_id)
+        return message_id
+
+    stream = start_stream(chat_id, user_id, answer, on_complete, deadline)
+    return _sse_response(stream, request, 0)
 
-            for idx in range(0, len(content), chunk_size):
-                yield content[idx : idx + chunk_size]
-        except Exception as exc:  # noqa: BLE001
-            db.rollback()
-            yield f"Erro: {exc}"
 
-    return StreamingResponse(content_stream(), media_type="text/plain")
+@router.get("/{chat_id}/ask/sse/{stream_id}")
+async def resume_chat_sse(
+    chat_id: int,
+    stream_id: str,
+    request: Request,
+    last_event_id: int | None = None,
+    user: User = Depends(get_current_user),
+):
+    """Retoma um stream SSE. O ultimo id recebido vem no cabecalho Last-Event-ID (ou em ?last_event_id=)."""
+    header = request.headers.get("last-event-id", "").strip()
+    if header:
+        if not header.isdigit():
+            raise HTTPException(status_code=400, detail="Last-Event-ID invalido")
+        last_event_id = int(header)
+    try:
+        stream = get_stream(stream_id, user.id)
+    except StreamNotFoundError as exc:
+        raise HTTPException(status_code=404, detail="Stream nao encontrado ou expirado") from exc
+    if stream.chat_id != chat_id:
+        raise HTTPException(status_code=404, detail="Stream nao encontrado ou expirado")
+    try:
+        stream.ensure_resumable(last_event_id or 0)
+    except StreamOffsetExpiredError as exc:
+        raise HTTPException(status_code=410, detail="Retomada indisponivel; recarregue a conversa") from exc
+    return _sse_response(stream, request, last_event_id or 0)
 
 
 @router.post("/{chat_id}/feedback", response_model=Envelope[bool])
@@ -250,5 +468,7 @@ def send_feedback(
         )
         db.add(directive)
         db.commit()
+        if user.is_admin:
+            invalidate_config_cache()
 
     return Envelope(success=True, data=True)
@@ -52,6 +52,11 @@ class PolicyUploadResponse(BaseModel):
     status: str
 
 
+class BatchAskRequest(BaseModel):
+    questions: list[str]
+    concurrency: Optional[int] = None
+
+
 class SystemConfigIn(BaseModel):
     system_prompt: Optional[str] = None
     model_name: Optional[str] = None
@@ -0,0 +1,115 @@
+import asyncio
+import time
+from collections.abc import AsyncIterator
+
+from app.core.config import settings
+from app.services.generator import (
+    ChatGenerationError,
+    _finalize_answer,
+    acall_llm_api_with_limits,
+    aprepare_generation_batch,
+)
+from app.services.llm_scheduler import PRIORITY_BACKGROUND, LLMQueueFullError, scheduler
+
+
+def _invalid_reason(question: str) -> str | None:
+    if not question.strip():
+        return "Pergunta vazia."
+    if len(question) > settings.MAX_QUESTION_CHARS:
+        return f"Pergunta muito longa (max {settings.MAX_QUESTION_CHARS} caracteres)."
+    return None
+
+
+async def _acquire_background(user_key: str) -> float:
+    # Lote nao disputa com usuarios: prioridade de segundo plano e, com a fila cheia, espera.
+    while True:
+        try:
+            return await scheduler.acquire(user_key, PRIORITY_BACKGROUND)
+        except LLMQueueFullError as exc:
+            await asyncio.sleep(exc.retry_after)
+
+
+async def _answer_one(
+    index: int,
+    question: str,
+    prepared: dict,
+    retrieval_ms: float,
+    semaphore: asyncio.Semaphore,
+    user_key: str,
+) -> dict:
+    line = {"index": index, "question": question, "answer_mode": prepared["answer_mode"]}
+    started = time.perf_counter()
+    if prepared["direct_answer"]:
+        # Resumo pre-calculado do documento: nao ocupa vaga de geracao.
+        line.update(
+            answer=_finalize_answer(prepared, prepared["direct_answer"]),
+            sources=prepared["citations"],
+            usage=None,
+            error=None,
+            timings={"retrieval_batch_ms": retrieval_ms, "wait_ms": 0.0, "llm_ms": 0.0, "total_ms": retrieval_ms},
+        )
+        return line
+    async with semaphore:
+        admitted_at = await _acquire_background(user_key)
+        llm_started = time.perf_counter()
+        try:
+            result = await acall_llm_api_with_limits(
+                prepared["messages"],
+                temperature=prepared["temperature"],
+                top_p=prepared["top_p"],
+                max_tokens=prepared["max_tokens"],
+                ledger={"kind": "batch", "answer_mode": prepared["answer_mode"]},
+            )
+            line["answer"] = _finalize_answer(prepared, result["content"])
+            line["sources"] = prepared["citations"]
+            line["usage"] = result["usage"]
+            line["error"] = None
+        except ChatGenerationError as exc:
+            line["answer"] = None
+            line["sources"] = prepared["citations"]
+            line["error"] = str(exc)
+        finally:
+            scheduler.release(admitted_at)
+    finished = time.perf_counter()
+    line["timings"] = {
+        "retrieval_batch_ms": retrieval_ms,
+        "wait_ms": round((llm_started - started) * 1000, 1),
+        "llm_ms": round((finished - llm_started) * 1000, 1),
+        "total_ms": round((finished - started) * 1000 + retrieval_ms, 1),
+    }
+    return line
+
+
+async def run_batch(questions: list[str], *, concurrency: int | None = None, user_key: str = "batch") -> AsyncIterator[dict]:
+    """
+    Responde uma lista de perguntas avulsas (sem chat). A recuperacao de todas e feita de uma
+    vez (um encoding em lote + uma busca vetorizada); as chamadas ao LLM saem com no maximo
+    `concurrency` em paralelo. Gera um dict por pergunta, na ordem em que ficam prontas.
+    """
+    concurrency = max(concurrency or settings.BATCH_LLM_CONCURRENCY, 1)
+    valid: list[tuple[int, str]] = []
+    for index, question in enumerate(questions):
+        reason = _invalid_reason(question)
+        if reason:
+            yield {"index": index, "question": question, "answer": None, "sources": [], "error": reason}
+        else:
+            valid.append((index, question))
+    if not valid:
+        return
+
+    started = time.perf_counter()
+    prepared_all = await aprepare_generation_batch([q for _, q in valid])
+    retrieval_ms = round((time.perf_counter() - started) * 1000, 1)
+
+    semaphore = asyncio.Semaphore(concurrency)
+    tasks = [
+        asyncio.ensure_future(_answer_one(index, question, prepared, retrieval_ms, semaphore, user_key))
+        for (index, question), prepared in zip(valid, prepared_all)
+    ]
+    try:
+        for next_done in asyncio.as_completed(tasks):
+            yield await next_done
+    finally:
+        # Cliente desconectou (ou erro inesperado): nao deixa geracoes orfas na fila.
+        for task in tasks:
+            task.cancel()
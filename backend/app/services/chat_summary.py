@@ -0,0 +1,149 @@
+import asyncio
+
+from fastapi.concurrency import run_in_threadpool
+
+from app.core.config import settings
+from app.db.session import SessionLocal
+from app.models import Chat, Message
+from app.services.generator import acall_llm_api_with_limits
+from app.services.llm_scheduler import PRIORITY_BACKGROUND, LLMQueueFullError, scheduler
+from app.services.prompt_budget import count_tokens
+
+_SUMMARY_PROMPT = (
+    "Voce mantem o resumo de uma conversa entre um colaborador e a assistente ATHENA sobre "
+    "politicas internas. Atualize o resumo existente incorporando os novos turnos. Preserve "
+    "fatos, numeros, politicas citadas, decisoes e duvidas em aberto; descarte cumprimentos. "
+    "Responda apenas com o resumo atualizado, em portugues, em no maximo 12 linhas."
+)
+
+# Teto de mensagens lidas por rodada; o orcamento de tokens costuma cortar antes.
+_MAX_TURNS_PER_PASS = 100
+
+_running: set[int] = set()
+_tasks: set[asyncio.Task] = set()
+
+
+def _format_turn(turn: dict) -> str:
+    speaker = "Usuario" if turn["role"] == "user" else "ATHENA"
+    return f"{speaker}: {turn['content'][: settings.CHAT_SUMMARY_TURN_CHARS]}"
+
+
+def _turns_budget(summary: str) -> int:
+    """Tokens que sobram para os turnos depois do prompt, do resumo atual e da resposta."""
+    return (
+        settings.MODEL_CONTEXT_TOKENS
+        - settings.CHAT_SUMMARY_MAX_TOKENS
+        - settings.PROMPT_SAFETY_MARGIN_TOKENS
+        - count_tokens(_SUMMARY_PROMPT)
+        - count_tokens(summary)
+    )
+
+
+def _load_pending(chat_id: int) -> tuple[str, int | None, list[dict]] | None:
+    """
+    Resumo atual + as mensagens mais antigas que ja sairam da janela recente e ainda nao foram
+    resumidas, so as que cabem num pedido (o restante fica para as proximas rodadas).
+    """
+    db = SessionLocal()
+    try:
+        chat = db.query(Chat).filter(Chat.id == chat_id).first()
+        if not chat:
+            return None
+        query = db.query(Message).filter(Message.chat_id == chat_id)
+        if chat.summary_upto_message_id:
+            query = query.filter(Message.id > chat.summary_upto_message_id)
+        overflow = query.count() - settings.CHAT_RECENT_MESSAGES
+        if overflow <= 0:
+            return None
+        rows = query.order_by(Message.id.asc()).limit(min(overflow, _MAX_TURNS_PER_PASS)).all()
+        summary = chat.summary or ""
+        budget = _turns_budget(summary)
+        turns: list[dict] = []
+        used = 0
+        for m in rows:
+            turn = {"id": m.id, "role": m.role, "content": m.content or ""}
+            cost = count_tokens(_format_turn(turn)) + 1
+            if turns and used + cost > budget:
+                break
+            turns.append(turn)
+            used += cost
+        return summary, chat.summary_upto_message_id, turns
+    finally:
+        db.close()
+
+
+def _save_summary(chat_id: int, summary: str, upto_message_id: int, previous_upto: int | None) -> bool:
+    db = SessionLocal()
+    try:
+        chat = db.query(Chat).filter(Chat.id == chat_id).first()
+        # Se outro processo ja avancou o resumo, descartamos este resultado.
+        if not chat or chat.summary_upto_message_id != previous_upto:
+            return False
+        chat.summary = summary
+        chat.summary_upto_message_id = upto_message_id
+        db.commit()
+        return True
+    finally:
+        db.close()
+
+
+def _build_messages(summary: str, turns: list[dict]) -> list[dict]:
+    transcript = "\n".join(_format_turn(t) for t in turns)
+    return [
+        {"role": "system", "content": _SUMMARY_PROMPT},
+        {
+            "role": "user",
+            "content": f"RESUMO ATUAL:\n{summary or '(vazio)'}\n\nNOVOS TURNOS:\n{transcript}",
+        },
+    ]
+
+
+async def update_chat_summary(chat_id: int) -> None:
+    """
+    Comprime no resumo os turnos que sairam da janela recente do chat, uma rodada por pedido
+    que cabe no contexto do modelo, ate alcancar a janela (chats longos levam varias rodadas).
+    """
+    if chat_id in _running:
+        return
+    _running.add(chat_id)
+    try:
+        while True:
+            loaded = await run_in_threadpool(_load_pending, chat_id)
+            if not loaded:
+                return
+            summary, previous_upto, turns = loaded
+
+            try:
+                admitted_at = await scheduler.acquire(f"summary:{chat_id}", PRIORITY_BACKGROUND)
+            except LLMQueueFullError:
+                # Fila cheia: tenta de novo apos a proxima resposta.
+                return
+            try:
+                result = await acall_llm_api_with_limits(
+                    _build_messages(summary, turns),
+                    temperature=0.1,
+                    top_p=0.9,
+                    max_tokens=settings.CHAT_SUMMARY_MAX_TOKENS,
+                    ledger={"kind": "chat_summary", "chat_id": chat_id},
+                )
+            finally:
+                scheduler.release(admitted_at)
+
+            saved = await run_in_threadpool(
+                _save_summary, chat_id, result["content"].strip(), turns[-1]["id"], previous_upto
+            )
+            if not saved:
+                return
+    except Exception as exc:  # noqa: BLE001
+        print(f"[chat-summary] Falha ao resumir chat {chat_id}: {exc}")
+    finally:
+        _running.discard(chat_id)
+
+
+def schedule_chat_summary(chat_id: int) -> None:
+    """Dispara a atualizacao do resumo em segundo plano (chamar de dentro do event loop)."""
+    if not settings.CHAT_SUMMARY_ENABLED:
+        return
+    task = asyncio.get_running_loop().create_task(update_chat_summary(chat_id))
+    _tasks.add(task)
+    task.add_done_callback(_tasks.discard)
@@ -0,0 +1,41 @@
+import threading
+import time
+from collections.abc import Callable
+from typing import Any
+
+from app.core.config import settings
+
+# Cache versionado em memoria para SystemConfig e diretrizes de feedback. As rotas de
+# admin que alteram esses dados chamam invalidate_config_cache(); o TTL e so uma rede de
+# seguranca para alteracoes feitas fora do processo (outro worker, edicao manual do banco).
+_lock = threading.Lock()
+_version = 0
+_entries: dict[Any, tuple[int, float, Any]] = {}
+
+
+def get_config_version() -> int:
+    with _lock:
+        return _version
+
+
+def invalidate_config_cache() -> None:
+    global _version
+    with _lock:
+        _version += 1
+        _entries.clear()
+
+
+def cached(key: Any, loader: Callable[[], Any]) -> Any:
+    """Devolve o valor em cache para `key` ou carrega (sem cachear se houve invalidacao no meio)."""
+    now = time.monotonic()
+    with _lock:
+        version = _version
+        entry = _entries.get(key)
+        if entry and entry[0] == version and now - entry[1] < settings.CONFIG_CACHE_TTL_SECONDS:
+            return entry[2]
+
+    value = loader()
+    with _lock:
+        if _version == version:
+            _entries[key] = (version, now, value)
+    return value
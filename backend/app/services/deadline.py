@@ -0,0 +1,172 @@
+import asyncio
+import threading
+import time
+from collections.abc import AsyncIterator, Awaitable
+from typing import Any, TypeVar
+
+from app.core.config import settings
+
+T = TypeVar("T")
+
+
+class DeadlineExceededError(Exception):
+    """O prazo da requisicao acabou; `stage` indica a etapa em que ele estourou."""
+
+    def __init__(self, stage: str):
+        super().__init__(f"Tempo limite da resposta excedido ({stage})")
+        self.stage = stage
+
+
+class ClientDisconnectedError(Exception):
+    """O cliente fechou a conexao antes do fim da resposta."""
+
+
+class Deadline:
+    """Prazo absoluto de uma requisicao, repassado por recuperacao, fila e chamada ao LLM."""
+
+    def __init__(self, seconds: float):
+        self.seconds = seconds
+        self.expires_at = time.monotonic() + seconds
+
+    @classmethod
+    def for_request(cls) -> "Deadline":
+        return cls(settings.REQUEST_DEADLINE_SECONDS)
+
+    def remaining(self) -> float:
+        return max(self.expires_at - time.monotonic(), 0.0)
+
+    @property
+    def expired(self) -> bool:
+        return time.monotonic() >= self.expires_at
+
+    def check(self, stage: str) -> None:
+        if self.expired:
+            _bump("deadline_exceeded")
+            raise DeadlineExceededError(stage)
+
+    async def wait(self, aw: Awaitable[T], stage: str) -> T:
+        """Aguarda `aw` no maximo ate o prazo (cancelando-o se estourar)."""
+        self.check(stage)
+        try:
+            return await asyncio.wait_for(aw, self.remaining())
+        except asyncio.TimeoutError as exc:
+            _bump("deadline_exceeded")
+            raise DeadlineExceededError(stage) from exc
+
+
+# Contadores de geracoes interrompidas (cliente saiu ou prazo estourou) e tokens desperdicados.
+_stats_lock = threading.Lock()
+_stats = {
+    "disconnects": 0,
+    "deadline_exceeded": 0,
+    "cancelled_in_queue": 0,
+    "cancelled_generations": 0,
+    "wasted_prompt_tokens": 0,
+    "wasted_output_tokens": 0,
+}
+_output_tokens_per_second: float | None = None
+
+
+def _bump(key: str, delta: int = 1) -> None:
+    with _stats_lock:
+        _stats[key] += delta
+
+
+def observe_generation(output_tokens: int | None, seconds: float) -> None:
+    """Media movel da velocidade de geracao, usada para estimar tokens de respostas cortadas."""
+    global _output_tokens_per_second
+    if not output_tokens or seconds <= 0:
+        return
+    rate = output_tokens / seconds
+    with _stats_lock:
+        previous = _output_tokens_per_second
+        _output_tokens_per_second = rate if previous is None else previous * 0.8 + rate * 0.2
+
+
+def estimate_output_tokens(seconds: float, max_tokens: int) -> int:
+    with _stats_lock:
+        rate = _output_tokens_per_second
+    if rate is None:
+        return 0
+    return min(int(rate * seconds), max_tokens)
+
+
+def record_cancelled_generation(prompt_tokens: int, output_tokens: int) -> None:
+    """Geracao abortada apos ocupar o LLM: o prefill e os tokens ja gerados foram perdidos."""
+    with _stats_lock:
+        _stats["cancelled_generations"] += 1
+        _stats["wasted_prompt_tokens"] += prompt_tokens
+        _stats["wasted_output_tokens"] += output_tokens
+    print(f"[cancel] geracao interrompida: prompt~{prompt_tokens} saida~{output_tokens} tokens descartados")
+
+
+def record_cancelled_in_queue() -> None:
+    _bump("cancelled_in_queue")
+
+
+def get_cancellation_stats() -> dict:
+    with _stats_lock:
+        return {
+            **_stats,
+            "deadline_seconds": settings.REQUEST_DEADLINE_SECONDS,
+            "output_tokens_per_second": round(_output_tokens_per_second, 1) if _output_tokens_per_second else None,
+        }
+
+
+class RequestGuard:
+    """
+    Acompanha uma requisicao HTTP: consulta `request.is_disconnected()` a cada
+    DISCONNECT_POLL_SECONDS e cancela a etapa em andamento quando o cliente sai ou o prazo
+    acaba. O cancelamento chega ate o httpx, que fecha a conexao com o LM Studio.
+    """
+
+    def __init__(self, request: Any, deadline: Deadline):
+        self.request = request
+        self.deadline = deadline
+        self._watcher: asyncio.Task | None = None
+
+    async def _watch(self) -> None:
+        while not await self.request.is_disconnected():
+            await asyncio.sleep(settings.DISCONNECT_POLL_SECONDS)
+
+    async def run(self, aw: Awaitable[T], stage: str = "request") -> T:
+        if self._watcher is None:
+            self._watcher = asyncio.ensure_future(self._watch())
+        task = asyncio.ensure_future(aw)
+        try:
+            done, _ = await asyncio.wait(
+                {task, self._watcher}, timeout=self.deadline.remaining(), return_when=asyncio.FIRST_COMPLETED
+            )
+        except asyncio.CancelledError:
+            # O servidor cancela a requisicao quando percebe a desconexao antes de nos.
+            _bump("disconnects")
+            task.cancel()
+            raise
+        if task in done:
+            return task.result()
+
+        task.cancel()
+        try:
+            await task
+        except BaseException:  # noqa: BLE001 - o resultado da etapa cancelada nao importa mais
+            pass
+        if self._watcher in done:
+            _bump("disconnects")
+            raise ClientDisconnectedError()
+        _bump("deadline_exceeded")
+        raise DeadlineExceededError(stage)
+
+    async def iterate(self, source: AsyncIterator[T], stage: str = "stream") -> AsyncIterator[T]:
+        """Itera `source` interrompendo (e cancelando o produtor) se o cliente sair ou o prazo acabar."""
+        iterator = source.__aiter__()
+        while True:
+            try:
+                item = await self.run(iterator.__anext__(), stage)
+            except StopAsyncIteration:
+                return
+            yield item
+
+    def close(self) -> None:
+        if self._watcher is not None:
+            self._watcher.cancel()
+            self._watcher = None
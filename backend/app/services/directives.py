@@ -0,0 +1,118 @@
+import threading
+
+import numpy as np
+from sqlalchemy.exc import OperationalError
+
+from app.core.config import settings
+from app.db.session import SessionLocal
+from app.models import FeedbackDirective
+from app.services.config_cache import cached
+from app.services.embeddings import encode_queries, encode_texts
+from app.services.prompt_budget import count_tokens
+
+# Tokens de diretrizes enviados por pergunta, comparados ao envio das FEEDBACK_DIRECTIVES_LIMIT
+# mais recentes em todo prompt (comportamento anterior).
+_stats_lock = threading.Lock()
+_stats = {"requests": 0, "directives_injected": 0, "tokens_injected": 0, "tokens_saved": 0}
+
+
+def embed_directive(text: str) -> bytes:
+    """Vetor da diretriz (float32 normalizado) para gravar no banco quando ela e aplicada."""
+    return encode_texts([text])[0].tobytes()
+
+
+def _query_directive_index() -> dict:
+    db = SessionLocal()
+    try:
+        rows = (
+            db.query(FeedbackDirective)
+            .filter(FeedbackDirective.status == "applied")
+            .order_by(FeedbackDirective.applied_at.desc())
+            .all()
+        )
+        rows = [row for row in rows if (row.text or "").strip()]
+        missing = [row for row in rows if not row.is_global and not row.embedding]
+        if missing:
+            # Diretrizes aplicadas antes da indexacao: o vetor e calculado e gravado uma unica vez.
+            for row, vector in zip(missing, encode_texts([row.text for row in missing])):
+                row.embedding = vector.tobytes()
+            db.commit()
+
+        limit = settings.FEEDBACK_DIRECTIVES_LIMIT or None
+        global_rows = [row for row in rows if row.is_global][:limit]
+        scoped_rows = [row for row in rows if not row.is_global]
+        return {
+            "applied": len(rows),
+            "global": [row.text for row in global_rows],
+            "global_tokens": sum(count_tokens(row.text) for row in global_rows),
+            "texts": [row.text for row in scoped_rows],
+            "tokens": [count_tokens(row.text) for row in scoped_rows],
+            "matrix": (
+                np.stack([np.frombuffer(row.embedding, dtype=np.float32) for row in scoped_rows])
+                if scoped_rows
+                else np.zeros((0, 0), dtype=np.float32)
+            ),
+            "baseline_tokens": sum(count_tokens(row.text) for row in rows[:limit]),
+        }
+    except OperationalError:
+        return {"applied": 0, "global": [], "global_tokens": 0, "texts": [], "tokens": [], "matrix": None, "baseline_tokens": 0}
+    finally:
+        db.close()
+
+
+def load_directive_index() -> dict:
+    """Diretrizes aplicadas e seus vetores (cache em memoria, invalidado pelas rotas de admin)."""
+    return cached("directive_index", _query_directive_index)
+
+
+def select_directives(question: str, query_emb: np.ndarray | None = None) -> tuple[list[str], list[str]]:
+    return select_directives_batch([question], query_emb[None, :] if query_emb is not None else None)[0]
+
+
+def select_directives_batch(
+    questions: list[str], query_embs: np.ndarray | None = None
+) -> list[tuple[list[str], list[str]]]:
+    """
+    Para cada pergunta: (diretrizes globais, diretrizes relevantes). As relevantes sao as
+    FEEDBACK_DIRECTIVES_TOP_K mais proximas da pergunta com score >= FEEDBACK_DIRECTIVES_MIN_SCORE,
+    ate completar FEEDBACK_DIRECTIVES_LIMIT junto com as globais. `query_embs` sao os vetores que
+    a recuperacao ja calculou (encode_queries); sem eles, as perguntas sao codificadas aqui.
+    """
+    index = load_directive_index()
+    room = settings.FEEDBACK_DIRECTIVES_TOP_K
+    if settings.FEEDBACK_DIRECTIVES_LIMIT:
+        room = min(room, max(settings.FEEDBACK_DIRECTIVES_LIMIT - len(index["global"]), 0))
+
+    selected: list[list[int]] = [[] for _ in questions]
+    if index["texts"] and room > 0 and questions:
+        if query_embs is None:
+            query_embs = encode_queries(questions)
+        scores = index["matrix"] @ query_embs.T
+        for column, chosen in enumerate(selected):
+            column_scores = scores[:, column]
+            for position in np.argsort(-column_scores)[:room]:
+                if column_scores[position] >= settings.FEEDBACK_DIRECTIVES_MIN_SCORE:
+                    chosen.append(int(position))
+
+    with _stats_lock:
+        for chosen in selected:
+            injected = index["global_tokens"] + sum(index["tokens"][p] for p in chosen)
+            _stats["requests"] += 1
+            _stats["directives_injected"] += len(index["global"]) + len(chosen)
+            _stats["tokens_injected"] += injected
+            _stats["tokens_saved"] += max(index["baseline_tokens"] - injected, 0)
+    return [(list(index["global"]), [index["texts"][p] for p in chosen]) for chosen in selected]
+
+
+def get_directive_stats() -> dict:
+    index = load_directive_index()
+    with _stats_lock:
+        stats = dict(_stats)
+    return {
+        **stats,
+        "applied": index["applied"],
+        "global": len(index["global"]),
+        "indexed": len(index["texts"]),
+        "top_k": settings.FEEDBACK_DIRECTIVES_TOP_K,
+        "min_score": settings.FEEDBACK_DIRECTIVES_MIN_SCORE,
+    }
@@ -0,0 +1,199 @@
+import asyncio
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+from app.core.config import settings
+from app.db.session import SessionLocal
+from app.models import PolicyFile
+from app.services.config_cache import invalidate_config_cache
+from app.services.generator import _SUMMARY_TEMPLATE, acall_llm_api_with_limits
+from app.services.ingest import POLICY_DIR, get_ingest_status
+from app.services.llm_scheduler import PRIORITY_BACKGROUND, LLMQueueFullError, scheduler
+from app.services.parser import extract_text_from_file
+
+_MAP_PROMPT = (
+    "Voce le uma parte de um documento interno que depois sera resumido. Extraia, em topicos "
+    "curtos, os fatos desta parte: partes envolvidas, datas, horarios, locais, valores, condicoes "
+    "de pagamento, prazos, obrigacoes, penalidades e regras. Nao invente nada; ignore hash, IDs e "
+    "assinaturas. Responda apenas com os topicos, em portugues."
+)
+_REDUCE_PROMPT = (
+    "Voce escreve o resumo de um documento interno a partir de anotacoes feitas parte a parte "
+    "(em ordem). Use somente as anotacoes.\n\n" + _SUMMARY_TEMPLATE
+)
+
+# Chamadas map em paralelo (limitadas) para todos os documentos; o worker processa um arquivo por vez.
+# Cada chamada ainda passa pelo escalonador do LLM, entao nao ultrapassa LLM_MAX_CONCURRENT_GENERATIONS.
+_llm_executor = ThreadPoolExecutor(max_workers=max(settings.DOC_SUMMARY_CONCURRENCY, 1), thread_name_prefix="athena-doc-summary")
+_worker: threading.Thread | None = None
+_worker_lock = threading.Lock()
+_requested = threading.Event()
+# Event loop da API (o escalonador e o cliente assincrono do LLM vivem nele).
+_loop: asyncio.AbstractEventLoop | None = None
+_loop_ready = threading.Event()
+_LOOP_WAIT_SECONDS = 30
+
+
+def attach_event_loop() -> None:
+    """Registra o loop da API para as chamadas do worker (chamar no startup, antes de pedir resumos)."""
+    global _loop
+    _loop = asyncio.get_running_loop()
+    _loop_ready.set()
+
+
+def _page_groups(pages: list[str], max_chars: int) -> list[tuple[int, int, str]]:
+    """Agrupa paginas consecutivas em blocos de ate max_chars: (pagina inicial, final, texto)."""
+    groups: list[tuple[int, int, str]] = []
+    start, parts, size = 1, [], 0
+    for number, page in enumerate(pages, start=1):
+        text = "\n".join(line.strip() for line in page.splitlines() if line.strip())
+        if not text:
+            continue
+        if parts and size + len(text) > max_chars:
+            groups.append((start, number - 1, "\n\n".join(parts)))
+            parts, size = [], 0
+        if not parts:
+            start = number
+        # Pagina maior que o bloco: entra cortada em pedacos.
+        for offset in range(0, len(text), max_chars):
+            piece = text[offset : offset + max_chars]
+            if parts and size + len(piece) > max_chars:
+                groups.append((start, number, "\n\n".join(parts)))
+                parts, size, start = [], 0, number
+            parts.append(piece)
+            size += len(piece)
+    if parts:
+        groups.append((start, len(pages), "\n\n".join(parts)))
+    return groups
+
+
+async def _aask(system: str, content: str, max_tokens: int) -> str:
+    # Segundo plano: cede a vez a usuarios e, com a fila cheia, espera em vez de falhar.
+    while True:
+        try:
+            admitted_at = await scheduler.acquire("doc-summary", PRIORITY_BACKGROUND)
+            break
+        except LLMQueueFullError as exc:
+            await asyncio.sleep(exc.retry_after)
+    try:
+        result = await acall_llm_api_with_limits(
+            [{"role": "system", "content": system}, {"role": "user", "content": content}],
+            temperature=0.1,
+            top_p=0.9,
+            max_tokens=max_tokens,
+            ledger={"kind": "doc_summary"},
+        )
+    finally:
+        scheduler.release(admitted_at)
+    return result["content"].strip()
+
+
+def _ask(system: str, content: str, max_tokens: int) -> str:
+    if not _loop_ready.wait(_LOOP_WAIT_SECONDS) or _loop is None or _loop.is_closed():
+        raise RuntimeError("event loop da API indisponivel")
+    return asyncio.run_coroutine_threadsafe(_aask(system, content, max_tokens), _loop).result()
+
+
+def _map_group(filename: str, group: tuple[int, int, str]) -> str:
+    first, last, text = group
+    pages = f"pagina {first}" if first == last else f"paginas {first}-{last}"
+    notes = _ask(_MAP_PROMPT, f"DOCUMENTO: {filename} ({pages})\n\n{text}", max_tokens=400)
+    return f"[{pages}]\n{notes}"
+
+
+def summarize_document(filename: str, pages: list[str]) -> str:
+    """Map-reduce: anotacoes por bloco de paginas (em paralelo) e um resumo final no formato RESUMO."""
+    max_chars = settings.DOC_SUMMARY_MAP_CHARS
+    notes = list(_llm_executor.map(lambda g: _map_group(filename, g), _page_groups(pages, max_chars)))
+    if not notes:
+        return ""
+
+    # Anotacoes que nao cabem num unico pedido sao condensadas em rodadas.
+    while len(notes) > 1 and sum(len(n) for n in notes) > max_chars:
+        groups = _page_groups(notes, max_chars)
+        if len(groups) >= len(notes):
+            break
+        notes = list(
+            _llm_executor.map(lambda g: _ask(_MAP_PROMPT, f"DOCUMENTO: {filename}\n\n{g[2]}", max_tokens=500), groups)
+        )
+
+    return _ask(_REDUCE_PROMPT, f"DOCUMENTO: {filename}\n\nANOTACOES:\n" + "\n\n".join(notes), max_tokens=750)
+
+
+def _pending_documents() -> list[tuple[int, str, str]]:
+    """Politicas vetorizadas cujo resumo nao corresponde ao hash atual do arquivo."""
+    hashes = get_ingest_status()["hashes"]
+    db = SessionLocal()
+    try:
+        policies = (
+            db.query(PolicyFile)
+            .filter(PolicyFile.active.is_(True), PolicyFile.embedding_status == "completed")
+            .all()
+        )
+        return [
+            (p.id, p.filename, hashes[p.filename])
+            for p in policies
+            if hashes.get(p.filename) and p.summary_hash != hashes[p.filename]
+        ]
+    finally:
+        db.close()
+
+
+def _save_summary(policy_id: int, filename: str, summary: str, file_hash: str) -> bool:
+    # O arquivo pode ter mudado durante a geracao: so grava se o hash ainda for o mesmo.
+    if get_ingest_status()["hashes"].get(filename) != file_hash:
+        return False
+    db = SessionLocal()
+    try:
+        policy = db.query(PolicyFile).filter(PolicyFile.id == policy_id).first()
+        if not policy:
+            return False
+        policy.summary = summary
+        policy.summary_hash = file_hash
+        db.commit()
+    finally:
+        db.close()
+    invalidate_config_cache()
+    return True
+
+
+def refresh_document_summaries() -> int:
+    """Gera os resumos que faltam (ou estao desatualizados). Retorna quantos foram gravados."""
+    saved = 0
+    for policy_id, filename, file_hash in _pending_documents():
+        try:
+            pages = extract_text_from_file(POLICY_DIR / filename)
+            if not pages or not any(p.strip() for p in pages):
+                continue
+            print(f"[doc-summary] Resumindo {filename} ({len(pages)} paginas)...")
+            summary = summarize_document(filename, pages)
+            if summary and _save_summary(policy_id, filename, summary, file_hash):
+                saved += 1
+                print(f"[doc-summary] Resumo de {filename} salvo.")
+        except Exception as exc:  # noqa: BLE001
+            # Tenta de novo no proximo pedido (ingestao, watcher ou reprocessamento).
+            print(f"[doc-summary] Falha ao resumir {filename}: {exc}")
+    return saved
+
+
+def _run_worker() -> None:
+    global _worker
+    while True:
+        with _worker_lock:
+            if not _requested.is_set():
+                _worker = None
+                return
+            _requested.clear()
+        refresh_document_summaries()
+
+
+def request_document_summaries() -> None:
+    """Agenda a geracao dos resumos em segundo plano (um unico worker; pedidos se acumulam)."""
+    global _worker
+    if not settings.DOC_SUMMARY_ENABLED:
+        return
+    with _worker_lock:
+        _requested.set()
+        if _worker is None:
+            _worker = threading.Thread(target=_run_worker, daemon=True, name="athena-doc-summary-worker")
+            _worker.start()
@@ -1,6 +1,9 @@
+import hashlib
 import os
 import pickle
 import re
+import shutil
+import threading
 import unicodedata
 from collections import defaultdict
 from typing import Dict, List, Tuple
@@ -9,14 +12,24 @@ import numpy as np
 from sentence_transformers import SentenceTransformer
 
 from app.core.config import settings
+from app.services.minhash import NearDuplicateIndex, collapse_near_duplicates, occurrence_of, signature
 
 MODEL_NAME = "sentence-transformers/all-MiniLM-L6-v2"
 model = SentenceTransformer(MODEL_NAME)
 
 EMBEDDINGS_FILE = settings.EMBEDDINGS_FILE
+# Cada documento (source) e persistido em seu proprio segmento. Assim a ingestao
+# faz checkpoint por arquivo sem regravar o indice inteiro a cada documento.
+SEGMENTS_DIR = os.path.splitext(EMBEDDINGS_FILE)[0] + "_segments"
 
 # Estrutura em memoria
 emb_store: List[Dict] = []
+_store_lock = threading.Lock()
+
+# Indice de busca derivado do emb_store: um vetor canonico por grupo de quase duplicados.
+_index: Dict | None = None
+_index_version = 0
+_index_lock = threading.Lock()
 
 
 # --------------------------
@@ -26,24 +39,19 @@ emb_store: List[Dict] = []
 def reset_embeddings() -> None:
     """Limpa vetorizacoes em memoria e arquivo."""
     global emb_store
-    emb_store = []
+    with _store_lock:
+        emb_store = []
+        _invalidate_index()
 
-    if os.path.exists(EMBEDDINGS_FILE):
-        os.remove(EMBEDDINGS_FILE)
+        if os.path.exists(EMBEDDINGS_FILE):
+            os.remove(EMBEDDINGS_FILE)
+        if os.path.isdir(SEGMENTS_DIR):
+            shutil.rmtree(SEGMENTS_DIR)
 
 
-def store_embeddings(text_chunks: List[Dict]) -> None:
-    """
-    Recebe uma lista de chunks no formato:
-    {
-        "text": "...",
-        "source": "...",
-        "page": 3,
-        "order": 10
-    }
-    """
-    global emb_store
-
+def _build_items(text_chunks: List[Dict]) -> List[Dict]:
+    """Enriquece os chunks com metadados semanticos e calcula os embeddings (em lote)."""
+    prepared: List[Dict] = []
     for item in text_chunks:
         text = (item.get("text") or "").strip()
         if not text:
@@ -75,13 +83,10 @@ def store_embeddings(text_chunks: List[Dict]) -> None:
             doc_type=doc_type,
         )
 
-        emb = model.encode(semantic_text, convert_to_numpy=True)
-
-        emb_store.append(
+        prepared.append(
             {
                 "text": text,
                 "semantic_text": semantic_text,
-                "embedding": emb,
                 "source": item.get("source"),
                 "page": item.get("page"),
                 "order": item.get("order"),
@@ -89,21 +94,79 @@ def store_embeddings(text_chunks: List[Dict]) -> None:
                 "role": role,
                 "topic": topic,
                 "doc_type": doc_type,
+                "minhash": item.get("minhash"),
+                "occurrences": item.get("occurrences") or [occurrence_of(item)],
             }
         )
 
-    save_embeddings()
+    if prepared:
+        vectors = model.encode([p["semantic_text"] for p in prepared], convert_to_numpy=True)
+        for entry, emb in zip(prepared, vectors):
+            entry["embedding"] = emb
+    return prepared
+
+
+def store_embeddings(text_chunks: List[Dict]) -> None:
+    """
+    Recebe uma lista de chunks no formato:
+    {
+        "text": "...",
+        "source": "...",
+        "page": 3,
+        "order": 10
+    }
+    """
+    global emb_store
+
+    items = _build_items(collapse_near_duplicates(text_chunks))
+    with _store_lock:
+        emb_store = emb_store + items
+        _invalidate_index()
+        for source in {item.get("source") for item in items}:
+            _write_segment(source, [i for i in emb_store if i.get("source") == source])
+
+
+def replace_source_embeddings(source: str, text_chunks: List[Dict]) -> int:
+    """
+    Substitui os embeddings de um documento e persiste somente o segmento dele.
+    Os vetores antigos continuam servindo buscas ate o novo segmento estar pronto.
+    """
+    global emb_store
+
+    # Quase duplicados do mesmo documento (rodapes, assinaturas) viram um unico vetor.
+    canonical = collapse_near_duplicates(text_chunks)
+    if len(canonical) < len(text_chunks):
+        print(f"[embeddings] {source}: {len(text_chunks)} chunks -> {len(canonical)} apos remover quase duplicados")
+    items = _build_items(canonical)
+    with _store_lock:
+        emb_store = [i for i in emb_store if i.get("source") != source] + items
+        _invalidate_index()
+        _write_segment(source, items)
+    return len(items)
 
 
 def load_embeddings() -> None:
-    """Carrega embeddings do disco."""
+    """Carrega embeddings do disco (segmentos por documento ou arquivo legado unico)."""
     global emb_store
 
-    if os.path.exists(EMBEDDINGS_FILE):
-        with open(EMBEDDINGS_FILE, "rb") as f:
-            emb_store = pickle.load(f)
-    else:
-        emb_store = []
+    with _store_lock:
+        if os.path.isdir(SEGMENTS_DIR):
+            store: List[Dict] = []
+            for name in sorted(os.listdir(SEGMENTS_DIR)):
+                if not name.endswith(".pkl"):
+                    continue
+                with open(os.path.join(SEGMENTS_DIR, name), "rb") as f:
+                    segment = pickle.load(f)
+                store.extend(segment.get("items") or [])
+            emb_store = store
+        elif os.path.exists(EMBEDDINGS_FILE):
+            with open(EMBEDDINGS_FILE, "rb") as f:
+                emb_store = pickle.load(f)
+            # Migra o formato legado para segmentos na primeira carga.
+            _write_all_segments()
+        else:
+            emb_store = []
+        _invalidate_index()
 
 
 def _ensure_loaded() -> None:
@@ -368,14 +431,17 @@ def _all_chunks_for_sources(sources: list[str]) -> list[Dict]:
     wanted = set(sources)
     chunks: list[Dict] = []
     for item in emb_store:
-        if item.get("source") in wanted:
+        # Trecho quase duplicado guardado uma vez: vale para cada documento em que aparece.
+        for occ in item.get("occurrences") or [occurrence_of(item)]:
+            if occ.get("source") not in wanted:
+                continue
             text = item.get("text") or ""
             chunks.append(
                 {
                     "text": text,
-                    "source": item.get("source", ""),
-                    "page": item.get("page", 0),
-                    "order": item.get("order", 0),
+                    "source": occ.get("source") or "",
+                    "page": occ.get("page") or 0,
+                    "order": occ.get("order") or 0,
                     "score": float(item.get("score") or 0.0) + _summary_relevance_score(text),
                     "category": item.get("category", "indefinido"),
                     "role": item.get("role", "indefinido"),
@@ -387,10 +453,41 @@ def _all_chunks_for_sources(sources: list[str]) -> list[Dict]:
 
 
 def save_embeddings() -> None:
-    """Persiste o emb_store em disco."""
-    os.makedirs(os.path.dirname(EMBEDDINGS_FILE) or "data", exist_ok=True)
-    with open(EMBEDDINGS_FILE, "wb") as f:
-        pickle.dump(emb_store, f)
+    """Persiste o emb_store em disco (todos os segmentos)."""
+    with _store_lock:
+        _write_all_segments()
+
+
+def _segment_path(source: str) -> str:
+    digest = hashlib.sha1(str(source or "").encode("utf-8")).hexdigest()[:16]
+    return os.path.join(SEGMENTS_DIR, f"{digest}.pkl")
+
+
+def _write_segment(source: str, items: List[Dict]) -> None:
+    """Grava o segmento de um documento de forma atomica (tmp + rename)."""
+    os.makedirs(SEGMENTS_DIR, exist_ok=True)
+    path = _segment_path(source)
+    if not items:
+        if os.path.exists(path):
+            os.remove(path)
+        return
+    tmp_path = path + ".tmp"
+    with open(tmp_path, "wb") as f:
+        pickle.dump({"source": source, "items": items}, f)
+    os.replace(tmp_path, path)
+
+
+def _write_all_segments() -> None:
+    by_source: dict[str, list[Dict]] = defaultdict(list)
+    for item in emb_store:
+        by_source[item.get("source")].append(item)
+    os.makedirs(SEGMENTS_DIR, exist_ok=True)
+    wanted = {os.path.basename(_segment_path(source)) for source in by_source}
+    for name in os.listdir(SEGMENTS_DIR):
+        if name.endswith(".pkl") and name not in wanted:
+            os.remove(os.path.join(SEGMENTS_DIR, name))
+    for source, items in by_source.items():
+        _write_segment(source, items)
 
 
 def remove_embeddings_for_source(source: str) -> None:
@@ -398,46 +495,266 @@ def remove_embeddings_for_source(source: str) -> None:
     global emb_store
     if not emb_store:
         load_embeddings()
-    emb_store = [item for item in emb_store if item.get("source") != source]
-    save_embeddings()
+    with _store_lock:
+        emb_store = [item for item in emb_store if item.get("source") != source]
+        _invalidate_index()
+        _write_segment(source, [])
+
+
+def _invalidate_index() -> None:
+    global _index, _index_version
+    _index = None
+    _index_version += 1
+
 
+def get_index_version() -> int:
+    """Versao do indice em memoria; muda sempre que o emb_store e alterado."""
+    return _index_version
 
-def _cosine_similarity(a: np.ndarray, b: np.ndarray) -> float:
-    denom = (np.linalg.norm(a) * np.linalg.norm(b)) + 1e-8
-    return float(np.dot(a, b) / denom)
 
+def _build_index(store: List[Dict]) -> Dict:
+    """
+    Agrupa quase duplicados entre documentos (MinHash/LSH) e monta a matriz normalizada
+    apenas com os vetores canonicos. Cada item canonico guarda todas as ocorrencias.
+    """
+    lsh = NearDuplicateIndex()
+    canonical: List[Dict] = []
+    for item in store:
+        sig = item.get("minhash")
+        if sig is None:
+            sig = signature(item.get("text") or "")
+        occurrences = item.get("occurrences") or [occurrence_of(item)]
+        match = lsh.find(sig)
+        if match is not None:
+            canonical[match]["occurrences"].extend(occurrences)
+            continue
+        lsh.add(sig)
+        canonical.append({**item, "occurrences": list(occurrences)})
 
-def search_similar_documents(query: str, k: int = 5) -> List[Dict]:
-    """Retorna os K chunks mais similares com metadados completos."""
+    if canonical:
+        matrix = np.stack([np.asarray(c["embedding"], dtype=np.float32) for c in canonical])
+        matrix /= np.linalg.norm(matrix, axis=1, keepdims=True) + 1e-8
+    else:
+        matrix = np.zeros((0, 0), dtype=np.float32)
+
+    # Posicoes canonicas por documento e por (documento, pagina), para buscas restritas a um subconjunto.
+    by_source: Dict[str, set[int]] = defaultdict(set)
+    by_page: Dict[tuple[str, int], set[int]] = defaultdict(set)
+    for position, item in enumerate(canonical):
+        for occ in item["occurrences"]:
+            source = occ.get("source") or ""
+            by_source[source].add(position)
+            by_page[(source, int(occ.get("page") or 0))].add(position)
+
+    total = sum(len(c["occurrences"]) for c in canonical)
+    print(f"[embeddings] Indice: {total} trechos -> {len(canonical)} vetores canonicos")
+    return {"items": canonical, "matrix": matrix, "by_source": dict(by_source), "by_page": dict(by_page)}
+
+
+def _get_index() -> Dict:
+    global _index
+    index = _index
+    if index is not None:
+        return index
+    with _index_lock:
+        if _index is not None:
+            return _index
+        version = _index_version
+        built = _build_index(emb_store)
+        # So publica se o store nao mudou durante a construcao.
+        if version == _index_version:
+            _index = built
+        return built
+
+
+def search_similar_documents(query: str, k: int = 5, query_emb: np.ndarray | None = None) -> List[Dict]:
+    """Retorna os K chunks mais similares com metadados completos (`query_emb`: vetor ja calculado)."""
     if not emb_store:
         load_embeddings()
 
     if not emb_store:
         return []
 
-    query_semantic = build_query_semantic_text(query)
-    query_emb = model.encode(query_semantic, convert_to_numpy=True)
-    scored = []
+    index = _get_index()
+    if not index["items"]:
+        return []
 
-    for item in emb_store:
-        score = _cosine_similarity(query_emb, item["embedding"])
+    scores = index["matrix"] @ (query_emb if query_emb is not None else encode_query(query))
+    return _scored_matches(index, scores, k)
 
-        scored.append(
-            {
-                "text": item.get("text", ""),
-                "source": item.get("source", ""),
-                "page": item.get("page", 0),
-                "order": item.get("order", 0),
-                "category": item.get("category", "indefinido"),
-                "role": item.get("role", "indefinido"),
-                "topic": item.get("topic", "indefinido"),
-                "doc_type": item.get("doc_type", "indefinido"),
-                "score": score,
-            }
-        )
 
-    scored.sort(key=lambda x: x["score"], reverse=True)
-    return scored[:k]
+def encode_query(query: str) -> np.ndarray:
+    """Vetor normalizado da pergunta usado na busca; o generator o repassa a selecao de diretrizes."""
+    query_emb = np.asarray(model.encode(build_query_semantic_text(query), convert_to_numpy=True), dtype=np.float32)
+    query_emb /= np.linalg.norm(query_emb) + 1e-8
+    return query_emb
+
+
+def encode_queries(queries: List[str]) -> np.ndarray:
+    """encode_query para varias perguntas num unico model.encode (uma linha por pergunta)."""
+    if not queries:
+        return np.zeros((0, 0), dtype=np.float32)
+    semantic = [build_query_semantic_text(q) for q in queries]
+    query_embs = np.asarray(
+        model.encode(semantic, batch_size=settings.BATCH_ENCODE_SIZE, convert_to_numpy=True),
+        dtype=np.float32,
+    )
+    query_embs /= np.linalg.norm(query_embs, axis=1, keepdims=True) + 1e-8
+    return query_embs
+
+
+def encode_texts(texts: List[str]) -> np.ndarray:
+    """Vetores normalizados (float32) para textos avulsos, ex.: diretrizes e perguntas."""
+    if not texts:
+        return np.zeros((0, 0), dtype=np.float32)
+    embs = np.asarray(
+        model.encode(texts, batch_size=settings.BATCH_ENCODE_SIZE, convert_to_numpy=True),
+        dtype=np.float32,
+    )
+    embs /= np.linalg.norm(embs, axis=1, keepdims=True) + 1e-8
+    return embs
+
+
+def _working_set_positions(index: Dict, working_set: Dict) -> np.ndarray:
+    """
+    Posicoes canonicas do conjunto de trabalho: todos os trechos dos documentos lembrados ou,
+    se isso passar de CHAT_MEMORY_MAX_CHUNKS, apenas as paginas citadas nos ultimos turnos.
+    """
+    positions: set[int] = set()
+    for source in working_set.get("sources") or ():
+        positions.update(index["by_source"].get(source, ()))
+    if len(positions) > settings.CHAT_MEMORY_MAX_CHUNKS:
+        positions = set()
+        for source, page in working_set.get("chunks") or ():
+            positions.update(index["by_page"].get((source, int(page)), ()))
+    return np.fromiter(sorted(positions), dtype=np.int64, count=len(positions))
+
+
+def _names_other_document(query: str, index: Dict, sources: list[str]) -> bool:
+    """A pergunta cita pelo nome um documento fora do conjunto de trabalho (ex.: outra politica)?"""
+    known = set().union(*(_tokenize(s) for s in sources)) if sources else set()
+    distinctive = {t for t in _tokenize(query) - known if len(t) >= 3}
+    if not distinctive:
+        return False
+    return any(distinctive & _tokenize(source) for source in index["by_source"] if source not in sources)
+
+
+def _search_working_set(
+    query: str, k: int, working_set: Dict, query_emb: np.ndarray | None = None
+) -> tuple[List[Dict], bool]:
+    """
+    Pontua so o subconjunto lembrado do chat (um produto com poucas linhas em vez da matriz
+    inteira). Se o melhor score ficar abaixo de CHAT_MEMORY_MIN_SCORE, reaproveita o mesmo
+    vetor da pergunta na busca global. Retorna (trechos, se o conjunto de trabalho bastou).
+    A pergunta curta e codificada junto com a ultima pergunta completa do chat ("anchor");
+    sem anchor, usa `query_emb` quando ja calculado.
+    """
+    if not emb_store:
+        load_embeddings()
+    if not emb_store:
+        return [], False
+
+    index = _get_index()
+    if not index["items"]:
+        return [], False
+
+    anchor = working_set.get("anchor")
+    if anchor:
+        query_emb = encode_query(f"{anchor}\n{query}")
+    elif query_emb is None:
+        query_emb = encode_query(query)
+    sources = list(working_set.get("sources") or ())
+    if not _names_other_document(query, index, sources):
+        positions = _working_set_positions(index, working_set)
+        if positions.size:
+            subset_scores = index["matrix"][positions] @ query_emb
+            if float(subset_scores.max()) >= settings.CHAT_MEMORY_MIN_SCORE:
+                return _scored_matches(index, subset_scores, k, positions, prefer_sources=set(sources)), True
+
+    return _scored_matches(index, index["matrix"] @ query_emb, k), False
+
+
+def search_similar_documents_batch(
+    queries: List[str], ks: List[int], query_embs: np.ndarray | None = None
+) -> List[List[Dict]]:
+    """
+    Como search_similar_documents para varias consultas: um unico model.encode em lote e um
+    unico produto de matrizes (trechos x consultas). `ks[i]` e o K da consulta i; `query_embs`
+    traz os vetores ja calculados (uma linha por consulta).
+    """
+    if not emb_store:
+        load_embeddings()
+
+    if not queries or not emb_store:
+        return [[] for _ in queries]
+
+    index = _get_index()
+    if not index["items"]:
+        return [[] for _ in queries]
+
+    if query_embs is None:
+        query_embs = encode_queries(queries)
+    scores = index["matrix"] @ query_embs.T
+    return [_scored_matches(index, scores[:, i], ks[i]) for i in range(len(queries))]
+
+
+def _scored_matches(
+    index: Dict,
+    scores: np.ndarray,
+    k: int,
+    positions: np.ndarray | None = None,
+    prefer_sources: set[str] | None = None,
+) -> List[Dict]:
+    """
+    No maximo `k` trechos. `positions` mapeia cada score para a posicao no indice quando a busca
+    foi num subconjunto; com `prefer_sources`, o trecho sai rotulado com a ocorrencia desses documentos.
+    """
+    top = np.argsort(-scores)[:k]
+    scored = []
+    for rank in top:
+        position = int(positions[rank]) if positions is not None else int(rank)
+        item = index["items"][position]
+        # Um vetor canonico pode representar varias ocorrencias (source, page): a primeira vira o
+        # trecho devolvido e as demais seguem como metadado, sem ocupar vagas do top-k.
+        first, *others = [_occurrence_ref(occ) for occ in item["occurrences"]]
+        match = {
+            "text": item.get("text", ""),
+            **first,
+            "category": item.get("category", "indefinido"),
+            "role": item.get("role", "indefinido"),
+            "topic": item.get("topic", "indefinido"),
+            "doc_type": item.get("doc_type", "indefinido"),
+            "cluster": position,
+            "duplicates": others,
+            "score": float(scores[rank]),
+        }
+        scored.append((_with_source_in(match, prefer_sources) if prefer_sources else None) or match)
+
+    return scored
+
+
+def _occurrence_ref(occ: Dict) -> Dict:
+    return {"source": occ.get("source") or "", "page": occ.get("page") or 0, "order": occ.get("order") or 0}
+
+
+def _match_sources(match: Dict) -> list[str]:
+    """Documentos em que o trecho aparece: o do rotulo e os das ocorrencias quase duplicadas."""
+    return [match["source"]] + [d["source"] for d in match.get("duplicates") or ()]
+
+
+def _with_source_in(match: Dict, sources) -> Dict | None:
+    """
+    O trecho rotulado (source/page/order, e portanto a citacao) com a primeira ocorrencia que
+    pertence a `sources`; a ocorrencia anterior passa para `duplicates`. None se nenhuma pertence.
+    """
+    if match.get("source") in sources:
+        return match
+    duplicates = match.get("duplicates") or []
+    for i, dup in enumerate(duplicates):
+        if dup["source"] in sources:
+            rest = [_occurrence_ref(match)] + duplicates[:i] + duplicates[i + 1 :]
+            return {**match, **dup, "duplicates": rest}
+    return None
 
 
 def _normalize_text(text: str) -> str:
@@ -596,7 +913,8 @@ def _pick_preferred_sources(query: str, matches: List[Dict]) -> list[str]:
 
     by_source: dict[str, list[dict]] = defaultdict(list)
     for m in matches:
-        by_source[m["source"]].append(m)
+        for source in _match_sources(m):
+            by_source[source].append(m)
 
     scored_sources: list[tuple[str, int, float]] = []
     for source, items in by_source.items():
@@ -625,6 +943,13 @@ def _pick_preferred_sources(query: str, matches: List[Dict]) -> list[str]:
     return []
 
 
+def find_summary_source(query: str, query_emb: np.ndarray | None = None) -> str | None:
+    """Documento unico que a pergunta pede para resumir (mesma heuristica do modo "summary")."""
+    matches = _rerank_matches(query, search_similar_documents(query, _candidate_count(10, "summary"), query_emb))
+    preferred = _pick_preferred_sources(query, matches)
+    return preferred[0] if len(preferred) == 1 else None
+
+
 def get_relevant_chunks(query: str, k: int = 3, max_chars: int = 4000) -> str:
     """Retorna os melhores trechos formatados para o modelo, com limite de tamanho."""
     context, _ = get_relevant_chunks_with_meta(query, k=k, max_chars=max_chars)
@@ -637,11 +962,69 @@ def get_relevant_chunks_with_meta(
     max_chars: int = 4000,
     max_per_source: int = 2,
     mode: str = "qa",
+    query_emb: np.ndarray | None = None,
 ) -> tuple[str, list[dict]]:
     """Retorna contexto formatado e metadados para citacoes."""
+    matches = search_similar_documents(query, _candidate_count(k, mode), query_emb)
+    return _format_relevant_chunks(query, matches, max_chars=max_chars, max_per_source=max_per_source, mode=mode)
+
+
+def get_relevant_chunks_in_working_set(
+    query: str,
+    working_set: Dict,
+    k: int = 3,
+    max_chars: int = 4000,
+    max_per_source: int = 2,
+    mode: str = "qa",
+    query_emb: np.ndarray | None = None,
+) -> tuple[str, list[dict], bool]:
+    """
+    get_relevant_chunks_with_meta para perguntas de seguimento: `working_set` traz os
+    documentos ("sources") e paginas ("chunks": (source, page)) citados nos ultimos turnos do
+    chat, alem da ultima pergunta completa ("anchor"). Retorna tambem se o conjunto de trabalho bastou (False = caiu na busca global).
+    """
+    matches, in_working_set = _search_working_set(query, _candidate_count(k, mode), working_set, query_emb)
+    context, citations = _format_relevant_chunks(
+        query, matches, max_chars=max_chars, max_per_source=max_per_source, mode=mode
+    )
+    return context, citations, in_working_set
+
+
+def _candidate_count(k: int, mode: str) -> int:
     # Para "summary", buscamos mais candidatos para aumentar cobertura do documento.
-    candidates = max(k * 6, 12) if mode != "summary" else max(k * 10, 40)
-    matches = search_similar_documents(query, candidates)
+    return max(k * 6, 12) if mode != "summary" else max(k * 10, 40)
+
+
+def get_relevant_chunks_with_meta_batch(
+    requests: List[Dict], query_embs: np.ndarray | None = None
+) -> List[tuple[str, list[dict]]]:
+    """
+    get_relevant_chunks_with_meta para varias consultas com uma unica busca vetorizada.
+    Cada item de `requests` tem "query" e, opcionalmente, k/max_chars/max_per_source/mode;
+    `query_embs` traz os vetores ja calculados, na mesma ordem.
+    """
+    params = [
+        {
+            "max_chars": r.get("max_chars", 4000),
+            "max_per_source": r.get("max_per_source", 2),
+            "mode": r.get("mode", "qa"),
+        }
+        for r in requests
+    ]
+    queries = [r["query"] for r in requests]
+    ks = [_candidate_count(r.get("k", 3), p["mode"]) for r, p in zip(requests, params)]
+    all_matches = search_similar_documents_batch(queries, ks, query_embs)
+    return [_format_relevant_chunks(q, m, **p) for q, m, p in zip(queries, all_matches, params)]
+
+
+def _format_relevant_chunks(
+    query: str,
+    matches: List[Dict],
+    *,
+    max_chars: int,
+    max_per_source: int,
+    mode: str,
+) -> tuple[str, list[dict]]:
     matches = _rerank_matches(query, matches)
 
     if not matches:
@@ -655,7 +1038,8 @@ def get_relevant_chunks_with_meta(
             matches = _all_chunks_for_sources(preferred_sources)
             max_per_source = max(max_per_source, 50)
         else:
-            matches = [m for m in matches if m.get("source") in preferred_sources]
+            # Relabel: um trecho quase duplicado entre documentos e citado pelo documento pedido.
+            matches = [r for r in (_with_source_in(m, preferred_sources) for m in matches) if r is not None]
             # Quando um documento especifico foi identificado, permite mais trechos dele.
             max_per_source = max(max_per_source, 4)
 
@@ -699,11 +1083,15 @@ def get_relevant_chunks_with_meta(
     total_chars = 0
     citations: list[dict] = []
     seen = set()
+    seen_clusters: set[int] = set()
     per_source = defaultdict(int)
     for m in iter_selected():
         normalized = _normalize_text(m["text"])
         if normalized in seen:
             continue
+        cluster = m.get("cluster")
+        if cluster is not None and cluster in seen_clusters:
+            continue
         if per_source[m["source"]] >= max_per_source:
             continue
         header_parts = [f"Documento: {m['source']}", f"Pagina {m['page']}"]
@@ -722,6 +1110,8 @@ def get_relevant_chunks_with_meta(
         formatted.append(snippet)
         citations.append({"source": m["source"], "page": m["page"], "score": m["score"]})
         seen.add(normalized)
+        if cluster is not None:
+            seen_clusters.add(cluster)
         per_source[m["source"]] += 1
         if total_chars >= max_chars:
             break
@@ -1,6 +1,6 @@
 import csv
 import json
-import shutil
+import os
 from datetime import datetime
 from pathlib import Path
 from typing import Any, Dict
@@ -68,9 +68,10 @@ def ingest_finance_csv():
 
 
 def upload_finance_csv(temp_path: Path):
+    """Publica o CSV recebido (movido atomicamente, sem copia) e reprocessa a pivot."""
     dest = Path(settings.FINANCE_CSV_PATH)
     dest.parent.mkdir(parents=True, exist_ok=True)
-    shutil.copy(temp_path, dest)
+    os.replace(temp_path, dest)
     return ingest_finance_csv()
 
 
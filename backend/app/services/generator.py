@@ -1,22 +1,54 @@
+import asyncio
+import hashlib
+import json
 import re
+import time
+import unicodedata
 import uuid
+from collections import deque
+from collections.abc import AsyncIterator, Iterator
+from contextlib import contextmanager
+from concurrent.futures import ThreadPoolExecutor
 
-import requests
+import numpy as np
 from sqlalchemy.exc import OperationalError
 from sqlalchemy.orm import Session
 
 from app.core.athena_prompt import ATHENA_SYSTEM_PROMPT
 from app.core.config import settings
 from app.db.session import SessionLocal
-from app.models import FeedbackDirective, SystemConfig
-from app.services.embeddings import get_relevant_chunks_with_meta
+from app.models import PolicyFile, SystemConfig
+from app.services.embeddings import (
+    encode_queries,
+    encode_query,
+    find_summary_source,
+    get_index_version,
+    get_relevant_chunks_in_working_set,
+    get_relevant_chunks_with_meta,
+    get_relevant_chunks_with_meta_batch,
+)
+from app.services import llm_client, retrieval_memory
+from app.services.config_cache import cached, get_config_version
+from app.services.deadline import (
+    Deadline,
+    DeadlineExceededError,
+    estimate_output_tokens,
+    observe_generation,
+    record_cancelled_generation,
+    record_cancelled_in_queue,
+)
+from app.services.directives import select_directives, select_directives_batch
+from app.services.llm_scheduler import priority_for, scheduler
+from app.services.prompt_budget import count_static_tokens, count_tokens, fit_context, fit_history, history_budget
+from app.services.singleflight import SharedStream, SingleFlight, StreamSubscription
+from app.services.usage_ledger import record_llm_usage
 
 
 class ChatGenerationError(Exception):
     """Erro ao gerar resposta do modelo."""
 
 
-def load_system_config() -> dict:
+def _query_system_config() -> dict:
     db: Session = SessionLocal()
     try:
         cfg = db.query(SystemConfig).first()
@@ -32,37 +64,37 @@ def load_system_config() -> dict:
         db.close()
 
 
-def load_feedback_directives(limit: int | None = None) -> list[str]:
+def _query_document_summaries() -> dict[str, str]:
     db: Session = SessionLocal()
     try:
-        query = (
-            db.query(FeedbackDirective)
-            .filter(FeedbackDirective.status == "applied")
-            .order_by(FeedbackDirective.applied_at.desc())
+        rows = (
+            db.query(PolicyFile.filename, PolicyFile.summary)
+            .filter(PolicyFile.active.is_(True), PolicyFile.summary.isnot(None))
+            .all()
         )
-        if limit:
-            query = query.limit(limit)
-        return [row.text for row in query.all()]
+        return {filename: summary for filename, summary in rows}
     except OperationalError:
-        return []
+        return {}
     finally:
         db.close()
 
 
+def load_document_summaries() -> dict[str, str]:
+    """Resumos pre-calculados por arquivo (cache em memoria, invalidado quando um resumo e salvo)."""
+    return cached("document_summaries", _query_document_summaries)
+
+
+def load_system_config() -> dict:
+    """SystemConfig atual (cache em memoria, invalidado pelas rotas de admin)."""
+    return dict(cached("system_config", _query_system_config))
+
+
 def call_llm_api(messages: list[dict], *, temperature: float | None = None, top_p: float | None = None) -> dict:
     """Compat: chama o endpoint /v1/responses do LM Studio."""
     return call_llm_api_with_limits(messages, temperature=temperature, top_p=top_p, max_tokens=600)
 
 
-def call_llm_api_with_limits(
-    messages: list[dict],
-    *,
-    temperature: float | None = None,
-    top_p: float | None = None,
-    max_tokens: int = 600,
-) -> dict:
-    """Chama o endpoint /v1/responses do LM Studio, permitindo ajustar limites."""
-    cfg = load_system_config()
+def _resolve_model_name(cfg: dict) -> str:
     env_model = (settings.LMSTUDIO_MODEL or "").strip()
     db_model = (cfg.get("model_name") or "").strip()
     model_name = db_model or env_model
@@ -76,28 +108,29 @@ def call_llm_api_with_limits(
         and env_model.lower().startswith("qwen")
     ):
         model_name = env_model
+    return model_name
+
 
-    payload = {
-        "model": model_name,
+def _build_payload(
+    messages: list[dict],
+    *,
+    temperature: float | None,
+    top_p: float | None,
+    max_tokens: int,
+    stream: bool,
+) -> dict:
+    cfg = load_system_config()
+    return {
+        "model": _resolve_model_name(cfg),
         "input": messages,
         "temperature": temperature if temperature is not None else cfg.get("temperature", 0.25),
         "top_p": top_p if top_p is not None else cfg.get("top_p", 1.0),
         "max_tokens": max_tokens,
-        "stream": False,
+        "stream": stream,
     }
 
-    try:
-        response = requests.post(
-            settings.LMSTUDIO_API_URL,
-            json=payload,
-            headers={"Content-Type": "application/json"},
-            timeout=settings.LMSTUDIO_TIMEOUT_SECONDS,
-        )
-        response.raise_for_status()
-        data = response.json()
-    except Exception as exc:  # noqa: BLE001
-        raise ChatGenerationError(f"Falha ao chamar modelo: {exc}") from exc
 
+def _extract_output_text(data: dict) -> str:
     try:
         output_items = data.get("output") or []
         first_output = output_items[0] if output_items else {}
@@ -120,8 +153,293 @@ def call_llm_api_with_limits(
             raise ValueError("Conteudo vazio retornado pelo modelo")
     except Exception as exc:  # noqa: BLE001
         raise ChatGenerationError("Resposta invalida do modelo") from exc
+    return content
+
+
+def _usage_cached_tokens(usage: dict) -> int | None:
+    for key in ("input_tokens_details", "prompt_tokens_details"):
+        details = usage.get(key)
+        if isinstance(details, dict) and details.get("cached_tokens") is not None:
+            return int(details["cached_tokens"])
+    return None
+
+
+def _usage_from_response(data: dict | None, payload: dict) -> dict:
+    """Tokens da resposta do LM Studio (formato responses ou chat/completions) num formato so."""
+    data = data or {}
+    usage = data.get("usage") or {}
+    return {
+        "prompt_tokens": usage.get("input_tokens", usage.get("prompt_tokens")),
+        "completion_tokens": usage.get("output_tokens", usage.get("completion_tokens")),
+        "cached_tokens": _usage_cached_tokens(usage),
+        "model": data.get("model") or payload.get("model"),
+    }
+
+
+def _record_ledger(ledger: dict | None, usage: dict | None, latency_s: float, **extra) -> None:
+    """`ledger` = contexto da chamada (kind e, quando houver, chat_id, user_id, answer_mode)."""
+    if ledger is not None:
+        record_llm_usage(usage=usage, latency_s=latency_s, **ledger, **extra)
+
+
+def call_llm_api_with_limits(
+    messages: list[dict],
+    *,
+    temperature: float | None = None,
+    top_p: float | None = None,
+    max_tokens: int = 600,
+    ledger: dict | None = None,
+) -> dict:
+    """Chama o endpoint /v1/responses do LM Studio, permitindo ajustar limites."""
+    payload = _build_payload(messages, temperature=temperature, top_p=top_p, max_tokens=max_tokens, stream=False)
+
+    started = time.perf_counter()
+    try:
+        data = llm_client.post_json(payload)
+    except Exception as exc:  # noqa: BLE001
+        raise ChatGenerationError(f"Falha ao chamar modelo: {exc}") from exc
+
+    content = _extract_output_text(data)
+    usage = _usage_from_response(data, payload)
+    _record_ledger(ledger, usage, time.perf_counter() - started)
+    return {"id": str(uuid.uuid4()), "content": content, "usage": usage}
+
+
+async def acall_llm_api_with_limits(
+    messages: list[dict],
+    *,
+    temperature: float | None = None,
+    top_p: float | None = None,
+    max_tokens: int = 600,
+    deadline: Deadline | None = None,
+    ledger: dict | None = None,
+) -> dict:
+    """Versao assincrona de call_llm_api_with_limits (nao ocupa thread durante a geracao)."""
+    payload = _build_payload(messages, temperature=temperature, top_p=top_p, max_tokens=max_tokens, stream=False)
+
+    started = time.perf_counter()
+    try:
+        data = await llm_client.apost_json(payload, deadline=deadline)
+    except DeadlineExceededError:
+        raise
+    except Exception as exc:  # noqa: BLE001
+        raise ChatGenerationError(f"Falha ao chamar modelo: {exc}") from exc
+
+    content = _extract_output_text(data)
+    usage = _usage_from_response(data, payload)
+    _record_ledger(ledger, usage, time.perf_counter() - started)
+    return {"id": str(uuid.uuid4()), "content": content, "usage": usage}
+
+
+class _SSEDecoder:
+    """Acumula linhas SSE ("event:"/"data:") do LM Studio e devolve eventos JSON completos."""
+
+    def __init__(self):
+        self._data_lines: list[str] = []
+        self.finished = False
+
+    def feed(self, line: str | None) -> dict | None:
+        if line is None:
+            return None
+        if line == "":
+            return self.flush()
+        if line.startswith("data:"):
+            self._data_lines.append(line[5:].lstrip())
+        return None
+
+    def flush(self) -> dict | None:
+        if not self._data_lines:
+            return None
+        data = "\n".join(self._data_lines)
+        self._data_lines = []
+        if data.strip() == "[DONE]":
+            self.finished = True
+            return None
+        try:
+            return json.loads(data)
+        except ValueError:
+            return None
+
+
+def _iter_sse_events(lines: Iterator[str]) -> Iterator[dict]:
+    """Converte linhas SSE do LM Studio em eventos JSON."""
+    decoder = _SSEDecoder()
+    for line in lines:
+        event = decoder.feed(line)
+        if decoder.finished:
+            return
+        if event is not None:
+            yield event
+    event = decoder.flush()
+    if event is not None:
+        yield event
+
+
+class _StreamEvents:
+    """Interpretacao comum dos eventos do /v1/responses (streams sincrono e assincrono)."""
+
+    def __init__(self, payload: dict):
+        self.payload = payload
+        self.usage: dict | None = None
+        self.done = False
+
+    def _handle_event(self, event: dict) -> str | None:
+        """Devolve o delta de texto do evento (se houver); marca `done` ao concluir."""
+        kind = str(event.get("type") or "")
+        if kind.endswith("output_text.delta"):
+            delta = event.get("delta")
+            return str(delta) if delta else None
+        if kind in ("response.completed", "response.incomplete"):
+            self.usage = _usage_from_response(event.get("response") or event, self.payload)
+            self.done = True
+        elif kind in ("error", "response.failed"):
+            raise ChatGenerationError(f"Falha ao gerar resposta: {event.get('error') or event}")
+        return None
+
+
+class LLMStream(_StreamEvents):
+    """
+    Resposta em streaming do /v1/responses. A conexao e aberta em open() (erros de
+    conexao/HTTP viram ChatGenerationError antes do primeiro byte ao cliente); a iteracao
+    devolve os deltas de texto conforme o LM Studio os gera.
+    """
+
+    def __init__(self, payload: dict):
+        super().__init__(payload)
+        self._response = None
+
+    def open(self) -> "LLMStream":
+        try:
+            self._response = llm_client.open_stream(self.payload)
+        except Exception as exc:  # noqa: BLE001
+            self.close()
+            raise ChatGenerationError(f"Falha ao chamar modelo: {exc}") from exc
+        return self
+
+    def __iter__(self) -> Iterator[str]:
+        if self._response is None:
+            self.open()
+        try:
+            for event in _iter_sse_events(self._response.iter_lines()):
+                delta = self._handle_event(event)
+                if delta:
+                    yield delta
+                if self.done:
+                    break
+        except ChatGenerationError:
+            raise
+        except Exception as exc:  # noqa: BLE001
+            raise ChatGenerationError(f"Falha no streaming do modelo: {exc}") from exc
+        finally:
+            self.close()
+
+    def close(self) -> None:
+        if self._response is not None:
+            self._response.close()
+            self._response = None
+
+
+class AsyncLLMStream(_StreamEvents):
+    """Versao assincrona de LLMStream: le o SSE sem ocupar uma thread durante a geracao."""
 
-    return {"id": str(uuid.uuid4()), "content": content, "raw": data}
+    def __init__(self, payload: dict, deadline: Deadline | None = None):
+        super().__init__(payload)
+        self.deadline = deadline
+        self._response = None
+
+    async def open(self) -> "AsyncLLMStream":
+        try:
+            self._response = await llm_client.aopen_stream(self.payload, deadline=self.deadline)
+        except DeadlineExceededError:
+            await self.aclose()
+            raise
+        except Exception as exc:  # noqa: BLE001
+            await self.aclose()
+            raise ChatGenerationError(f"Falha ao chamar modelo: {exc}") from exc
+        return self
+
+    async def __aiter__(self) -> AsyncIterator[str]:
+        if self._response is None:
+            await self.open()
+        decoder = _SSEDecoder()
+        try:
+            async for line in self._response.aiter_lines():
+                event = decoder.feed(line)
+                if decoder.finished:
+                    break
+                if event is None:
+                    continue
+                delta = self._handle_event(event)
+                if delta:
+                    yield delta
+                if self.done:
+                    break
+        except ChatGenerationError:
+            raise
+        except Exception as exc:  # noqa: BLE001
+            if self.deadline is not None and self.deadline.expired:
+                raise DeadlineExceededError("llm") from exc
+            raise ChatGenerationError(f"Falha no streaming do modelo: {exc}") from exc
+        finally:
+            await self.aclose()
+
+    async def aclose(self) -> None:
+        if self._response is not None:
+            response, self._response = self._response, None
+            await response.aclose()
+
+
+class _PrecomputedStream:
+    """Mesma interface de LLMStream/AsyncLLMStream para uma resposta ja pronta (sem LLM)."""
+
+    def __init__(self, text: str):
+        self.text = text
+        self.usage: dict | None = None
+
+    def open(self) -> "_PrecomputedStream":
+        return self
+
+    def __iter__(self) -> Iterator[str]:
+        yield self.text
+
+    def close(self) -> None:
+        pass
+
+
+class _AsyncPrecomputedStream(_PrecomputedStream):
+    async def open(self) -> "_AsyncPrecomputedStream":
+        return self
+
+    async def __aiter__(self) -> AsyncIterator[str]:
+        yield self.text
+
+    async def aclose(self) -> None:
+        pass
+
+
+def stream_llm_api_with_limits(
+    messages: list[dict],
+    *,
+    temperature: float | None = None,
+    top_p: float | None = None,
+    max_tokens: int = 600,
+) -> LLMStream:
+    """Versao em streaming de call_llm_api_with_limits."""
+    payload = _build_payload(messages, temperature=temperature, top_p=top_p, max_tokens=max_tokens, stream=True)
+    return LLMStream(payload)
+
+
+def astream_llm_api_with_limits(
+    messages: list[dict],
+    *,
+    temperature: float | None = None,
+    top_p: float | None = None,
+    max_tokens: int = 600,
+    deadline: Deadline | None = None,
+) -> AsyncLLMStream:
+    """Versao assincrona de stream_llm_api_with_limits (abrir com `await stream.open()`)."""
+    payload = _build_payload(messages, temperature=temperature, top_p=top_p, max_tokens=max_tokens, stream=True)
+    return AsyncLLMStream(payload, deadline)
 
 
 _XYZ_RE = re.compile(r"\b(paginacao\s+xyz|paginação\s+xyz|xyz)\b", re.IGNORECASE)
@@ -162,49 +480,91 @@ REGRAS IMPORTANTES:
 """.strip()
 
 
-def _clean_response_text(text: str) -> str:
-    """
-    Remove ruídos comuns (placeholders como 'paginação XYZ') e reduz repetição de linhas.
-    Mantém a ordem original.
-    """
-    lines = [ln.rstrip() for ln in (text or "").splitlines()]
-    cleaned: list[str] = []
-    seen = set()
-
-    for ln in lines:
-        stripped = ln.strip()
-        if not stripped:
-            if cleaned and cleaned[-1] != "":
-                cleaned.append("")
-            continue
-        if _XYZ_RE.search(stripped):
-            continue
-        key = re.sub(r"\s+", " ", stripped.lower())
-        if key in seen:
-            continue
-        seen.add(key)
-        cleaned.append(stripped)
-
-    while cleaned and cleaned[-1] == "":
-        cleaned.pop()
-
-    return "\n".join(cleaned).strip()
+def _static_prompt_prefix(system_prompt: str, directives: list[str]) -> str:
+    """Parte do prompt de sistema que so muda quando o admin altera config/diretrizes."""
+    parts = [
+        system_prompt,
+        "\n\n--- FORMATO DE SAIDA (RESUMO) ---\n" + _SUMMARY_TEMPLATE,
+    ]
+    directives_block = "\n".join(f"- {text}" for text in directives if text.strip())
+    if directives_block:
+        parts.append("\n\n--- AJUSTES APROVADOS PELA ADMINISTRACAO ---\n" + directives_block)
+    return "".join(parts)
 
 
 _DOC_META_RE = re.compile(
     r"\b(sha256|clicksign|hash do documento|documento numero|documento n[úu]mero|assinaturas?:)\b",
     re.IGNORECASE,
 )
+# Quebras de linha reconhecidas por str.splitlines (a limpeza trabalha linha a linha).
+_LINE_BREAKS_RE = re.compile(r"\r\n|[\n\r\v\f\x1c\x1d\x1e\x85\u2028\u2029]")
 
 
-def _remove_document_metadata(answer: str) -> str:
-    lines = [ln.rstrip() for ln in (answer or "").splitlines()]
-    kept: list[str] = []
-    for ln in lines:
-        if _DOC_META_RE.search(ln):
-            continue
-        kept.append(ln)
-    return "\n".join(kept).strip()
+class AnswerCleaner:
+    """
+    Limpeza da resposta linha a linha, para rodar sobre o stream de tokens: remove
+    placeholders (ex.: 'paginação XYZ'), linhas repetidas e excesso de linhas em branco e,
+    com `strip_document_metadata`, linhas de hash/Clicksign/assinaturas. feed() devolve o
+    texto das linhas que acabaram de se completar; flush() fecha a ultima. A concatenacao
+    do que foi emitido e igual a limpar a resposta inteira de uma vez (clean()).
+    """
+
+    def __init__(self, strip_document_metadata: bool = False):
+        self.strip_document_metadata = strip_document_metadata
+        self._buffer = ""
+        self._seen: set[str] = set()
+        self._has_content = False  # ja houve linha valida (mesmo que removida como metadado)
+        self._last_blank = False
+        self._pending_blanks = 0
+        self._emitted: list[str] = []
+
+    @property
+    def text(self) -> str:
+        return "".join(self._emitted)
+
+    def feed(self, delta: str) -> str:
+        self._buffer += delta
+        out: list[str] = []
+        while True:
+            match = _LINE_BREAKS_RE.search(self._buffer)
+            # "\r" no fim pode ser a primeira metade de um "\r\n": espera o proximo pedaco.
+            if match is None or (match.group() == "\r" and match.end() == len(self._buffer)):
+                break
+            line, self._buffer = self._buffer[: match.start()], self._buffer[match.end() :]
+            out.append(self._line(line))
+        return "".join(out)
+
+    def flush(self) -> str:
+        line, self._buffer = self._buffer, ""
+        return self._line(line) if line else ""
+
+    def clean(self, text: str) -> str:
+        return self.feed(text or "") + self.flush()
+
+    def _line(self, line: str) -> str:
+        stripped = line.strip()
+        if not stripped:
+            if self._has_content and not self._last_blank:
+                self._last_blank = True
+                self._pending_blanks += 1
+            return ""
+        if _XYZ_RE.search(stripped):
+            return ""
+        key = re.sub(r"\s+", " ", stripped.lower())
+        if key in self._seen:
+            return ""
+        self._seen.add(key)
+        self._has_content = True
+        self._last_blank = False
+        # O metadado conta como linha de conteudo ao recolher brancos: as linhas em branco dos
+        # dois lados ficam, como quando ele era removido numa segunda passada.
+        if self.strip_document_metadata and _DOC_META_RE.search(stripped):
+            return ""
+        # Linhas em branco so saem antes de uma nova linha de conteudo (nada no inicio ou no fim).
+        chunk = "\n" * (self._pending_blanks + 1) + stripped if self._emitted else stripped
+        self._pending_blanks = 0
+        self._emitted.append(chunk)
+        return chunk
 
 
 def _append_sources(answer: str, citations: list[dict]) -> str:
@@ -246,41 +606,24 @@ def _dedupe_consecutive_messages(messages: list[dict]) -> list[dict]:
     return deduped
 
 
-def generate_answer_with_history(question: str, history: list[dict]) -> dict:
-    """Gera resposta usando historico do chat e contexto das politicas."""
-    lowered = question.lower()
-
-    def looks_like_small_talk(text: str) -> bool:
-        t = text.strip().lower()
-        if len(t) > 80:
-            return False
-        greetings = ("ola", "olá", "oi", "bom dia", "boa tarde", "boa noite", "tudo bem", "como voce esta", "como você está")
-        if any(g in t for g in greetings):
-            # se nao estiver pedindo politica/documento, tratamos como conversa geral
-            keywords = ("politica", "pol", "ctt", "documento", "arquivo", "pdf", "procedimento", "cartao", "cartão")
-            return not any(k in t for k in keywords)
+def _looks_like_small_talk(text: str) -> bool:
+    t = text.strip().lower()
+    if len(t) > 80:
         return False
+    greetings = ("ola", "olá", "oi", "bom dia", "boa tarde", "boa noite", "tudo bem", "como voce esta", "como você está")
+    if any(g in t for g in greetings):
+        # se nao estiver pedindo politica/documento, tratamos como conversa geral
+        keywords = ("politica", "pol", "ctt", "documento", "arquivo", "pdf", "procedimento", "cartao", "cartão")
+        return not any(k in t for k in keywords)
+    return False
 
-    is_summary_request = any(key in lowered for key in ("resumo", "resuma", "sintese", "sintetize"))
-
-    if looks_like_small_talk(question):
-        context, citations = "", []
-    elif is_summary_request:
-        # Resumo de documento precisa de mais cobertura do mesmo PDF.
-        context, citations = get_relevant_chunks_with_meta(
-            question,
-            k=10,
-            max_chars=6500,
-            max_per_source=12,
-            mode="summary",
-        )
-    else:
-        context, citations = get_relevant_chunks_with_meta(question)
 
-    cfg = load_system_config()
-    system_prompt = cfg.get("system_prompt") or ATHENA_SYSTEM_PROMPT
-    directives = load_feedback_directives(settings.FEEDBACK_DIRECTIVES_LIMIT)
-    if looks_like_small_talk(question):
+def _detect_answer_mode(question: str) -> tuple[str, bool, bool]:
+    """Retorna (modo de resposta, e conversa curta?, e pedido de resumo?)."""
+    lowered = question.lower()
+    small_talk = _looks_like_small_talk(question)
+    is_summary_request = any(key in lowered for key in ("resumo", "resuma", "sintese", "sintetize"))
+    if small_talk:
         answer_mode = "PADRAO"
     elif any(key in lowered for key in ("detalhe", "detalhar", "expandir", "aprofund", "explique mais")):
         answer_mode = "DETALHADO"
@@ -288,25 +631,177 @@ def generate_answer_with_history(question: str, history: list[dict]) -> dict:
         answer_mode = "RESUMO"
     else:
         answer_mode = "PADRAO"
+    return answer_mode, small_talk, is_summary_request
 
-    system_parts = [
-        f"MODO DE RESPOSTA: {answer_mode}\n",
-        system_prompt,
-        ("\n\n--- FORMATO DE SAIDA (RESUMO) ---\n" + _SUMMARY_TEMPLATE) if answer_mode == "RESUMO" else "",
-        "\n\n--- CONTEXTO DAS POLITICAS ---\n"
-        + (context or "Nenhum trecho relevante de politica foi encontrado para esta pergunta."),
+
+def _retrieve_with_directives(
+    question: str, chat_id: int | None = None
+) -> tuple[tuple[str, list[dict]], tuple[list[str], list[str]]]:
+    """
+    Etapa de recuperacao: codifica a pergunta uma unica vez e usa o mesmo vetor na busca e na
+    selecao das diretrizes relevantes. Retorna (contexto, (diretrizes globais, relevantes)).
+    """
+    _, small_talk, _ = _detect_answer_mode(question)
+    query_emb = None if small_talk else encode_query(question)
+    return _retrieve_context(question, chat_id, query_emb), select_directives(question, query_emb)
+
+
+def _retrieve_context(
+    question: str, chat_id: int | None = None, query_emb: np.ndarray | None = None
+) -> tuple[str, list[dict]]:
+    """
+    Busca no indice com o vetor `query_emb` da pergunta; depende da pergunta e, em perguntas de
+    seguimento, dos documentos que o chat vinha consultando (memoria de recuperacao).
+    """
+    _, small_talk, is_summary_request = _detect_answer_mode(question)
+    if small_talk:
+        return "", []
+    working_set = retrieval_memory.working_set_for(chat_id, question)
+    if is_summary_request:
+        retrieved = _document_summary_context(question, working_set, query_emb)
+        if not retrieved:
+            # Resumo de documento precisa de mais cobertura do mesmo PDF.
+            retrieved = _search_chunks(
+                question,
+                working_set,
+                query_emb,
+                k=10,
+                max_chars=6500,
+                max_per_source=12,
+                mode="summary",
+            )
+    else:
+        retrieved = _search_chunks(question, working_set, query_emb)
+    retrieval_memory.remember(chat_id, question, retrieved[1])
+    return retrieved
+
+
+def _search_chunks(
+    question: str, working_set: dict | None, query_emb: np.ndarray | None, **params
+) -> tuple[str, list[dict]]:
+    if working_set is None:
+        return get_relevant_chunks_with_meta(question, query_emb=query_emb, **params)
+    context, citations, in_working_set = get_relevant_chunks_in_working_set(
+        question, working_set, query_emb=query_emb, **params
+    )
+    retrieval_memory.record_working_set_result(in_working_set)
+    return context, citations
+
+
+def _document_summary_context(
+    question: str, working_set: dict | None = None, query_emb: np.ndarray | None = None
+) -> tuple[str, list[dict]] | None:
+    """Contexto compacto com o resumo pre-calculado do documento pedido (se existir)."""
+    summaries = load_document_summaries()
+    if not summaries:
+        return None
+    source = find_summary_source(question, query_emb)
+    if not source and working_set:
+        # "resuma isso": o documento e o que o chat vinha consultando.
+        source = working_set["sources"][0]
+    if not source or source not in summaries:
+        return None
+    context = f"[Documento: {source} | Resumo do documento inteiro] Trecho:\n{summaries[source]}"
+    return context, [{"source": source, "page": 1, "score": 1.0, "document_summary": True}]
+
+
+def _retrieve_context_batch(questions: list[str], query_embs: np.ndarray) -> list[tuple[str, list[dict]]]:
+    """_retrieve_context para varias perguntas com uma unica busca em lote (`query_embs`: encode_queries)."""
+    results: list[tuple[str, list[dict]]] = [("", [])] * len(questions)
+    requests: list[dict] = []
+    positions: list[int] = []
+    for position, question in enumerate(questions):
+        _, small_talk, is_summary_request = _detect_answer_mode(question)
+        if small_talk:
+            continue
+        if is_summary_request:
+            precomputed = _document_summary_context(question, query_emb=query_embs[position])
+            if precomputed:
+                results[position] = precomputed
+                continue
+            requests.append({"query": question, "k": 10, "max_chars": 6500, "max_per_source": 12, "mode": "summary"})
+        else:
+            requests.append({"query": question})
+        positions.append(position)
+    searched = get_relevant_chunks_with_meta_batch(requests, query_embs[positions] if positions else None)
+    for position, retrieved in zip(positions, searched):
+        results[position] = retrieved
+    return results
+
+
+def prepare_generation_batch(questions: list[str]) -> list[dict]:
+    """
+    _prepare_generation para perguntas avulsas (sem historico), recuperando todas de uma vez;
+    um unico encoding em lote serve a busca e a selecao das diretrizes.
+    """
+    query_embs = encode_queries(questions)
+    retrieved = _retrieve_context_batch(questions, query_embs)
+    cfg = load_system_config()
+    return [
+        _assemble_generation(q, [{"role": "user", "content": q}], None, r, (cfg, *directives))
+        for q, r, directives in zip(questions, retrieved, select_directives_batch(questions, query_embs))
     ]
-    if directives:
-        directives_block = "\n".join(f"- {text}" for text in directives if text.strip())
-        system_parts.append("\n\n--- AJUSTES APROVADOS PELA ADMINISTRACAO ---\n" + directives_block)
 
-    system_content = "".join(system_parts)
+
+def _prepare_generation(question: str, history: list[dict], summary: str | None = None) -> dict:
+    """
+    Recupera contexto e monta mensagens/parametros do LLM para a pergunta. `summary` e o
+    resumo persistido dos turnos antigos do chat (o historico traz so os recentes).
+    """
+    retrieved, directives = _retrieve_with_directives(question)
+    return _assemble_generation(question, history, summary, retrieved, (load_system_config(), *directives))
+
+
+def _assemble_generation(
+    question: str,
+    history: list[dict],
+    summary: str | None,
+    retrieved: tuple[str, list[dict]],
+    prompt_config: tuple[dict, list[str], list[str]],
+) -> dict:
+    """Monta mensagens/parametros a partir das etapas ja concluidas (sem I/O)."""
+    lowered = question.lower()
+    answer_mode, small_talk, is_summary_request = _detect_answer_mode(question)
+
+    # Orcamento do contexto recuperado (descarta os trechos menos relevantes se estourar).
+    context, citations, context_tokens = fit_context(*retrieved)
+
+    cfg, directives, relevant_directives = prompt_config
+    system_prompt = cfg.get("system_prompt") or ATHENA_SYSTEM_PROMPT
+
+    # Prefixo estavel (prompt do sistema, formato de resumo e diretrizes globais) primeiro, partes
+    # variaveis por pergunta (diretrizes relevantes, modo e contexto) no fim: o LM Studio
+    # reaproveita o KV-cache do prefixo.
+    static_prefix = _static_prompt_prefix(system_prompt, directives)
+    relevant_block = "\n".join(f"- {text}" for text in relevant_directives if text.strip())
+    volatile_part = (
+        (f"\n\n--- AJUSTES APROVADOS PARA ESTE TIPO DE PERGUNTA ---\n{relevant_block}" if relevant_block else "")
+        + f"\n\n--- MODO DE RESPOSTA: {answer_mode} ---"
+        + "\n\n--- CONTEXTO DAS POLITICAS ---\n"
+        + (context or "Nenhum trecho relevante de politica foi encontrado para esta pergunta.")
+    )
+    # Resumo do chat logo apos o prefixo: muda so quando o resumo e atualizado.
+    summary_part = f"\n\n--- RESUMO DA CONVERSA ATE AQUI ---\n{summary.strip()}" if (summary or "").strip() else ""
+    system_content = static_prefix + summary_part + volatile_part
+
+    if small_talk:
+        temp = 0.4
+        top_p = 1.0
+        max_tokens = 220
+    elif is_summary_request:
+        temp = min(cfg.get("temperature", 0.25), 0.15)
+        top_p = min(cfg.get("top_p", 1.0), 0.9)
+        max_tokens = 750
+    else:
+        temp = cfg.get("temperature", 0.25)
+        top_p = cfg.get("top_p", 1.0)
+        max_tokens = 900 if answer_mode == "DETALHADO" else 650
 
     history_for_llm = history
     if answer_mode == "RESUMO":
         # Resumo deve focar no documento, então reduzimos influência de respostas anteriores.
         history_for_llm = [m for m in history if m.get("role") == "user"][-4:]
-    elif looks_like_small_talk(question):
+    elif small_talk:
         history_for_llm = [m for m in history if m.get("role") == "user"][-2:]
     else:
         history_for_llm = history[-20:]
@@ -316,25 +811,598 @@ def generate_answer_with_history(question: str, history: list[dict]) -> dict:
         # Mantém só as 2 últimas perguntas únicas para evitar prompt gigante.
         history_for_llm = history_for_llm[-2:]
 
+    # Historico por orcamento de tokens: o que sobra depois do sistema e da resposta,
+    # removendo da mensagem mais antiga para a mais nova.
+    system_tokens = count_static_tokens(static_prefix) + count_tokens(summary_part + volatile_part)
+    history_for_llm, history_tokens, dropped = fit_history(
+        history_for_llm, history_budget(system_tokens, max_tokens)
+    )
+    token_budget = {
+        "system": system_tokens,
+        "context": context_tokens,
+        "history": history_tokens,
+        "history_dropped": dropped,
+        "completion": max_tokens,
+        "total": system_tokens + history_tokens + max_tokens,
+    }
+    print(
+        f"[prompt-budget] mode={answer_mode} system={system_tokens} (contexto {context_tokens}) "
+        f"history={history_tokens} (-{dropped} msgs) completion={max_tokens} total={token_budget['total']}"
+    )
+
     messages = [{"role": "system", "content": system_content}] + history_for_llm
 
-    if looks_like_small_talk(question):
-        temp = 0.4
-        top_p = 1.0
-        max_tokens = 220
-    elif is_summary_request:
-        temp = min(cfg.get("temperature", 0.25), 0.15)
-        top_p = min(cfg.get("top_p", 1.0), 0.9)
-        max_tokens = 750
+    # Pedido de resumo de um documento com resumo pre-calculado: responde sem chamar o LLM.
+    direct_answer = None
+    if settings.DOC_SUMMARY_SERVE_DIRECT and answer_mode == "RESUMO" and citations and citations[0].get("document_summary"):
+        direct_answer = load_document_summaries().get(citations[0]["source"])
+
+    return {
+        "messages": messages,
+        "temperature": temp,
+        "top_p": top_p,
+        "max_tokens": max_tokens,
+        "citations": citations,
+        "answer_mode": answer_mode,
+        "small_talk": small_talk,
+        "direct_answer": direct_answer,
+        "token_budget": token_budget,
+        "prefix_hash": hashlib.sha1(static_prefix.encode("utf-8")).hexdigest()[:12],
+        "strip_document_metadata": answer_mode == "RESUMO"
+        and not any(k in lowered for k in ("hash", "sha256", "assinatura", "clicksign")),
+    }
+
+
+def _finalize_answer(prepared: dict, content: str) -> str:
+    cleaned = AnswerCleaner(prepared["strip_document_metadata"]).clean(content)
+    return _append_sources(cleaned, prepared["citations"])
+
+
+def _direct_result(prepared: dict) -> dict:
+    """Resultado no formato de call_llm_api_with_limits para um resumo pre-calculado."""
+    return {"id": str(uuid.uuid4()), "content": prepared["direct_answer"], "usage": None}
+
+
+def generate_answer_with_history(question: str, history: list[dict], summary: str | None = None) -> dict:
+    """Gera resposta usando historico do chat e contexto das politicas."""
+    prepared = _prepare_generation(question, history, summary)
+    if prepared["direct_answer"]:
+        result = _direct_result(prepared)
     else:
-        temp = cfg.get("temperature", 0.25)
-        top_p = cfg.get("top_p", 1.0)
-        max_tokens = 900 if answer_mode == "DETALHADO" else 650
+        result = call_llm_api_with_limits(
+            prepared["messages"],
+            temperature=prepared["temperature"],
+            top_p=prepared["top_p"],
+            max_tokens=prepared["max_tokens"],
+            ledger=_ledger_context(prepared, "answer"),
+        )
+    result["content"] = _finalize_answer(prepared, result["content"])
+    result["sources"] = prepared["citations"]
+    return result
+
+
+class StreamedAnswer:
+    """
+    Resposta gerada token a token. `sources` fica disponivel antes da geracao;
+    ao esgotar a iteracao, `content` traz a resposta final (limpa + fontes), igual a
+    generate_answer_with_history, pronta para ser persistida.
+    """
+
+    def __init__(self, prepared: dict):
+        self.id = str(uuid.uuid4())
+        self.prepared = prepared
+        self.sources: list[dict] = prepared["citations"]
+        self.content: str | None = None
+        self.usage: dict | None = None
+        self._started = 0.0
+        if prepared["direct_answer"]:
+            self._stream = _PrecomputedStream(prepared["direct_answer"])
+        else:
+            self._stream = stream_llm_api_with_limits(
+                prepared["messages"],
+                temperature=prepared["temperature"],
+                top_p=prepared["top_p"],
+                max_tokens=prepared["max_tokens"],
+            )
+
+    def open(self) -> "StreamedAnswer":
+        self._started = time.perf_counter()
+        self._stream.open()
+        return self
+
+    def sources_block(self) -> str:
+        return _append_sources("", self.sources)
+
+    def __iter__(self) -> Iterator[str]:
+        # Os deltas saem ja limpos, linha a linha; `content` e o mesmo texto + fontes.
+        parts: list[str] = []
+        cleaner = AnswerCleaner(self.prepared["strip_document_metadata"])
+        for delta in self._stream:
+            parts.append(delta)
+            cleaned = cleaner.feed(delta)
+            if cleaned:
+                yield cleaned
+        tail = cleaner.flush()
+        if tail:
+            yield tail
+        if not "".join(parts).strip():
+            raise ChatGenerationError("Resposta invalida do modelo")
+        self.usage = self._stream.usage
+        self.content = _append_sources(cleaner.text, self.sources)
+        if not self.prepared["direct_answer"]:
+            _record_ledger(
+                _ledger_context(self.prepared, "answer_stream"), self.usage, time.perf_counter() - self._started
+            )
+
+    def close(self) -> None:
+        self._stream.close()
+
+
+def stream_answer_with_history(question: str, history: list[dict], summary: str | None = None) -> StreamedAnswer:
+    """Como generate_answer_with_history, mas consumindo o LM Studio em streaming."""
+    return StreamedAnswer(_prepare_generation(question, history, summary))
+
+
+# Recuperacao/encoding (CPU e SQLite) roda num executor proprio, fora do threadpool do
+# Starlette; as geracoes passam pelo escalonador (llm_scheduler), independente do resto da API.
+_retrieval_executor = ThreadPoolExecutor(
+    max_workers=max(settings.RETRIEVAL_WORKERS, 1),
+    thread_name_prefix="athena-retrieval",
+)
+
+
+_pipeline_samples: deque[dict] = deque(maxlen=200)
+_PIPELINE_STAGES = ("history", "retrieval", "config", "assemble", "pre_llm")
+
+
+class AskPipeline:
+    """
+    Etapas independentes de uma pergunta rodando em paralelo: a recuperacao (CPU, executor
+    dedicado; inclui as diretrizes relevantes, com o mesmo vetor da pergunta) comeca assim que a
+    pergunta chega, junto com a leitura de config (threadpool), enquanto a rota grava a pergunta e carrega o historico. O tempo antes do
+    LLM fica perto da etapa mais lenta, e `timings` guarda a duracao de cada uma (ms).
+    Com `defer=True` (a mesma pergunta ja esta sendo gerada) as etapas so comecam em prepare():
+    quem entra na geracao em andamento nunca chega a fazer a recuperacao.
+    """
+
+    def __init__(
+        self,
+        question: str,
+        deadline: Deadline | None = None,
+        chat_id: int | None = None,
+        user_id: int | None = None,
+        defer: bool = False,
+    ):
+        self.question = question
+        self.deadline = deadline
+        self.chat_id = chat_id
+        self.user_id = user_id
+        self.timings: dict[str, float] = {}
+        self._created = time.perf_counter()
+        self._retrieval: asyncio.Future | None = None
+        self._config: asyncio.Future | None = None
+        if not defer:
+            self._start()
+
+    @property
+    def started(self) -> bool:
+        return self._retrieval is not None
+
+    def _start(self) -> None:
+        loop = asyncio.get_running_loop()
+        self._retrieval = loop.run_in_executor(
+            _retrieval_executor, self._timed, "retrieval", _retrieve_with_directives, self.question, self.chat_id
+        )
+        self._config = loop.run_in_executor(None, self._timed, "config", load_system_config)
+        for future in (self._retrieval, self._config):
+            # Se a rota falhar antes de usar o resultado, o erro nao fica "never retrieved".
+            future.add_done_callback(lambda f: f.cancelled() or f.exception())
 
-    result = call_llm_api_with_limits(messages, temperature=temp, top_p=top_p, max_tokens=max_tokens)
-    cleaned = _clean_response_text(result["content"])
-    if answer_mode == "RESUMO" and not any(k in lowered for k in ("hash", "sha256", "assinatura", "clicksign")):
-        cleaned = _remove_document_metadata(cleaned)
-    result["content"] = _append_sources(cleaned, citations)
-    result["sources"] = citations
+    def _timed(self, name: str, fn, *args):
+        started = time.perf_counter()
+        try:
+            return fn(*args)
+        finally:
+            self.timings[name] = round((time.perf_counter() - started) * 1000, 1)
+
+    @contextmanager
+    def stage(self, name: str):
+        """Mede uma etapa executada pela rota (ex.: gravar a pergunta e ler o historico)."""
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.timings[name] = round((time.perf_counter() - started) * 1000, 1)
+
+    async def prepare(self, history: list[dict], summary: str | None) -> dict:
+        if not self.started:
+            self._start()
+        stages = asyncio.gather(self._retrieval, self._config)
+        if self.deadline is not None:
+            (retrieved, directives), cfg = await self.deadline.wait(stages, "retrieval")
+        else:
+            (retrieved, directives), cfg = await stages
+        started = time.perf_counter()
+        prepared = _assemble_generation(self.question, history, summary, retrieved, (cfg, *directives))
+        now = time.perf_counter()
+        self.timings["assemble"] = round((now - started) * 1000, 1)
+        self.timings["pre_llm"] = round((now - self._created) * 1000, 1)
+        prepared["timings"] = dict(self.timings)
+        prepared["chat_id"] = self.chat_id
+        prepared["user_id"] = self.user_id
+        _pipeline_samples.append(prepared["timings"])
+        print("[ask-pipeline] " + " ".join(f"{k}={v}ms" for k, v in prepared["timings"].items()))
+        return prepared
+
+
+def start_ask_pipeline(
+    question: str,
+    deadline: Deadline | None = None,
+    chat_id: int | None = None,
+    user_id: int | None = None,
+) -> AskPipeline:
+    """
+    Dispara recuperacao e leitura de config para a pergunta (chamar dentro do event loop).
+    Com `chat_id`, perguntas de seguimento buscam primeiro nos documentos recentes do chat;
+    `chat_id`/`user_id` tambem identificam a chamada no ledger de uso. Se a mesma pergunta ja
+    esta sendo gerada, a recuperacao fica para quando (e se) ela for de fato necessaria.
+    """
+    global _retrievals_deferred
+    defer = _flight_in_progress(question)
+    if defer:
+        _retrievals_deferred += 1
+    return AskPipeline(question, deadline, chat_id, user_id, defer)
+
+
+async def aprepare_generation(
+    question: str,
+    history: list[dict],
+    summary: str | None = None,
+    pipeline: AskPipeline | None = None,
+    deadline: Deadline | None = None,
+) -> dict:
+    """_prepare_generation sem bloquear o event loop, com as etapas independentes em paralelo."""
+    if pipeline is None or pipeline.question != question:
+        pipeline = start_ask_pipeline(question, deadline)
+    return await pipeline.prepare(history, summary)
+
+
+async def aprepare_generation_batch(questions: list[str]) -> list[dict]:
+    """prepare_generation_batch no executor de recuperacao."""
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(_retrieval_executor, prepare_generation_batch, questions)
+
+
+def get_pipeline_metrics() -> dict:
+    """p50/p95 (ms) de cada etapa nas ultimas perguntas."""
+    stages = {}
+    for name in _PIPELINE_STAGES:
+        values = sorted(s[name] for s in _pipeline_samples if name in s)
+        if values:
+            stages[name] = {
+                "p50": values[len(values) // 2],
+                "p95": values[min(int(len(values) * 0.95), len(values) - 1)],
+            }
+    return {"samples": len(_pipeline_samples), "stages_ms": stages}
+
+
+# Modo de medicao (PROMPT_METRICS_ENABLED): latencia, tempo ate o primeiro token (~prefill)
+# e tokens de prompt servidos do cache do backend, para acompanhar o reaproveitamento do prefixo.
+_prompt_samples: deque[dict] = deque(maxlen=200)
+
+
+def _record_prompt_metrics(prepared: dict, usage: dict | None, *, latency_s: float, ttft_s: float | None = None) -> None:
+    if not settings.PROMPT_METRICS_ENABLED:
+        return
+    usage = usage or {}
+    input_tokens = usage.get("prompt_tokens")
+    cached_tokens = usage.get("cached_tokens")
+    sample = {
+        "prefix_hash": prepared.get("prefix_hash"),
+        "answer_mode": prepared.get("answer_mode"),
+        "latency_ms": round(latency_s * 1000, 1),
+        "ttft_ms": round(ttft_s * 1000, 1) if ttft_s is not None else None,
+        "input_tokens": input_tokens,
+        "cached_tokens": cached_tokens,
+    }
+    _prompt_samples.append(sample)
+    ttft = f"{sample['ttft_ms']}ms" if sample["ttft_ms"] is not None else "-"
+    print(
+        f"[prompt] prefix={sample['prefix_hash']} mode={sample['answer_mode']} "
+        f"ttft={ttft} total={sample['latency_ms']}ms cached={cached_tokens}/{input_tokens}"
+    )
+
+
+def get_prompt_metrics() -> dict:
+    samples = list(_prompt_samples)
+    ttfts = [x["ttft_ms"] for x in samples if x["ttft_ms"] is not None]
+    with_usage = [x for x in samples if x["input_tokens"] and x["cached_tokens"] is not None]
+    input_total = sum(x["input_tokens"] for x in with_usage)
+    return {
+        "enabled": settings.PROMPT_METRICS_ENABLED,
+        "samples": len(samples),
+        "ttft_ms_avg": round(sum(ttfts) / len(ttfts), 1) if ttfts else None,
+        "latency_ms_avg": round(sum(x["latency_ms"] for x in samples) / len(samples), 1) if samples else None,
+        "cached_token_ratio": round(sum(x["cached_tokens"] for x in with_usage) / input_total, 3) if input_total else None,
+        "recent": samples[-20:],
+    }
+
+
+# Perguntas identicas em voo ao mesmo tempo (ex.: periodo de matricula) compartilham uma
+# unica recuperacao + geracao. So vale sem contexto de conversa (/ask e chats novos).
+_answer_flights = SingleFlight()
+_stream_flights: dict[tuple, SharedStream] = {}
+_streams_coalesced = 0
+_retrievals_deferred = 0
+
+
+def _normalize_question(question: str) -> str:
+    folded = unicodedata.normalize("NFKD", question).encode("ascii", "ignore").decode("ascii")
+    return re.sub(r"\s+", " ", folded.casefold()).strip(" ?!.")
+
+
+def _flight_key(question: str) -> tuple:
+    answer_mode, _, _ = _detect_answer_mode(question)
+    return (_normalize_question(question), answer_mode, get_index_version(), get_config_version())
+
+
+def _coalesce_key(question: str, history: list[dict], summary: str | None) -> tuple | None:
+    if not settings.SINGLEFLIGHT_ENABLED or (summary or "").strip():
+        return None
+    if any(m.get("content") != question for m in history):
+        return None
+    return _flight_key(question)
+
+
+def _flight_in_progress(question: str) -> bool:
+    """Ha uma geracao compartilhavel da mesma pergunta em andamento (resposta ou stream)."""
+    if not settings.SINGLEFLIGHT_ENABLED:
+        return False
+    key = _flight_key(question)
+    shared = _stream_flights.get(key)
+    return _answer_flights.has(key) or (shared is not None and not shared.done)
+
+
+def _remember_joined(pipeline: AskPipeline | None, sources: list[dict]) -> None:
+    # Quem entrou numa geracao em andamento nao fez a recuperacao: a memoria do chat usa as fontes dela.
+    if pipeline is not None and not pipeline.started:
+        retrieval_memory.remember(pipeline.chat_id, pipeline.question, sources)
+
+
+def get_singleflight_stats() -> dict:
+    return {
+        "enabled": settings.SINGLEFLIGHT_ENABLED,
+        "answers_started": _answer_flights.started,
+        "answers_coalesced": _answer_flights.coalesced,
+        "answers_in_flight": _answer_flights.in_flight,
+        "answers_abandoned": _answer_flights.abandoned,
+        "streams_in_flight": len(_stream_flights),
+        "streams_coalesced": _streams_coalesced,
+        "retrievals_deferred": _retrievals_deferred,
+    }
+
+
+async def agenerate_answer_with_history(
+    question: str,
+    history: list[dict],
+    *,
+    summary: str | None = None,
+    user_key: str = "anon",
+    pipeline: AskPipeline | None = None,
+    deadline: Deadline | None = None,
+) -> dict:
+    """
+    Versao assincrona de generate_answer_with_history. A chamada ao LLM aguarda vaga no
+    escalonador (pode levantar LLMQueueFullError quando a fila esta cheia). Perguntas
+    identicas concorrentes sem historico sao atendidas por uma unica geracao. `pipeline`
+    (start_ask_pipeline) reaproveita a recuperacao ja iniciada pela rota; `deadline` limita
+    recuperacao, fila e chamada ao LLM (DeadlineExceededError).
+    """
+    key = _coalesce_key(question, history, summary)
+    if key is None:
+        return await _agenerate_answer(question, history, summary, user_key, pipeline, deadline)
+    shared = await _answer_flights.do(
+        key, lambda: _agenerate_answer(question, history, summary, user_key, pipeline, deadline)
+    )
+    _remember_joined(pipeline, shared.get("sources") or [])
+    # Cada interessado recebe sua propria copia (e id), o conteudo e o mesmo.
+    return {**shared, "id": str(uuid.uuid4())}
+
+
+async def _agenerate_answer(
+    question: str,
+    history: list[dict],
+    summary: str | None,
+    user_key: str,
+    pipeline: AskPipeline | None = None,
+    deadline: Deadline | None = None,
+) -> dict:
+    prepared = await aprepare_generation(question, history, summary, pipeline, deadline)
+    if prepared["direct_answer"]:
+        result = _direct_result(prepared)
+        result["content"] = _finalize_answer(prepared, result["content"])
+        result["sources"] = prepared["citations"]
+        return result
+    admitted_at = await _acquire_generation_slot(prepared, user_key, deadline)
+    started = time.perf_counter()
+    try:
+        result = await acall_llm_api_with_limits(
+            prepared["messages"],
+            temperature=prepared["temperature"],
+            top_p=prepared["top_p"],
+            max_tokens=prepared["max_tokens"],
+            deadline=deadline,
+            ledger=_ledger_context(prepared, "answer"),
+        )
+    except (asyncio.CancelledError, DeadlineExceededError):
+        # Cliente saiu ou prazo acabou: o httpx fecha a conexao e o LM Studio para de gerar.
+        elapsed = time.perf_counter() - started
+        _record_cancelled(prepared, "answer", estimate_output_tokens(elapsed, prepared["max_tokens"]), elapsed)
+        raise
+    finally:
+        scheduler.release(admitted_at)
+    latency_s = time.perf_counter() - started
+    observe_generation(result["usage"]["completion_tokens"], latency_s)
+    _record_prompt_metrics(prepared, result["usage"], latency_s=latency_s)
+    result["content"] = _finalize_answer(prepared, result["content"])
+    result["sources"] = prepared["citations"]
     return result
+
+
+def _prompt_tokens(prepared: dict) -> int:
+    budget = prepared.get("token_budget") or {}
+    return int(budget.get("system", 0)) + int(budget.get("history", 0))
+
+
+def _ledger_context(prepared: dict, kind: str) -> dict:
+    return {
+        "kind": kind,
+        "answer_mode": prepared.get("answer_mode"),
+        "chat_id": prepared.get("chat_id"),
+        "user_id": prepared.get("user_id"),
+    }
+
+
+def _record_cancelled(prepared: dict, kind: str, output_tokens: int, elapsed_s: float) -> None:
+    """Geracao interrompida: o LM Studio nao devolve usage, entao o ledger recebe a estimativa."""
+    prompt_tokens = _prompt_tokens(prepared)
+    record_cancelled_generation(prompt_tokens, output_tokens)
+    usage = {
+        "prompt_tokens": prompt_tokens,
+        "completion_tokens": output_tokens,
+        "cached_tokens": None,
+        "model": _resolve_model_name(load_system_config()),
+    }
+    _record_ledger(_ledger_context(prepared, kind), usage, elapsed_s, status="cancelled")
+
+
+async def _acquire_generation_slot(prepared: dict, user_key: str, deadline: Deadline | None) -> float:
+    """Vaga no escalonador, esperando no maximo ate o prazo da requisicao."""
+    acquire = scheduler.acquire(user_key, priority_for(prepared))
+    try:
+        if deadline is None:
+            return await acquire
+        return await deadline.wait(acquire, "fila")
+    except (asyncio.CancelledError, DeadlineExceededError):
+        record_cancelled_in_queue()
+        raise
+
+
+class AsyncStreamedAnswer:
+    """
+    Como StreamedAnswer, mas assincrona. Ocupa uma vaga do escalonador de open() ate aclose().
+    """
+
+    def __init__(self, prepared: dict, user_key: str = "anon", deadline: Deadline | None = None):
+        self.id = str(uuid.uuid4())
+        self.prepared = prepared
+        self.sources: list[dict] = prepared["citations"]
+        self.content: str | None = None
+        self.usage: dict | None = None
+        self.user_key = user_key
+        self.deadline = deadline
+        self._admitted_at: float | None = None
+        self._started = 0.0
+        if prepared["direct_answer"]:
+            self._stream = _AsyncPrecomputedStream(prepared["direct_answer"])
+        else:
+            self._stream = astream_llm_api_with_limits(
+                prepared["messages"],
+                temperature=prepared["temperature"],
+                top_p=prepared["top_p"],
+                max_tokens=prepared["max_tokens"],
+                deadline=deadline,
+            )
+
+    async def open(self) -> "AsyncStreamedAnswer":
+        if not self.prepared["direct_answer"]:
+            self._admitted_at = await _acquire_generation_slot(self.prepared, self.user_key, self.deadline)
+        self._started = time.perf_counter()
+        try:
+            await self._stream.open()
+        except BaseException:
+            await self.aclose()
+            raise
+        return self
+
+    def sources_block(self) -> str:
+        return _append_sources("", self.sources)
+
+    async def __aiter__(self) -> AsyncIterator[str]:
+        parts: list[str] = []
+        cleaner = AnswerCleaner(self.prepared["strip_document_metadata"])
+        ttft_s: float | None = None
+        try:
+            async for delta in self._stream:
+                if ttft_s is None:
+                    ttft_s = time.perf_counter() - self._started
+                parts.append(delta)
+                cleaned = cleaner.feed(delta)
+                if cleaned:
+                    yield cleaned
+        except (asyncio.CancelledError, DeadlineExceededError):
+            if not self.prepared["direct_answer"]:
+                _record_cancelled(
+                    self.prepared, "answer_stream", count_tokens("".join(parts)), time.perf_counter() - self._started
+                )
+            raise
+        tail = cleaner.flush()
+        if tail:
+            yield tail
+        if not "".join(parts).strip():
+            raise ChatGenerationError("Resposta invalida do modelo")
+        self.usage = self._stream.usage
+        self.content = _append_sources(cleaner.text, self.sources)
+        if not self.prepared["direct_answer"]:
+            latency_s = time.perf_counter() - self._started
+            observe_generation((self.usage or {}).get("completion_tokens"), latency_s)
+            _record_prompt_metrics(self.prepared, self.usage, latency_s=latency_s, ttft_s=ttft_s)
+            _record_ledger(
+                _ledger_context(self.prepared, "answer_stream"), self.usage, latency_s, ttft_s=ttft_s
+            )
+
+    async def aclose(self) -> None:
+        await self._stream.aclose()
+        if self._admitted_at is not None:
+            admitted_at, self._admitted_at = self._admitted_at, None
+            scheduler.release(admitted_at)
+
+
+async def astream_answer_with_history(
+    question: str,
+    history: list[dict],
+    *,
+    summary: str | None = None,
+    user_key: str = "anon",
+    pipeline: AskPipeline | None = None,
+    deadline: Deadline | None = None,
+) -> AsyncStreamedAnswer | StreamSubscription:
+    """
+    Versao assincrona de stream_answer_with_history (recuperacao no executor dedicado).
+    Perguntas identicas concorrentes sem historico assinam o mesmo stream; abrir com `open()`.
+    Num stream compartilhado vale o prazo de quem o iniciou.
+    """
+    global _streams_coalesced
+    key = _coalesce_key(question, history, summary)
+    if key is None:
+        prepared = await aprepare_generation(question, history, summary, pipeline, deadline)
+        return AsyncStreamedAnswer(prepared, user_key, deadline)
+
+    shared = _stream_flights.get(key)
+    if shared is None or shared.done:
+
+        async def opener() -> AsyncStreamedAnswer:
+            prepared = await aprepare_generation(question, history, summary, pipeline, deadline)
+            answer = AsyncStreamedAnswer(prepared, user_key, deadline)
+            return await answer.open()
+
+        def on_finish(finished: SharedStream, key: tuple = key) -> None:
+            if _stream_flights.get(key) is finished:
+                del _stream_flights[key]
+
+        shared = SharedStream(opener, on_finish)
+        _stream_flights[key] = shared
+    else:
+        _streams_coalesced += 1
+        shared.add_open_callback(lambda answer, pipeline=pipeline: _remember_joined(pipeline, answer.sources))
+    return shared.subscribe()
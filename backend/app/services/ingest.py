@@ -2,18 +2,19 @@ import os
 import hashlib
 import json
 from pathlib import Path
-from typing import List, Dict
+from typing import Dict, Iterable, List
 
 from sqlalchemy.orm import Session
 
 from app.core.config import settings
 from app.db.session import get_session
 from app.models import PolicyFile
+from app.services.config_cache import invalidate_config_cache
 from app.services.embeddings import (
     build_semantic_metadata,
     load_embeddings,
     remove_embeddings_for_source,
-    store_embeddings,
+    replace_source_embeddings,
 )
 from app.services.parser import extract_text_from_file
 
@@ -21,7 +22,7 @@ from app.services.parser import extract_text_from_file
 BASE_DIR = Path(__file__).resolve().parent.parent.parent
 POLICY_DIR = BASE_DIR / settings.POLICY_DIR
 META_FILE = BASE_DIR / "data/embeddings_meta.json"
-EMBEDDINGS_SCHEMA_VERSION = 2
+EMBEDDINGS_SCHEMA_VERSION = 3
 
 
 # -----------------------------------------------------------------------------
@@ -78,94 +79,185 @@ def split_into_chunks_with_metadata(
 # PROCESSAMENTO PRINCIPAL (incremental)
 # -----------------------------------------------------------------------------
 def ingest_all_policies():
-    """Processa PDFs/DOCX/TXT com metadados e atualiza o banco de forma incremental."""
+    """
+    Processa PDFs/DOCX/TXT com metadados e atualiza o banco de forma incremental.
+    Cada arquivo e uma unidade com checkpoint proprio: se o processo cair no meio,
+    a proxima execucao retoma a partir do primeiro arquivo nao concluido.
+    """
     print("[ingest] Iniciando processamento das políticas...")
 
     POLICY_DIR.mkdir(exist_ok=True, parents=True)
     load_embeddings()
 
-    meta_version, meta = _load_meta()
-    if meta_version != EMBEDDINGS_SCHEMA_VERSION:
-        # Força reprocessamento quando o pipeline de embeddings muda.
-        meta = {}
-    updated_meta: dict[str, str] = {}
+    meta = _load_current_meta()
 
     db: Session = next(get_session())
     processed_files = 0
 
-    current_files = [f for f in os.listdir(POLICY_DIR) if not f.startswith(".")]
+    current_files = sorted(f for f in os.listdir(POLICY_DIR) if not f.startswith("."))
 
-    for filename in current_files:
-        file_path = POLICY_DIR / filename
-        file_hash = _file_hash(file_path)
-        updated_meta[filename] = file_hash
+    try:
+        for filename in current_files:
+            if _ingest_file(db, filename, meta):
+                processed_files += 1
 
-        print(f"[ingest] Verificando: {filename}")
+        # Remover embeddings de arquivos que foram apagados
+        removed_files = set(meta.keys()) - set(current_files)
+        for fname in sorted(removed_files):
+            print(f"[ingest] Removendo embeddings de arquivo ausente: {fname}")
+            remove_embeddings_for_source(fname)
+            meta.pop(fname, None)
+        _save_meta(meta)
+    finally:
+        db.close()
 
-        policy = (
-            db.query(PolicyFile)
-            .filter(PolicyFile.filename == filename)
-            .first()
-        )
+    print(f"[ingest] Processo de ingestão concluído! {processed_files} arquivos processados.")
 
-        if not policy:
-            print(f"[ingest] AVISO: {filename} não está registrado no banco. Ignorando.")
-            continue
 
-        # Skip se hash não mudou e status está ok
-        if meta.get(filename) == file_hash and policy.embedding_status == "completed":
-            print(f"[ingest] {filename} sem mudanças. Pulando reprocessamento.")
-            continue
+def ingest_policies(changed: Iterable[str], removed: Iterable[str] = ()) -> int:
+    """
+    Ingestão direcionada: processa apenas os arquivos informados (ex.: eventos do watcher),
+    sem varrer nem recalcular o hash da pasta inteira.
+    """
+    changed = sorted({name for name in changed if name and not name.startswith(".")})
+    removed = sorted({name for name in removed if name and not name.startswith(".")} - set(changed))
+    if not changed and not removed:
+        return 0
 
-        # Limpar embeddings antigos do arquivo
-        remove_embeddings_for_source(filename)
+    print(f"[ingest] Ingestão direcionada: {len(changed)} alterado(s), {len(removed)} removido(s)")
+    load_embeddings()
 
-        try:
-            pages = extract_text_from_file(file_path)
+    meta = _load_current_meta()
+
+    db: Session = next(get_session())
+    processed_files = 0
 
-            if not pages or not any(p.strip() for p in pages):
-                print(f"[ingest] AVISO: {filename} não contém texto extraído!")
-                policy.embedding_status = "error"
-                policy.embedding_last_error = "Nenhum texto extraído"
-                db.add(policy)
+    try:
+        for filename in changed:
+            if not (POLICY_DIR / filename).is_file():
+                removed.append(filename)
                 continue
+            if _ingest_file(db, filename, meta):
+                processed_files += 1
 
-            chunks = split_into_chunks_with_metadata(
-                pages=pages,
-                source_name=filename,
-            )
+        for fname in removed:
+            print(f"[ingest] Removendo embeddings de arquivo ausente: {fname}")
+            remove_embeddings_for_source(fname)
+            meta.pop(fname, None)
+        _save_meta(meta)
+    finally:
+        db.close()
 
-            print(f"[ingest] {len(chunks)} chunks gerados para {filename}")
+    print(f"[ingest] Ingestão direcionada concluída! {processed_files} arquivos processados.")
+    return processed_files
 
-            store_embeddings(chunks)
 
-            policy.embedding_status = "completed"
-            policy.embedding_last_error = None
-            db.add(policy)
-            processed_files += 1
+def _load_current_meta() -> dict:
+    meta_version, meta = _load_meta()
+    if meta_version != EMBEDDINGS_SCHEMA_VERSION:
+        # Força reprocessamento quando o pipeline de embeddings muda.
+        return {}
+    return meta
 
-        except Exception as e:  # noqa: BLE001
-            print(f"[ingest] ERRO ao processar {filename}: {e}")
+
+def _checkpoint(db: Session, meta: dict, filename: str, file_hash: str) -> None:
+    """
+    Fecha a unidade de trabalho de um arquivo: status no banco e depois o hash no meta.
+    O segmento de embeddings ja foi gravado antes. Se o processo cair entre as etapas,
+    o arquivo fica com status/hash divergentes e apenas ele e reprocessado.
+    """
+    db.commit()
+    meta[filename] = file_hash
+    _save_meta(meta)
+
+
+def _ingest_file(db: Session, filename: str, meta: dict) -> bool:
+    """Processa um arquivo da pasta de políticas. Retorna se ele foi (re)vetorizado."""
+    file_path = POLICY_DIR / filename
+    file_hash = _file_hash(file_path)
+
+    print(f"[ingest] Verificando: {filename}")
+
+    policy = (
+        db.query(PolicyFile)
+        .filter(PolicyFile.filename == filename)
+        .first()
+    )
+
+    if not policy:
+        print(f"[ingest] AVISO: {filename} não está registrado no banco. Ignorando.")
+        if meta.get(filename) != file_hash:
+            _checkpoint(db, meta, filename, file_hash)
+        return False
+
+    # Skip se hash não mudou e status está ok
+    if meta.get(filename) == file_hash and policy.embedding_status == "completed":
+        print(f"[ingest] {filename} sem mudanças. Pulando reprocessamento.")
+        return False
+
+    try:
+        pages = extract_text_from_file(file_path)
+
+        if not pages or not any(p.strip() for p in pages):
+            print(f"[ingest] AVISO: {filename} não contém texto extraído!")
+            remove_embeddings_for_source(filename)
             policy.embedding_status = "error"
-            policy.embedding_last_error = str(e)
+            policy.embedding_last_error = "Nenhum texto extraído"
             db.add(policy)
-            continue
+            _checkpoint(db, meta, filename, file_hash)
+            return False
+
+        chunks = split_into_chunks_with_metadata(
+            pages=pages,
+            source_name=filename,
+        )
 
-    # Remover embeddings de arquivos que foram apagados
-    removed_files = set(meta.keys()) - set(current_files)
-    for fname in removed_files:
-        print(f"[ingest] Removendo embeddings de arquivo ausente: {fname}")
-        remove_embeddings_for_source(fname)
+        print(f"[ingest] {len(chunks)} chunks gerados para {filename}")
+
+        # Substitui o segmento do arquivo (os embeddings antigos seguem valendo ate aqui).
+        replace_source_embeddings(filename, chunks)
+
+        policy.embedding_status = "completed"
+        policy.embedding_last_error = None
+        # O resumo precomputado descrevia a versao anterior do arquivo.
+        policy.summary = None
+        policy.summary_hash = None
+        db.add(policy)
+        _checkpoint(db, meta, filename, file_hash)
+        invalidate_config_cache()
+        print(f"[ingest] Checkpoint: {filename} concluído.")
+        return True
+
+    except Exception as e:  # noqa: BLE001
+        print(f"[ingest] ERRO ao processar {filename}: {e}")
+        db.rollback()
+        remove_embeddings_for_source(filename)
+        policy.embedding_status = "error"
+        policy.embedding_last_error = str(e)
+        db.add(policy)
+        _checkpoint(db, meta, filename, file_hash)
+        return False
 
-    _save_meta(updated_meta)
 
-    db.commit()
-    db.close()
+# Hashes ja conhecidos (ex.: calculados durante o upload), validos enquanto (mtime, tamanho) nao mudar.
+_known_hashes: dict[str, tuple[tuple[int, int], str]] = {}
 
-    print(f"[ingest] Processo de ingestão concluído! {processed_files} arquivos processados.")
+
+def remember_file_hash(path: Path, file_hash: str) -> None:
+    """Registra o sha256 de um arquivo recem-gravado para evitar reler o conteudo na ingestao."""
+    stat = path.stat()
+    _known_hashes[str(Path(path).resolve())] = ((stat.st_mtime_ns, stat.st_size), file_hash)
 
 
 def _file_hash(path: Path) -> str:
+    key = str(path.resolve())
+    known = _known_hashes.get(key)
+    if known:
+        stat = path.stat()
+        if known[0] == (stat.st_mtime_ns, stat.st_size):
+            return known[1]
+        _known_hashes.pop(key, None)
+
     hasher = hashlib.sha256()
     with path.open("rb") as f:
         for chunk in iter(lambda: f.read(8192), b""):
@@ -191,7 +283,10 @@ def _load_meta() -> tuple[int, dict]:
 def _save_meta(meta: dict) -> None:
     META_FILE.parent.mkdir(parents=True, exist_ok=True)
     payload = {"_schema_version": EMBEDDINGS_SCHEMA_VERSION, "hashes": meta}
-    META_FILE.write_text(json.dumps(payload, ensure_ascii=False, indent=2), encoding="utf-8")
+    # Escrita atomica: um crash durante o checkpoint nao corrompe o meta.
+    tmp_file = META_FILE.with_suffix(".json.tmp")
+    tmp_file.write_text(json.dumps(payload, ensure_ascii=False, indent=2), encoding="utf-8")
+    os.replace(tmp_file, META_FILE)
 
 
 def get_ingest_status(db: Session | None = None) -> dict:
@@ -0,0 +1,534 @@
+import asyncio
+import random
+import threading
+import time
+
+import httpx
+
+from app.core.config import settings
+from app.services.deadline import Deadline, DeadlineExceededError
+
+
+class LLMUnavailableError(Exception):
+    """Backend do LLM indisponivel (circuito aberto ou falha de conexao persistente)."""
+
+
+# Erros anteriores ao envio da requisicao (conexao ou vaga no pool): seguros para repetir.
+# RemoteProtocolError fica de fora: pode vir depois de o servidor aceitar o pedido, e repetir
+# uma geracao a faria rodar (e ser contabilizada) duas vezes.
+_RETRYABLE_ERRORS = (httpx.ConnectError, httpx.ConnectTimeout, httpx.PoolTimeout)
+
+
+class CircuitBreaker:
+    """
+    Disjuntor simples: apos N falhas consecutivas abre e passa a falhar rapido;
+    depois de reset_seconds deixa uma requisicao de teste passar (meio-aberto).
+    """
+
+    def __init__(self, failure_threshold: int, reset_seconds: float):
+        self.failure_threshold = max(failure_threshold, 1)
+        self.reset_seconds = reset_seconds
+        self._failures = 0
+        self._opened_at: float | None = None
+        self._probe_in_flight = False
+        self._lock = threading.Lock()
+
+    @property
+    def state(self) -> str:
+        with self._lock:
+            return self._state_locked()
+
+    def _state_locked(self) -> str:
+        if self._opened_at is None:
+            return "closed"
+        if time.monotonic() - self._opened_at >= self.reset_seconds:
+            return "half_open"
+        return "open"
+
+    def allow(self) -> bool:
+        with self._lock:
+            state = self._state_locked()
+            if state == "closed":
+                return True
+            if state == "half_open" and not self._probe_in_flight:
+                self._probe_in_flight = True
+                return True
+            return False
+
+    def record_success(self) -> None:
+        with self._lock:
+            self._failures = 0
+            self._opened_at = None
+            self._probe_in_flight = False
+
+    def cancel_probe(self) -> None:
+        """Requisicao cancelada sem resultado: libera a vaga de teste do meio-aberto."""
+        with self._lock:
+            self._probe_in_flight = False
+
+    def record_failure(self) -> None:
+        with self._lock:
+            self._failures += 1
+            self._probe_in_flight = False
+            if self._failures >= self.failure_threshold:
+                self._opened_at = time.monotonic()
+
+    def snapshot(self) -> dict:
+        with self._lock:
+            return {
+                "state": self._state_locked(),
+                "consecutive_failures": self._failures,
+                "opened_at_monotonic": self._opened_at,
+            }
+
+
+class Backend:
+    """Um servidor compativel com /v1/responses (LM Studio, vLLM...), com peso e disjuntor proprio."""
+
+    def __init__(self, url: str, weight: float = 1.0):
+        self.url = url
+        self.weight = max(weight, 0.01)
+        self.breaker = CircuitBreaker(settings.LLM_BREAKER_FAILURE_THRESHOLD, settings.LLM_BREAKER_RESET_SECONDS)
+        self.outstanding = 0
+        self.requests = 0
+        self.failures = 0
+        # Resultado da ultima sonda ativa (None = ainda nao sondado).
+        self.healthy: bool | None = None
+        self.last_probe_error: str | None = None
+
+    @property
+    def health_url(self) -> str:
+        return str(httpx.URL(self.url).copy_with(path=settings.LLM_HEALTH_CHECK_PATH, query=None))
+
+    def available(self) -> bool:
+        return self.healthy is not False and self.breaker.state != "open"
+
+    def snapshot(self) -> dict:
+        return {
+            "url": self.url,
+            "weight": self.weight,
+            "outstanding": self.outstanding,
+            "requests": self.requests,
+            "failures": self.failures,
+            "healthy": self.healthy,
+            "last_probe_error": self.last_probe_error,
+            "circuit": self.breaker.snapshot(),
+        }
+
+
+def _parse_backends(spec: str, default_url: str) -> list[Backend]:
+    """LMSTUDIO_BACKENDS: "url|peso,url|peso" (peso opcional); vazio usa LMSTUDIO_API_URL."""
+    backends: list[Backend] = []
+    for entry in (spec or "").split(","):
+        entry = entry.strip()
+        if not entry:
+            continue
+        url, _, weight = entry.partition("|")
+        backends.append(Backend(url.strip(), float(weight) if weight.strip() else 1.0))
+    return backends or [Backend(default_url)]
+
+
+class LLMRouter:
+    """
+    Escolhe o backend com menos requisicoes em andamento (ponderado pelo peso). Backends com
+    o disjuntor aberto (falhas passivas) ou reprovados na sonda ativa ficam fora da escolha.
+    Tambem conta as reservas por pool ("async"/"sync"): cada uma ocupa uma conexao do cliente
+    ate o release, inclusive durante um stream.
+    """
+
+    def __init__(self, backends: list[Backend]):
+        self.backends = backends
+        self.in_use = {"async": 0, "sync": 0}
+        self._lock = threading.Lock()
+
+    def has_alternative(self, tried: set[str]) -> bool:
+        return any(b.url not in tried and b.available() for b in self.backends)
+
+    def pick(self, tried: set[str] | None = None, pool: str = "async") -> Backend:
+        """Reserva um backend (chamar release com o mesmo pool depois). Prefere os ainda nao tentados."""
+        tried = tried or set()
+        with self._lock:
+            ranked = sorted(
+                self.backends,
+                key=lambda b: (
+                    b.url in tried,
+                    not b.available(),
+                    (b.outstanding + 1) / b.weight,
+                    random.random(),
+                ),
+            )
+            for backend in ranked:
+                # Disjuntor fechado deixa passar; meio-aberto libera uma unica requisicao de teste.
+                if backend.breaker.allow():
+                    backend.outstanding += 1
+                    backend.requests += 1
+                    self.in_use[pool] += 1
+                    return backend
+        _bump("rejected_open_circuit")
+        raise LLMUnavailableError("Servico de IA temporariamente indisponivel. Tente novamente em instantes.")
+
+    def release(self, backend: Backend, pool: str = "async") -> None:
+        with self._lock:
+            backend.outstanding -= 1
+            self.in_use[pool] -= 1
+
+
+router = LLMRouter(_parse_backends(settings.LMSTUDIO_BACKENDS, settings.LMSTUDIO_API_URL))
+
+_stats = {"requests": 0, "streams": 0, "failures": 0, "retries": 0, "rejected_open_circuit": 0, "in_flight": 0}
+_stats_lock = threading.Lock()
+_probe_task: asyncio.Task | None = None
+
+_async_client: httpx.AsyncClient | None = None
+_sync_client: httpx.Client | None = None
+_client_lock = threading.Lock()
+
+
+def _bump(key: str, delta: int = 1) -> None:
+    with _stats_lock:
+        _stats[key] += delta
+
+
+def _timeout() -> httpx.Timeout:
+    return httpx.Timeout(
+        connect=settings.LMSTUDIO_CONNECT_TIMEOUT_SECONDS,
+        read=settings.LMSTUDIO_TIMEOUT_SECONDS,
+        write=settings.LMSTUDIO_CONNECT_TIMEOUT_SECONDS,
+        pool=settings.LMSTUDIO_CONNECT_TIMEOUT_SECONDS,
+    )
+
+
+def _request_timeout(deadline: Deadline | None):
+    """Timeout de leitura limitado ao que resta do prazo da requisicao."""
+    if deadline is None:
+        return httpx.USE_CLIENT_DEFAULT
+    deadline.check("llm")
+    return httpx.Timeout(
+        connect=min(settings.LMSTUDIO_CONNECT_TIMEOUT_SECONDS, deadline.remaining()),
+        read=min(settings.LMSTUDIO_TIMEOUT_SECONDS, deadline.remaining()),
+        write=settings.LMSTUDIO_CONNECT_TIMEOUT_SECONDS,
+        pool=min(settings.LMSTUDIO_CONNECT_TIMEOUT_SECONDS, deadline.remaining()),
+    )
+
+
+def _limits() -> httpx.Limits:
+    return httpx.Limits(
+        max_connections=settings.LLM_POOL_MAX_CONNECTIONS,
+        max_keepalive_connections=settings.LLM_POOL_MAX_KEEPALIVE,
+        keepalive_expiry=settings.LLM_POOL_KEEPALIVE_SECONDS,
+    )
+
+
+def get_async_client() -> httpx.AsyncClient:
+    """Cliente assincrono unico do processo (pool de conexoes com keep-alive)."""
+    global _async_client
+    with _client_lock:
+        if _async_client is None or _async_client.is_closed:
+            _async_client = httpx.AsyncClient(timeout=_timeout(), limits=_limits())
+        return _async_client
+
+
+def get_sync_client() -> httpx.Client:
+    """Cliente sincrono com pool proprio, para chamadores fora do event loop (ingestao, CLI)."""
+    global _sync_client
+    with _client_lock:
+        if _sync_client is None or _sync_client.is_closed:
+            _sync_client = httpx.Client(timeout=_timeout(), limits=_limits())
+        return _sync_client
+
+
+async def aclose_clients() -> None:
+    global _async_client, _sync_client, _probe_task
+    if _probe_task is not None:
+        _probe_task.cancel()
+        _probe_task = None
+    if _async_client is not None:
+        await _async_client.aclose()
+        _async_client = None
+    if _sync_client is not None:
+        _sync_client.close()
+        _sync_client = None
+
+
+def _backoff_delay(attempt: int) -> float:
+    base = settings.LLM_RETRY_BACKOFF_SECONDS * (2 ** attempt)
+    return base * random.uniform(0.5, 1.5)
+
+
+def _record_outcome(backend: Backend, exc: BaseException | None) -> None:
+    if exc is None:
+        backend.breaker.record_success()
+        return
+    if isinstance(exc, httpx.HTTPStatusError) and exc.response.status_code < 500:
+        # Erro do pedido (4xx): o backend esta de pe.
+        backend.breaker.record_success()
+        return
+    _bump("failures")
+    backend.failures += 1
+    backend.breaker.record_failure()
+
+
+def _raise_if_deadline(exc: BaseException, deadline: Deadline | None, backend: Backend) -> None:
+    # Timeout causado pelo prazo da requisicao nao e falha do backend (nao conta no disjuntor).
+    if deadline is not None and deadline.expired and isinstance(exc, httpx.TimeoutException):
+        backend.breaker.cancel_probe()
+        raise DeadlineExceededError("llm") from exc
+
+
+def _should_retry(exc: BaseException, attempt: int, tried: set[str]) -> bool:
+    """Erros de conexao: repete (outro backend, ou o mesmo com backoff). 5xx: so em outro backend."""
+    if attempt >= settings.LLM_RETRY_ATTEMPTS:
+        return False
+    if isinstance(exc, _RETRYABLE_ERRORS):
+        return True
+    if isinstance(exc, httpx.HTTPStatusError) and exc.response.status_code >= 500:
+        return router.has_alternative(tried)
+    return False
+
+
+def _retry_delay(attempt: int, tried: set[str]) -> float:
+    # Trocar de backend e imediato; repetir no mesmo espera o backoff.
+    return 0.0 if router.has_alternative(tried) else _backoff_delay(attempt)
+
+
+class _ReleasingStream(httpx.SyncByteStream):
+    """Envolve o corpo de uma resposta em streaming para liberar o backend ao fechar."""
+
+    def __init__(self, stream: httpx.SyncByteStream, on_close):
+        self._stream = stream
+        self._on_close = on_close
+
+    def __iter__(self):
+        return iter(self._stream)
+
+    def close(self) -> None:
+        try:
+            self._stream.close()
+        finally:
+            if self._on_close is not None:
+                on_close, self._on_close = self._on_close, None
+                on_close()
+
+
+class _AsyncReleasingStream(httpx.AsyncByteStream):
+    """Versao assincrona de _ReleasingStream."""
+
+    def __init__(self, stream: httpx.AsyncByteStream, on_close):
+        self._stream = stream
+        self._on_close = on_close
+
+    def __aiter__(self):
+        return self._stream.__aiter__()
+
+    async def aclose(self) -> None:
+        try:
+            await self._stream.aclose()
+        finally:
+            if self._on_close is not None:
+                on_close, self._on_close = self._on_close, None
+                on_close()
+
+
+def _json_headers() -> dict:
+    return {"Content-Type": "application/json"}
+
+
+def _stream_headers() -> dict:
+    return {"Content-Type": "application/json", "Accept": "text/event-stream"}
+
+
+async def apost_json(payload: dict, *, deadline: Deadline | None = None) -> dict:
+    """
+    POST JSON num backend escolhido pelo roteador, com pool, disjuntor por backend e
+    retentativas (em outro backend quando houver; no mesmo, com backoff e jitter).
+    Com `deadline`, cada tentativa so espera o que resta do prazo e nao ha retentativa apos ele.
+    """
+    _bump("requests")
+    _bump("in_flight")
+    tried: set[str] = set()
+    attempt = 0
+    try:
+        while True:
+            timeout = _request_timeout(deadline)
+            backend = router.pick(tried)
+            try:
+                response = await get_async_client().post(
+                    backend.url, json=payload, headers=_json_headers(), timeout=timeout
+                )
+                response.raise_for_status()
+                data = response.json()
+            except asyncio.CancelledError:
+                backend.breaker.cancel_probe()
+                raise
+            except Exception as exc:
+                _raise_if_deadline(exc, deadline, backend)
+                _record_outcome(backend, exc)
+                tried.add(backend.url)
+                if not _should_retry(exc, attempt, tried):
+                    raise
+                _bump("retries")
+                await asyncio.sleep(_retry_delay(attempt, tried))
+                attempt += 1
+                continue
+            finally:
+                router.release(backend)
+            _record_outcome(backend, None)
+            return data
+    finally:
+        _bump("in_flight", -1)
+
+
+def post_json(payload: dict) -> dict:
+    """Versao sincrona de apost_json (mesmas regras de roteamento, retentativa e disjuntor)."""
+    _bump("requests")
+    _bump("in_flight")
+    tried: set[str] = set()
+    attempt = 0
+    try:
+        while True:
+            backend = router.pick(tried, "sync")
+            try:
+                response = get_sync_client().post(backend.url, json=payload, headers=_json_headers())
+                response.raise_for_status()
+                data = response.json()
+            except Exception as exc:
+                _record_outcome(backend, exc)
+                tried.add(backend.url)
+                if not _should_retry(exc, attempt, tried):
+                    raise
+                _bump("retries")
+                time.sleep(_retry_delay(attempt, tried))
+                attempt += 1
+                continue
+            finally:
+                router.release(backend, "sync")
+            _record_outcome(backend, None)
+            return data
+    finally:
+        _bump("in_flight", -1)
+
+
+async def aopen_stream(payload: dict, *, deadline: Deadline | None = None) -> httpx.Response:
+    """
+    Abre uma resposta em streaming (so a abertura e repetida). O backend conta como ocupado
+    ate a resposta ser fechada.
+    """
+    _bump("streams")
+    tried: set[str] = set()
+    attempt = 0
+    while True:
+        timeout = _request_timeout(deadline)
+        backend = router.pick(tried)
+        client = get_async_client()
+        request = client.build_request("POST", backend.url, json=payload, headers=_stream_headers(), timeout=timeout)
+        try:
+            response = await client.send(request, stream=True)
+            if response.status_code >= 400:
+                await response.aread()
+                await response.aclose()
+                response.raise_for_status()
+        except BaseException as exc:
+            router.release(backend)
+            if isinstance(exc, asyncio.CancelledError):
+                backend.breaker.cancel_probe()
+                raise
+            _raise_if_deadline(exc, deadline, backend)
+            _record_outcome(backend, exc)
+            tried.add(backend.url)
+            if not _should_retry(exc, attempt, tried):
+                raise
+            _bump("retries")
+            await asyncio.sleep(_retry_delay(attempt, tried))
+            attempt += 1
+            continue
+        _record_outcome(backend, None)
+        response.stream = _AsyncReleasingStream(response.stream, lambda b=backend: router.release(b))
+        return response
+
+
+def open_stream(payload: dict) -> httpx.Response:
+    """Versao sincrona de aopen_stream."""
+    _bump("streams")
+    tried: set[str] = set()
+    attempt = 0
+    while True:
+        backend = router.pick(tried, "sync")
+        client = get_sync_client()
+        request = client.build_request("POST", backend.url, json=payload, headers=_stream_headers())
+        try:
+            response = client.send(request, stream=True)
+            if response.status_code >= 400:
+                response.read()
+                response.close()
+                response.raise_for_status()
+        except Exception as exc:
+            router.release(backend, "sync")
+            _record_outcome(backend, exc)
+            tried.add(backend.url)
+            if not _should_retry(exc, attempt, tried):
+                raise
+            _bump("retries")
+            time.sleep(_retry_delay(attempt, tried))
+            attempt += 1
+            continue
+        _record_outcome(backend, None)
+        response.stream = _ReleasingStream(response.stream, lambda b=backend: router.release(b, "sync"))
+        return response
+
+
+async def _probe_backends_forever() -> None:
+    """Sonda ativa: GET em LLM_HEALTH_CHECK_PATH de cada backend a cada intervalo."""
+    while True:
+        client = get_async_client()
+        for backend in router.backends:
+            try:
+                response = await client.get(backend.health_url, timeout=settings.LMSTUDIO_CONNECT_TIMEOUT_SECONDS)
+                response.raise_for_status()
+                backend.healthy = True
+                backend.last_probe_error = None
+            except asyncio.CancelledError:
+                raise
+            except Exception as exc:  # noqa: BLE001
+                if backend.healthy is not False:
+                    print(f"[llm-router] Backend {backend.url} reprovado na sonda: {exc!r}")
+                backend.healthy = False
+                backend.last_probe_error = repr(exc)
+        await asyncio.sleep(settings.LLM_HEALTH_CHECK_SECONDS)
+
+
+def start_health_probes() -> None:
+    """Inicia a sonda ativa em segundo plano (chamar dentro do event loop, no startup)."""
+    global _probe_task
+    if settings.LLM_HEALTH_CHECK_SECONDS <= 0 or (_probe_task is not None and not _probe_task.done()):
+        return
+    _probe_task = asyncio.get_running_loop().create_task(_probe_backends_forever())
+
+
+def _pool_snapshot(client: httpx.Client | httpx.AsyncClient | None, pool: str) -> dict | None:
+    if client is None or client.is_closed:
+        return None
+    # Contado pelo roteador (reservas em andamento), sem depender de internals do httpx/httpcore.
+    active = router.in_use[pool]
+    return {
+        "active": active,
+        "available": max(settings.LLM_POOL_MAX_CONNECTIONS - active, 0),
+        "max_connections": settings.LLM_POOL_MAX_CONNECTIONS,
+    }
+
+
+def get_pool_stats() -> dict:
+    """Estatisticas do pool, dos backends e dos disjuntores para monitoramento."""
+    with _stats_lock:
+        counters = dict(_stats)
+    return {
+        **counters,
+        "backends": [b.snapshot() for b in router.backends],
+        "async_pool": _pool_snapshot(_async_client, "async"),
+        "sync_pool": _pool_snapshot(_sync_client, "sync"),
+        "limits": {
+            "max_connections": settings.LLM_POOL_MAX_CONNECTIONS,
+            "max_keepalive": settings.LLM_POOL_MAX_KEEPALIVE,
+            "connect_timeout_s": settings.LMSTUDIO_CONNECT_TIMEOUT_SECONDS,
+            "read_timeout_s": settings.LMSTUDIO_TIMEOUT_SECONDS,
+        },
+    }
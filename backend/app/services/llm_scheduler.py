@@ -0,0 +1,139 @@
+import asyncio
+import heapq
+import itertools
+import math
+import time
+from collections import deque
+
+from app.core.config import settings
+
+# Classes de prioridade (menor = atende antes)
+PRIORITY_SMALL_TALK = 0
+PRIORITY_STANDARD = 1
+PRIORITY_LONG = 2
+PRIORITY_BACKGROUND = 3  # resumos de conversa etc.: so quando nao ha pergunta esperando
+
+
+class LLMQueueFullError(Exception):
+    """Fila de geracao cheia; `retry_after` e a estimativa (s) para tentar novamente."""
+
+    def __init__(self, retry_after: int):
+        super().__init__("Servico de IA ocupado. Tente novamente em instantes.")
+        self.retry_after = retry_after
+
+
+def priority_for(prepared: dict) -> int:
+    """Conversa curta e respostas padrao passam na frente de RESUMO/DETALHADO."""
+    if prepared.get("small_talk"):
+        return PRIORITY_SMALL_TALK
+    if prepared.get("answer_mode") in ("RESUMO", "DETALHADO"):
+        return PRIORITY_LONG
+    return PRIORITY_STANDARD
+
+
+class LLMScheduler:
+    """
+    Controle de admissao para o LM Studio: no maximo `max_in_flight` geracoes simultaneas
+    e uma fila de espera limitada. A fila ordena por (prioridade, rodada do usuario, chegada):
+    cada novo pedido de um usuario entra uma rodada depois do anterior dele, entao quem
+    dispara muitas perguntas nao passa na frente dos demais (fair queuing por rodadas).
+    Tudo roda no event loop; nao ha travas.
+    """
+
+    def __init__(self, max_in_flight: int, max_queue: int):
+        self.max_in_flight = max(max_in_flight, 1)
+        self.max_queue = max(max_queue, 0)
+        self._in_flight = 0
+        self._heap: list[tuple[int, int, int, str, asyncio.Future]] = []
+        self._seq = itertools.count()
+        self._user_round: dict[str, int] = {}
+        self._served_round = 0
+        self._waits: deque[float] = deque(maxlen=200)
+        self._service_times: deque[float] = deque(maxlen=50)
+        self.admitted = 0
+        self.rejected = 0
+
+    @property
+    def queue_depth(self) -> int:
+        return sum(1 for entry in self._heap if not entry[4].done())
+
+    def _next_round(self, user_key: str) -> int:
+        round_no = max(self._user_round.get(user_key, 0), self._served_round) + 1
+        self._user_round[user_key] = round_no
+        return round_no
+
+    def _retry_after(self) -> int:
+        avg_service = (sum(self._service_times) / len(self._service_times)) if self._service_times else 10.0
+        batches = (self.queue_depth + self._in_flight) / self.max_in_flight
+        return max(1, math.ceil(avg_service * batches))
+
+    async def acquire(self, user_key: str, priority: int = PRIORITY_STANDARD) -> float:
+        """Aguarda uma vaga; devolve o instante de admissao (para release)."""
+        enqueued_at = time.perf_counter()
+        if self._in_flight < self.max_in_flight and not self.queue_depth:
+            self._in_flight += 1
+            self._admit(enqueued_at, self._next_round(user_key))
+            return time.perf_counter()
+
+        if self.queue_depth >= self.max_queue:
+            self.rejected += 1
+            raise LLMQueueFullError(self._retry_after())
+
+        future = asyncio.get_running_loop().create_future()
+        round_no = self._next_round(user_key)
+        heapq.heappush(self._heap, (priority, round_no, next(self._seq), user_key, future))
+        try:
+            await future
+        except asyncio.CancelledError:
+            if future.done() and not future.cancelled():
+                # A vaga ja tinha sido entregue quando o cliente desistiu: devolve.
+                self._release_slot()
+            raise
+        self._admit(enqueued_at, round_no)
+        return time.perf_counter()
+
+    def _admit(self, enqueued_at: float, round_no: int) -> None:
+        self.admitted += 1
+        self._served_round = max(self._served_round, round_no)
+        self._waits.append(time.perf_counter() - enqueued_at)
+
+    def release(self, admitted_at: float) -> None:
+        self._service_times.append(time.perf_counter() - admitted_at)
+        self._release_slot()
+
+    def _release_slot(self) -> None:
+        # A vaga passa direto para o proximo da fila (in_flight nao muda) ou e liberada.
+        while self._heap:
+            *_, future = heapq.heappop(self._heap)
+            if not future.done():
+                future.set_result(None)
+                return
+        self._in_flight -= 1
+
+    def stats(self) -> dict:
+        waits = sorted(self._waits)
+        depth_by_priority = {"small_talk": 0, "standard": 0, "long": 0, "background": 0}
+        names = {
+            PRIORITY_SMALL_TALK: "small_talk",
+            PRIORITY_STANDARD: "standard",
+            PRIORITY_LONG: "long",
+            PRIORITY_BACKGROUND: "background",
+        }
+        for priority, *_rest, future in self._heap:
+            if not future.done():
+                depth_by_priority[names.get(priority, "standard")] += 1
+        return {
+            "in_flight": self._in_flight,
+            "max_in_flight": self.max_in_flight,
+            "queue_depth": sum(depth_by_priority.values()),
+            "queue_depth_by_priority": depth_by_priority,
+            "max_queue": self.max_queue,
+            "admitted": self.admitted,
+            "rejected": self.rejected,
+            "wait_ms_avg": round(1000 * sum(waits) / len(waits), 1) if waits else 0.0,
+            "wait_ms_p95": round(1000 * waits[int(0.95 * (len(waits) - 1))], 1) if waits else 0.0,
+            "wait_ms_max": round(1000 * waits[-1], 1) if waits else 0.0,
+        }
+
+
+scheduler = LLMScheduler(settings.LLM_MAX_CONCURRENT_GENERATIONS, settings.LLM_QUEUE_MAX)
@@ -0,0 +1,103 @@
+"""MinHash/LSH leve (numpy puro) para detectar trechos quase duplicados na ingestao."""
+
+import re
+import unicodedata
+import zlib
+from collections import defaultdict
+from typing import Dict, List
+
+import numpy as np
+
+from app.core.config import settings
+
+NUM_PERMUTATIONS = 64
+LSH_BANDS = 16
+LSH_ROWS = NUM_PERMUTATIONS // LSH_BANDS
+SHINGLE_SIZE = 5
+
+# Primo > 2^32; coeficientes < 2^31 garantem que a*h + b cabe em uint64 sem overflow.
+_PRIME = np.uint64(4294967311)
+_rng = np.random.RandomState(20240601)
+_A = _rng.randint(1, 2**31 - 1, size=NUM_PERMUTATIONS).astype(np.uint64)
+_B = _rng.randint(0, 2**31 - 1, size=NUM_PERMUTATIONS).astype(np.uint64)
+
+
+def _normalize(text: str) -> str:
+    folded = unicodedata.normalize("NFKD", text).encode("ascii", "ignore").decode("ascii")
+    return re.sub(r"\s+", " ", folded.lower()).strip()
+
+
+def shingles(text: str, size: int = SHINGLE_SIZE) -> set[str]:
+    normalized = _normalize(text)
+    if len(normalized) <= size:
+        return {normalized} if normalized else set()
+    return {normalized[i : i + size] for i in range(len(normalized) - size + 1)}
+
+
+def signature(text: str) -> np.ndarray:
+    """Assinatura MinHash estavel entre processos (crc32 em vez de hash() do Python)."""
+    grams = shingles(text)
+    if not grams:
+        return np.full(NUM_PERMUTATIONS, _PRIME, dtype=np.uint64)
+    hashes = np.fromiter((zlib.crc32(g.encode("utf-8")) for g in grams), dtype=np.uint64, count=len(grams))
+    return ((_A[:, None] * hashes[None, :] + _B[:, None]) % _PRIME).min(axis=1)
+
+
+def estimated_jaccard(a: np.ndarray, b: np.ndarray) -> float:
+    return float(np.mean(a == b))
+
+
+class NearDuplicateIndex:
+    """Indice LSH por bandas: candidatos por balde, confirmados pela similaridade estimada."""
+
+    def __init__(self, threshold: float | None = None):
+        self.threshold = settings.NEAR_DUP_THRESHOLD if threshold is None else threshold
+        self._buckets: dict[tuple[int, bytes], list[int]] = defaultdict(list)
+        self._signatures: list[np.ndarray] = []
+
+    def find(self, sig: np.ndarray) -> int | None:
+        """Retorna a posicao do primeiro item quase duplicado ja indexado (ou None)."""
+        checked: set[int] = set()
+        for band in range(LSH_BANDS):
+            key = (band, sig[band * LSH_ROWS : (band + 1) * LSH_ROWS].tobytes())
+            for candidate in self._buckets.get(key, ()):
+                if candidate in checked:
+                    continue
+                checked.add(candidate)
+                if estimated_jaccard(sig, self._signatures[candidate]) >= self.threshold:
+                    return candidate
+        return None
+
+    def add(self, sig: np.ndarray) -> int:
+        position = len(self._signatures)
+        self._signatures.append(sig)
+        for band in range(LSH_BANDS):
+            key = (band, sig[band * LSH_ROWS : (band + 1) * LSH_ROWS].tobytes())
+            self._buckets[key].append(position)
+        return position
+
+
+def occurrence_of(item: Dict) -> Dict:
+    return {"source": item.get("source"), "page": item.get("page"), "order": item.get("order")}
+
+
+def collapse_near_duplicates(chunks: List[Dict]) -> List[Dict]:
+    """
+    Agrupa chunks quase identicos (rodapes, blocos de assinatura, clausulas padrao).
+    Mantem o primeiro de cada grupo como canonico, com a assinatura MinHash e a lista
+    de todas as ocorrencias (source, page, order) para que as citacoes continuem resolvendo.
+    """
+    index = NearDuplicateIndex()
+    canonical: List[Dict] = []
+    for chunk in chunks:
+        text = (chunk.get("text") or "").strip()
+        if not text:
+            continue
+        sig = signature(text)
+        match = index.find(sig)
+        if match is not None:
+            canonical[match]["occurrences"].append(occurrence_of(chunk))
+            continue
+        index.add(sig)
+        canonical.append({**chunk, "minhash": sig, "occurrences": [occurrence_of(chunk)]})
+    return canonical
@@ -1,9 +1,14 @@
+import multiprocessing
+import os
+from concurrent.futures import ProcessPoolExecutor
 from pathlib import Path
 from typing import List
 
 import docx
 import pdfplumber
 
+from app.core.config import settings
+
 
 def extract_text_from_file(path: str | Path) -> List[str]:
     """
@@ -29,19 +34,70 @@ def extract_text_from_file(path: str | Path) -> List[str]:
 # PDF → Lista de páginas
 # ----------------------------------------------------------------------
 def extract_pdf_pages(path: Path) -> List[str]:
-    pages: List[str] = []
     try:
         with pdfplumber.open(str(path)) as pdf:
-            for page in pdf.pages:
-                # Melhor extração possível
-                content = page.extract_text(layout=True)
-                if not content:
-                    content = page.extract_text()
+            total_pages = len(pdf.pages)
+            workers = _pdf_worker_count(total_pages)
+            if workers <= 1:
+                return [_extract_page_text(page) for page in pdf.pages]
+    except Exception:
+        return []
 
-                pages.append(clean_text(content or ""))
+    # PDFs grandes: cada processo abre o arquivo e extrai sua faixa de páginas.
+    try:
+        return _extract_pdf_pages_parallel(path, total_pages, workers)
+    except Exception as exc:  # noqa: BLE001
+        print(f"[parser] Extracao paralela falhou para {path.name} ({exc}); usando modo sequencial.")
+
+    try:
+        return _extract_pdf_page_range(str(path), 0, total_pages)
     except Exception:
         return []
 
+
+def _extract_page_text(page) -> str:
+    # Melhor extração possível
+    content = page.extract_text(layout=True)
+    if not content:
+        content = page.extract_text()
+    return clean_text(content or "")
+
+
+def _pdf_worker_count(total_pages: int) -> int:
+    if total_pages < settings.PDF_PARALLEL_MIN_PAGES:
+        return 1
+    max_workers = settings.PDF_EXTRACT_WORKERS or os.cpu_count() or 1
+    # Evita faixas pequenas demais: o custo de abrir o PDF em cada processo não compensa.
+    by_pages = max(total_pages // max(settings.PDF_PAGES_PER_WORKER, 1), 1)
+    return max(min(max_workers, by_pages), 1)
+
+
+def _extract_pdf_page_range(path: str, start: int, end: int) -> List[str]:
+    """Extrai as páginas [start, end) abrindo o PDF de forma independente (roda no worker)."""
+    pages: List[str] = []
+    with pdfplumber.open(path) as pdf:
+        for index in range(start, end):
+            page = pdf.pages[index]
+            pages.append(_extract_page_text(page))
+            # Libera o cache de objetos da página para não acumular memória em PDFs enormes.
+            page.close()
+    return pages
+
+
+def _extract_pdf_pages_parallel(path: Path, total_pages: int, workers: int) -> List[str]:
+    step = -(-total_pages // workers)
+    ranges = [(start, min(start + step, total_pages)) for start in range(0, total_pages, step)]
+
+    # "spawn" evita herdar threads/estado do processo principal (ex.: modelo de embeddings).
+    ctx = multiprocessing.get_context("spawn")
+    with ProcessPoolExecutor(max_workers=len(ranges), mp_context=ctx) as executor:
+        futures = [executor.submit(_extract_pdf_page_range, str(path), start, end) for start, end in ranges]
+        # Resultados recolhidos na ordem das faixas, preservando a ordem das páginas.
+        pages: List[str] = []
+        for future in futures:
+            pages.extend(future.result())
+
+    print(f"[parser] {path.name}: {total_pages} paginas extraidas em {len(ranges)} processos")
     return pages
 
 
@@ -0,0 +1,122 @@
+import math
+import threading
+from functools import lru_cache
+
+from app.core.config import settings
+
+# Separador entre trechos em get_relevant_chunks_with_meta (um trecho por citacao).
+_SNIPPET_SEPARATOR = "\n\n[Documento: "
+# Custo aproximado de cada mensagem no template de chat (papel + marcadores).
+_MESSAGE_OVERHEAD_TOKENS = 4
+# Aproximacao local (portugues em tokenizers BPE fica perto de 3.5 caracteres por token).
+_CHARS_PER_TOKEN = 3.5
+
+_tokenizer = None
+_tokenizer_loaded = False
+_tokenizer_lock = threading.Lock()
+
+
+def _get_tokenizer():
+    """Tokenizer do modelo alvo (PROMPT_TOKENIZER: id do Hugging Face ou tokenizer.json local)."""
+    global _tokenizer, _tokenizer_loaded
+    if _tokenizer_loaded:
+        return _tokenizer
+    with _tokenizer_lock:
+        if _tokenizer_loaded:
+            return _tokenizer
+        name = (settings.PROMPT_TOKENIZER or "").strip()
+        if name:
+            try:
+                from tokenizers import Tokenizer
+
+                if name.endswith(".json"):
+                    _tokenizer = Tokenizer.from_file(name)
+                else:
+                    _tokenizer = Tokenizer.from_pretrained(name)
+            except Exception as exc:  # noqa: BLE001
+                print(f"[prompt-budget] Tokenizer '{name}' indisponivel ({exc}); usando aproximacao local.")
+                _tokenizer = None
+        _tokenizer_loaded = True
+        return _tokenizer
+
+
+def count_tokens(text: str) -> int:
+    if not text:
+        return 0
+    tokenizer = _get_tokenizer()
+    if tokenizer is not None:
+        return len(tokenizer.encode(text, add_special_tokens=False).ids)
+    return math.ceil(len(text) / _CHARS_PER_TOKEN)
+
+
+@lru_cache(maxsize=16)
+def count_static_tokens(text: str) -> int:
+    """count_tokens memorizado, para o prefixo estavel do prompt (mesmo texto a cada pergunta)."""
+    return count_tokens(text)
+
+
+def count_message_tokens(message: dict) -> int:
+    return count_tokens(str(message.get("content") or "")) + _MESSAGE_OVERHEAD_TOKENS
+
+
+def fit_context(context: str, citations: list[dict], budget: int | None = None) -> tuple[str, list[dict], int]:
+    """Descarta os ultimos trechos (menos relevantes) ate o contexto caber no orcamento."""
+    budget = settings.PROMPT_CONTEXT_BUDGET_TOKENS if budget is None else budget
+    tokens = count_tokens(context)
+    if tokens <= budget or not context:
+        return context, citations, tokens
+
+    snippets = context.split(_SNIPPET_SEPARATOR)
+    snippets = [snippets[0]] + [_SNIPPET_SEPARATOR.lstrip("\n") + s for s in snippets[1:]]
+    kept: list[str] = []
+    used = 0
+    for snippet in snippets:
+        cost = count_tokens(snippet) + 1
+        if kept and used + cost > budget:
+            break
+        kept.append(snippet)
+        used += cost
+    trimmed = "\n\n".join(kept)
+    if len(kept) == 1 and used > budget:
+        # Um unico trecho maior que o orcamento: corta pelo tamanho proporcional.
+        trimmed = trimmed[: int(len(trimmed) * budget / used)]
+    # Citacoes sao 1:1 com os trechos, na mesma ordem.
+    return trimmed, citations[: len(kept)], count_tokens(trimmed)
+
+
+def history_budget(system_tokens: int, completion_tokens: int) -> int:
+    """Orcamento do historico: o fixo, limitado ao que sobra da janela do modelo."""
+    remaining = (
+        settings.MODEL_CONTEXT_TOKENS
+        - system_tokens
+        - completion_tokens
+        - settings.PROMPT_SAFETY_MARGIN_TOKENS
+    )
+    return max(min(settings.PROMPT_HISTORY_BUDGET_TOKENS, remaining), 0)
+
+
+def fit_history(messages: list[dict], budget: int) -> tuple[list[dict], int, int]:
+    """
+    Mantem as mensagens mais recentes que cabem no orcamento (remove da mais antiga).
+    A ultima mensagem (a pergunta atual) sempre fica; se sozinha estourar, e truncada.
+    Retorna (mensagens, tokens usados, mensagens descartadas).
+    """
+    if not messages:
+        return [], 0, 0
+
+    kept: list[dict] = []
+    used = 0
+    for message in reversed(messages):
+        cost = count_message_tokens(message)
+        if kept and used + cost > budget:
+            break
+        kept.append(message)
+        used += cost
+    kept.reverse()
+
+    if len(kept) == 1 and used > budget:
+        content = str(kept[0].get("content") or "")
+        keep_chars = max(int(len(content) * budget / used), 1)
+        kept = [{**kept[0], "content": content[-keep_chars:]}]
+        used = count_message_tokens(kept[0])
+    return kept, used, len(messages) - len(kept)
@@ -0,0 +1,125 @@
+import re
+import threading
+import time
+import unicodedata
+from collections import OrderedDict, deque
+
+from app.core.config import settings
+
+# Marcadores de pergunta que depende do turno anterior ("e o prazo?", "detalhe mais", "e nesse caso?").
+_FOLLOW_UP_OPENERS = ("e ", "mas ", "entao ", "tambem ", "alem disso")
+_FOLLOW_UP_WORDS = {
+    "isso", "disso", "nisso", "esse", "essa", "desse", "dessa", "nesse", "nessa", "este", "esta",
+    "deste", "desta", "neste", "nesta", "dele", "dela", "deles", "delas", "mesmo", "mesma",
+    "acima", "anterior", "mais", "detalhe", "detalhar", "explique", "aprofunde", "continue",
+}
+# So entram na memoria as citacoes com score perto do melhor do turno (o assunto de fato).
+_RELEVANCE_RATIO = 0.8
+_STOPWORDS = {
+    "a", "o", "os", "as", "um", "uma", "de", "da", "do", "das", "dos", "para", "por", "com", "em",
+    "no", "na", "nos", "nas", "e", "ou", "que", "qual", "quais", "quem", "como", "onde", "quando",
+    "quanto", "quantos", "quantas", "sobre", "pelo", "pela", "voce", "pode", "ser", "tem", "sao", "ha",
+}
+
+
+class _ChatMemory:
+    __slots__ = ("turns", "anchor", "updated")
+
+    def __init__(self):
+        # Cada turno guarda as citacoes (source, page) da recuperacao, da mais relevante para a menos.
+        self.turns: deque[list[tuple[str, int]]] = deque(maxlen=max(settings.CHAT_MEMORY_TURNS, 1))
+        # Ultima pergunta completa do chat: da sentido ao encoding de "detalhe mais" ou "e o prazo?".
+        self.anchor: str | None = None
+        self.updated = time.monotonic()
+
+
+_memories: "OrderedDict[int, _ChatMemory]" = OrderedDict()
+_lock = threading.Lock()
+_stats = {"follow_ups": 0, "working_set_hits": 0, "global_fallbacks": 0}
+
+
+def _fold(text: str) -> str:
+    return unicodedata.normalize("NFKD", text).encode("ascii", "ignore").decode("ascii").casefold()
+
+
+def looks_like_follow_up(question: str) -> bool:
+    """Pergunta curta ou anaforica, que so faz sentido junto com o assunto do turno anterior."""
+    folded = " ".join(_fold(question).split())
+    words = re.findall(r"[a-z0-9]+", folded)
+    if not words:
+        return False
+    if folded.startswith(_FOLLOW_UP_OPENERS) or any(w in _FOLLOW_UP_WORDS for w in words):
+        return True
+    content = [w for w in words if len(w) > 2 and w not in _STOPWORDS]
+    return len(content) <= settings.CHAT_MEMORY_FOLLOW_UP_MAX_WORDS
+
+
+def working_set_for(chat_id: int | None, question: str) -> dict | None:
+    """
+    Conjunto de trabalho do chat para uma pergunta de seguimento: documentos citados nos ultimos
+    CHAT_MEMORY_TURNS turnos (mais recente primeiro), as paginas citadas e a ultima pergunta
+    completa ("anchor"). None = busca global.
+    """
+    if not settings.CHAT_MEMORY_ENABLED or chat_id is None or not looks_like_follow_up(question):
+        return None
+    with _lock:
+        memory = _memories.get(chat_id)
+        if memory is None:
+            return None
+        if time.monotonic() - memory.updated > settings.CHAT_MEMORY_TTL_SECONDS:
+            del _memories[chat_id]
+            return None
+        turns = [list(turn) for turn in reversed(memory.turns)]
+        anchor = memory.anchor
+        _stats["follow_ups"] += 1
+
+    sources: list[str] = []
+    chunks: list[tuple[str, int]] = []
+    for turn in turns:
+        for source, page in turn:
+            if source not in sources:
+                sources.append(source)
+            if (source, page) not in chunks:
+                chunks.append((source, page))
+    return {"sources": sources, "chunks": chunks, "anchor": anchor}
+
+
+def record_working_set_result(in_working_set: bool) -> None:
+    with _lock:
+        _stats["working_set_hits" if in_working_set else "global_fallbacks"] += 1
+
+
+def remember(chat_id: int | None, question: str, citations: list[dict]) -> None:
+    """Registra as citacoes da recuperacao de `question` como um turno da memoria do chat."""
+    if not settings.CHAT_MEMORY_ENABLED or chat_id is None:
+        return
+    best = max((float(c.get("score") or 0.0) for c in citations), default=0.0)
+    turn = []
+    for citation in citations:
+        if float(citation.get("score") or 0.0) < best * _RELEVANCE_RATIO:
+            continue
+        key = (str(citation.get("source") or ""), int(citation.get("page") or 0))
+        if key[0] and key not in turn:
+            turn.append(key)
+    if not turn:
+        # Busca sem resultado (ou conversa curta): mantem o assunto anterior.
+        return
+    with _lock:
+        memory = _memories.pop(chat_id, None) or _ChatMemory()
+        memory.turns.append(turn)
+        if not looks_like_follow_up(question):
+            memory.anchor = question
+        memory.updated = time.monotonic()
+        _memories[chat_id] = memory
+        while len(_memories) > max(settings.CHAT_MEMORY_MAX_CHATS, 1):
+            _memories.popitem(last=False)
+
+
+def forget_chat(chat_id: int) -> None:
+    with _lock:
+        _memories.pop(chat_id, None)
+
+
+def get_retrieval_memory_stats() -> dict:
+    with _lock:
+        return {"enabled": settings.CHAT_MEMORY_ENABLED, "chats": len(_memories), **_stats}
@@ -0,0 +1,178 @@
+import asyncio
+from collections.abc import AsyncIterator, Awaitable, Callable, Hashable
+from typing import Any
+
+
+class SingleFlight:
+    """
+    Chamadas concorrentes com a mesma chave compartilham uma unica execucao.
+    A execucao roda protegida (shield): se um dos interessados desiste, os outros continuam;
+    quando todos desistem, ela e cancelada.
+    """
+
+    def __init__(self):
+        self._inflight: dict[Hashable, asyncio.Task] = {}
+        self._waiters: dict[asyncio.Task, int] = {}
+        self.started = 0
+        self.coalesced = 0
+        self.abandoned = 0
+
+    @property
+    def in_flight(self) -> int:
+        return len(self._inflight)
+
+    def has(self, key: Hashable) -> bool:
+        return key in self._inflight
+
+    async def do(self, key: Hashable, fn: Callable[[], Awaitable[Any]]) -> Any:
+        task = self._inflight.get(key)
+        if task is None:
+            self.started += 1
+            task = asyncio.get_running_loop().create_task(fn())
+            self._inflight[key] = task
+            task.add_done_callback(lambda _t, k=key: self._drop(k, _t))
+        else:
+            self.coalesced += 1
+        self._waiters[task] = self._waiters.get(task, 0) + 1
+        try:
+            return await asyncio.shield(task)
+        except asyncio.CancelledError:
+            if task in self._waiters:
+                self._waiters[task] -= 1
+                if self._waiters[task] <= 0 and not task.done():
+                    # Ninguem mais espera: cancela e tira do mapa ja (novas chamadas comecam do zero).
+                    self.abandoned += 1
+                    task.cancel()
+                    if self._inflight.get(key) is task:
+                        del self._inflight[key]
+            raise
+        finally:
+            if task.done():
+                self._waiters.pop(task, None)
+
+    def _drop(self, key: Hashable, task: asyncio.Task) -> None:
+        self._waiters.pop(task, None)
+        if self._inflight.get(key) is task:
+            del self._inflight[key]
+        if not task.cancelled():
+            task.exception()  # evita "exception was never retrieved" quando ninguem aguardava
+
+
+class SharedStream:
+    """
+    Uma geracao em streaming com varios assinantes. `opener` devolve a resposta ja aberta
+    (com `sources`, `content`, `usage`, `sources_block()`, iteracao assincrona e `aclose()`);
+    os deltas ficam num buffer, entao quem chega depois recebe tudo desde o inicio.
+    Quando o ultimo assinante sai antes do fim, a geracao e cancelada.
+    """
+
+    def __init__(self, opener: Callable[[], Awaitable[Any]], on_finish: Callable[["SharedStream"], None]):
+        self._opener = opener
+        self._on_finish = on_finish
+        self.answer: Any = None
+        self.deltas: list[str] = []
+        self.done = False
+        self.error: BaseException | None = None
+        self.subscribers = 0
+        loop = asyncio.get_running_loop()
+        self._opened: asyncio.Future = loop.create_future()
+        self._signal = asyncio.Event()
+        self._task = loop.create_task(self._pump())
+
+    async def _pump(self) -> None:
+        try:
+            self.answer = await self._opener()
+            self._opened.set_result(None)
+            async for delta in self.answer:
+                self.deltas.append(delta)
+                self._notify()
+        except asyncio.CancelledError as exc:
+            self.error = exc
+            if not self._opened.done():
+                self._opened.cancel()
+            raise
+        except Exception as exc:  # noqa: BLE001
+            self.error = exc
+            if not self._opened.done():
+                self._opened.set_exception(exc)
+                self._opened.exception()  # marca como lida; assinantes recebem via wait_opened
+        finally:
+            self.done = True
+            self._notify()
+            if self.answer is not None:
+                await self.answer.aclose()
+            self._on_finish(self)
+
+    def _notify(self) -> None:
+        signal, self._signal = self._signal, asyncio.Event()
+        signal.set()
+
+    async def wait_opened(self) -> None:
+        await asyncio.shield(self._opened)
+
+    async def iter_from_start(self) -> AsyncIterator[str]:
+        index = 0
+        while True:
+            signal = self._signal
+            while index < len(self.deltas):
+                yield self.deltas[index]
+                index += 1
+            if self.done:
+                if self.error is not None:
+                    raise self.error
+                return
+            await signal.wait()
+
+    def add_open_callback(self, callback: Callable[[Any], None]) -> None:
+        """Chama `callback(answer)` quando a resposta compartilhada abrir (nada se a abertura falhar)."""
+        self._opened.add_done_callback(
+            lambda f: None if f.cancelled() or f.exception() is not None else callback(self.answer)
+        )
+
+    def subscribe(self) -> "StreamSubscription":
+        self.subscribers += 1
+        return StreamSubscription(self)
+
+    def unsubscribe(self) -> None:
+        self.subscribers -= 1
+        if self.subscribers <= 0 and not self.done:
+            self._task.cancel()
+
+
+class StreamSubscription:
+    """Visao de um assinante sobre um SharedStream, com a mesma interface da resposta original."""
+
+    def __init__(self, shared: SharedStream):
+        self._shared = shared
+        self._closed = False
+
+    @property
+    def sources(self) -> list[dict]:
+        return self._shared.answer.sources if self._shared.answer is not None else []
+
+    @property
+    def content(self) -> str | None:
+        return self._shared.answer.content if self._shared.answer is not None else None
+
+    @property
+    def usage(self) -> dict | None:
+        return self._shared.answer.usage if self._shared.answer is not None else None
+
+    def sources_block(self) -> str:
+        return self._shared.answer.sources_block()
+
+    async def open(self) -> "StreamSubscription":
+        try:
+            await self._shared.wait_opened()
+        except BaseException:
+            await self.aclose()
+            raise
+        return self
+
+    def __aiter__(self) -> AsyncIterator[str]:
+        return self._shared.iter_from_start()
+
+    async def aclose(self) -> None:
+        if not self._closed:
+            self._closed = True
+            self._shared.unsubscribe()
@@ -0,0 +1,193 @@
+import asyncio
+import json
+import uuid
+from collections import deque
+from collections.abc import AsyncIterator, Awaitable, Callable
+from typing import Any
+
+from app.core.config import settings
+from app.services.deadline import Deadline
+
+
+class StreamNotFoundError(Exception):
+    """Stream desconhecido, de outro usuario ou ja descartado."""
+
+
+class StreamOffsetExpiredError(Exception):
+    """O ponto de retomada ja saiu do buffer circular; o cliente deve recarregar a conversa."""
+
+
+class ResumableStream:
+    """
+    Uma geracao em streaming que sobrevive a quedas do cliente. Os eventos (meta, delta,
+    sources, done/error) recebem ids sequenciais e ficam num buffer circular limitado
+    (STREAM_BUFFER_EVENTS); quem reconecta informa o ultimo id recebido (Last-Event-ID) e
+    recebe so o que falta. A geracao roda numa tarefa propria e a resposta e gravada uma unica
+    vez por ela (`on_complete`), entao reconexoes nao geram de novo nem duplicam mensagens.
+    Sem nenhum cliente conectado por STREAM_RESUME_GRACE_SECONDS, a geracao e cancelada.
+    """
+
+    def __init__(
+        self,
+        stream_id: str,
+        chat_id: int,
+        user_id: int,
+        answer: Any,
+        on_complete: Callable[[str], Awaitable[int | None]],
+        deadline: Deadline,
+    ):
+        self.id = stream_id
+        self.chat_id = chat_id
+        self.user_id = user_id
+        self.answer = answer
+        self.deadline = deadline
+        self.done = False
+        self.subscribers = 0
+        self._events: deque[tuple[int, str, str]] = deque(maxlen=max(settings.STREAM_BUFFER_EVENTS, 16))
+        self._last_id = 0
+        self._signal = asyncio.Event()
+        self._on_complete = on_complete
+        self._idle_timer: asyncio.TimerHandle | None = None
+        self._append("meta", {"stream_id": stream_id, "chat_id": chat_id, "sources": answer.sources})
+        self._task = asyncio.get_running_loop().create_task(self._pump())
+
+    def _append(self, event: str, data: dict) -> None:
+        self._last_id += 1
+        self._events.append((self._last_id, event, json.dumps(data, ensure_ascii=False)))
+        signal, self._signal = self._signal, asyncio.Event()
+        signal.set()
+
+    async def _consume(self) -> None:
+        async for delta in self.answer:
+            self._append("delta", {"text": delta})
+
+    async def _pump(self) -> None:
+        try:
+            await self.deadline.wait(self._consume(), "stream")
+            message_id = await self._on_complete(self.answer.content)
+            sources_block = self.answer.sources_block()
+            if sources_block:
+                self._append("sources", {"text": "\n\n" + sources_block})
+            self._append("done", {"message_id": message_id})
+        except asyncio.CancelledError:
+            self._append("error", {"detail": "Geracao cancelada"})
+            raise
+        except Exception as exc:  # noqa: BLE001
+            self._append("error", {"detail": str(exc)})
+        finally:
+            self.done = True
+            self._cancel_idle_timer()
+            await self.answer.aclose()
+            _schedule_removal(self)
+
+    @property
+    def first_buffered_id(self) -> int:
+        return self._events[0][0] if self._events else self._last_id + 1
+
+    def ensure_resumable(self, last_event_id: int) -> None:
+        if last_event_id + 1 < self.first_buffered_id or last_event_id > self._last_id:
+            raise StreamOffsetExpiredError()
+
+    async def events_after(self, last_event_id: int) -> AsyncIterator[tuple[int, str, str]]:
+        """Eventos com id > last_event_id, ja no buffer e os proximos, ate o fim da geracao."""
+        self.ensure_resumable(last_event_id)
+        cursor = last_event_id
+        while True:
+            signal = self._signal
+            if cursor + 1 < self.first_buffered_id:
+                # Leitor lento demais: o buffer circular ja descartou eventos que ele nao viu.
+                raise StreamOffsetExpiredError()
+            for event in list(self._events):
+                if event[0] > cursor:
+                    cursor = event[0]
+                    yield event
+            if self.done and cursor >= self._last_id:
+                return
+            await signal.wait()
+
+    def subscribe(self, resumed: bool = False) -> None:
+        global _resumes
+        self.subscribers += 1
+        if resumed:
+            _resumes += 1
+        self._cancel_idle_timer()
+
+    def unsubscribe(self) -> None:
+        self.subscribers -= 1
+        if self.subscribers <= 0 and not self.done:
+            # Ninguem ouvindo: espera um pouco por uma reconexao antes de abandonar a geracao.
+            self._idle_timer = asyncio.get_running_loop().call_later(
+                settings.STREAM_RESUME_GRACE_SECONDS, self._abandon_if_idle
+            )
+
+    def _abandon_if_idle(self) -> None:
+        self._idle_timer = None
+        if self.subscribers <= 0 and not self.done:
+            print(f"[stream] {self.id}: nenhum cliente reconectou; geracao cancelada")
+            self._task.cancel()
+
+    def _cancel_idle_timer(self) -> None:
+        if self._idle_timer is not None:
+            self._idle_timer.cancel()
+            self._idle_timer = None
+
+
+_streams: dict[str, ResumableStream] = {}
+_active_by_chat: dict[int, str] = {}
+_resumes = 0
+
+
+def _schedule_removal(stream: ResumableStream) -> None:
+    if _active_by_chat.get(stream.chat_id) == stream.id:
+        del _active_by_chat[stream.chat_id]
+
+    def remove() -> None:
+        if _streams.get(stream.id) is stream:
+            del _streams[stream.id]
+
+    # Terminado, ainda fica disponivel um tempo para quem caiu perto do fim.
+    asyncio.get_running_loop().call_later(settings.STREAM_RETENTION_SECONDS, remove)
+
+
+def start_stream(
+    chat_id: int,
+    user_id: int,
+    answer: Any,
+    on_complete: Callable[[str], Awaitable[int | None]],
+    deadline: Deadline,
+) -> ResumableStream:
+    """Registra e inicia a geracao de `answer` (ja aberta), limitada ao prazo da pergunta."""
+    stream = ResumableStream(uuid.uuid4().hex, chat_id, user_id, answer, on_complete, deadline)
+    _streams[stream.id] = stream
+    _active_by_chat[chat_id] = stream.id
+    return stream
+
+
+def get_stream(stream_id: str, user_id: int) -> ResumableStream:
+    stream = _streams.get(stream_id)
+    if stream is None or stream.user_id != user_id:
+        raise StreamNotFoundError()
+    return stream
+
+
+def active_stream_for_chat(chat_id: int) -> ResumableStream | None:
+    stream_id = _active_by_chat.get(chat_id)
+    stream = _streams.get(stream_id) if stream_id else None
+    return stream if stream is not None and not stream.done else None
+
+
+def format_sse(event_id: int, event: str, data: str) -> str:
+    return f"id: {event_id}\nevent: {event}\ndata: {data}\n\n"
+
+
+def get_stream_stats() -> dict:
+    streams = list(_streams.values())
+    return {
+        "active": sum(1 for s in streams if not s.done),
+        "retained": sum(1 for s in streams if s.done),
+        "detached": sum(1 for s in streams if not s.done and s.subscribers <= 0),
+        "resumes": _resumes,
+        "buffer_events": settings.STREAM_BUFFER_EVENTS,
+        "resume_grace_s": settings.STREAM_RESUME_GRACE_SECONDS,
+        "retention_s": settings.STREAM_RETENTION_SECONDS,
+    }
@@ -0,0 +1,182 @@
+import threading
+import time
+from collections import defaultdict
+from datetime import datetime, timedelta
+
+from sqlalchemy import func
+from sqlalchemy.exc import OperationalError
+from sqlalchemy.orm import Session
+
+from app.core.config import settings
+from app.db.session import SessionLocal
+from app.models import LLMUsage
+
+# As chamadas ao LLM so empilham a linha em memoria; um worker grava em lote a cada
+# USAGE_LEDGER_FLUSH_SECONDS, sem abrir sessao no caminho da resposta.
+_buffer: list[dict] = []
+_lock = threading.Lock()
+_wake = threading.Event()
+_worker: threading.Thread | None = None
+_last_purge = 0.0
+_PURGE_INTERVAL_SECONDS = 3600
+
+
+def record_llm_usage(
+    kind: str,
+    *,
+    usage: dict | None,
+    latency_s: float,
+    ttft_s: float | None = None,
+    status: str = "ok",
+    answer_mode: str | None = None,
+    chat_id: int | None = None,
+    user_id: int | None = None,
+) -> None:
+    """Registra uma chamada ao LLM no ledger (usage no formato normalizado do generator)."""
+    global _worker
+    if not settings.USAGE_LEDGER_ENABLED:
+        return
+    usage = usage or {}
+    row = {
+        "created_at": datetime.utcnow(),
+        "kind": kind,
+        "status": status,
+        "user_id": user_id,
+        "chat_id": chat_id,
+        "answer_mode": answer_mode,
+        "model": usage.get("model"),
+        "prompt_tokens": usage.get("prompt_tokens"),
+        "completion_tokens": usage.get("completion_tokens"),
+        "cached_tokens": usage.get("cached_tokens"),
+        "latency_ms": round(latency_s * 1000, 1),
+        "ttft_ms": round(ttft_s * 1000, 1) if ttft_s is not None else None,
+    }
+    with _lock:
+        _buffer.append(row)
+        if _worker is None:
+            _worker = threading.Thread(target=_run_worker, daemon=True, name="athena-usage-ledger")
+            _worker.start()
+
+
+def _purge_expired(db: Session) -> None:
+    global _last_purge
+    now = time.monotonic()
+    if settings.USAGE_LEDGER_RETENTION_DAYS <= 0 or now - _last_purge < _PURGE_INTERVAL_SECONDS:
+        return
+    _last_purge = now
+    cutoff = datetime.utcnow() - timedelta(days=settings.USAGE_LEDGER_RETENTION_DAYS)
+    db.query(LLMUsage).filter(LLMUsage.created_at < cutoff).delete(synchronize_session=False)
+
+
+def flush_usage_ledger() -> int:
+    """Grava as linhas pendentes; devolve quantas foram gravadas."""
+    with _lock:
+        rows = list(_buffer)
+        _buffer.clear()
+    if not rows:
+        return 0
+    db = SessionLocal()
+    try:
+        db.bulk_insert_mappings(LLMUsage, rows)
+        _purge_expired(db)
+        db.commit()
+        return len(rows)
+    except Exception as exc:  # noqa: BLE001
+        db.rollback()
+        print(f"[usage-ledger] Falha ao gravar {len(rows)} registros: {exc}")
+        return 0
+    finally:
+        db.close()
+
+
+def _run_worker() -> None:
+    while True:
+        _wake.wait(max(settings.USAGE_LEDGER_FLUSH_SECONDS, 0.1))
+        _wake.clear()
+        flush_usage_ledger()
+
+
+def _percentile(values: list[float], q: float) -> float | None:
+    if not values:
+        return None
+    values = sorted(values)
+    return values[min(int(len(values) * q), len(values) - 1)]
+
+
+def _aggregate(db: Session, column, since: datetime) -> list[dict]:
+    rows = (
+        db.query(
+            column.label("key"),
+            func.count(LLMUsage.id),
+            func.coalesce(func.sum(LLMUsage.prompt_tokens), 0),
+            func.coalesce(func.sum(LLMUsage.completion_tokens), 0),
+            func.coalesce(func.sum(LLMUsage.cached_tokens), 0),
+            func.avg(LLMUsage.latency_ms),
+            func.sum(LLMUsage.status == "cancelled"),
+        )
+        .filter(LLMUsage.created_at >= since)
+        .group_by(column)
+        .order_by(column)
+        .all()
+    )
+    return [
+        {
+            "key": key,
+            "requests": count,
+            "prompt_tokens": int(prompt),
+            "completion_tokens": int(completion),
+            "cached_tokens": int(cached),
+            "total_tokens": int(prompt) + int(completion),
+            "latency_ms_avg": round(latency, 1) if latency is not None else None,
+            "cancelled": int(cancelled or 0),
+        }
+        for key, count, prompt, completion, cached, latency, cancelled in rows
+    ]
+
+
+def _percentiles(rows: list[tuple]) -> dict:
+    prompt = [r[0] for r in rows if r[0] is not None]
+    completion = [r[1] for r in rows if r[1] is not None]
+    total = [r[0] + r[1] for r in rows if r[0] is not None and r[1] is not None]
+    return {
+        "samples": len(rows),
+        "prompt_tokens_p95": _percentile(prompt, 0.95),
+        "completion_tokens_p95": _percentile(completion, 0.95),
+        "total_tokens_p95": _percentile(total, 0.95),
+        "latency_ms_p50": _percentile([r[2] for r in rows], 0.5),
+        "latency_ms_p95": _percentile([r[2] for r in rows], 0.95),
+    }
+
+
+def get_usage_report(db: Session, days: int) -> dict:
+    """Consumo dos ultimos `days` dias: totais por dia, modo, modelo e tipo de chamada, e p95."""
+    flush_usage_ledger()
+    since = datetime.utcnow() - timedelta(days=days)
+    try:
+        by_day = _aggregate(db, func.date(LLMUsage.created_at), since)
+        by_mode = _aggregate(db, LLMUsage.answer_mode, since)
+        by_model = _aggregate(db, LLMUsage.model, since)
+        by_kind = _aggregate(db, LLMUsage.kind, since)
+        samples = (
+            db.query(LLMUsage.prompt_tokens, LLMUsage.completion_tokens, LLMUsage.latency_ms, LLMUsage.answer_mode)
+            .filter(LLMUsage.created_at >= since, LLMUsage.status == "ok")
+            .all()
+        )
+    except OperationalError:
+        # Banco sem a migracao 0005 ainda.
+        by_day, by_mode, by_model, by_kind, samples = [], [], [], [], []
+
+    per_mode: dict[str | None, list[tuple]] = defaultdict(list)
+    for row in samples:
+        per_mode[row[3]].append(row)
+    return {
+        "enabled": settings.USAGE_LEDGER_ENABLED,
+        "days": days,
+        "since": since.isoformat(),
+        "by_day": by_day,
+        "by_mode": by_mode,
+        "by_model": by_model,
+        "by_kind": by_kind,
+        "percentiles": _percentiles(samples),
+        "percentiles_by_mode": [{"key": mode, **_percentiles(rows)} for mode, rows in sorted(per_mode.items(), key=lambda x: str(x[0]))],
+    }
@@ -0,0 +1,5 @@
+import sys
+from pathlib import Path
+
+# Os testes importam o pacote `app` a partir de backend/ (mesmo layout do uvicorn app.main:app).
+sys.path.insert(0, str(Path(__file__).resolve().parents[1]))
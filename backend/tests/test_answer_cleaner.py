@@ -0,0 +1,93 @@
+import random
+import re
+
+import pytest
+
+from app.services.generator import _DOC_META_RE, _XYZ_RE, AnswerCleaner
+
+
+# Referencia: limpeza em duas passadas anterior ao AnswerCleaner (texto inteiro, sem stream).
+def _clean_response_text(text: str) -> str:
+    lines = [ln.rstrip() for ln in (text or "").splitlines()]
+    cleaned: list[str] = []
+    seen = set()
+
+    for ln in lines:
+        stripped = ln.strip()
+        if not stripped:
+            if cleaned and cleaned[-1] != "":
+                cleaned.append("")
+            continue
+        if _XYZ_RE.search(stripped):
+            continue
+        key = re.sub(r"\s+", " ", stripped.lower())
+        if key in seen:
+            continue
+        seen.add(key)
+        cleaned.append(stripped)
+
+    while cleaned and cleaned[-1] == "":
+        cleaned.pop()
+
+    return "\n".join(cleaned).strip()
+
+
+def _remove_document_metadata(answer: str) -> str:
+    lines = [ln.rstrip() for ln in (answer or "").splitlines()]
+    kept: list[str] = []
+    for ln in lines:
+        if _DOC_META_RE.search(ln):
+            continue
+        kept.append(ln)
+    return "\n".join(kept).strip()
+
+
+def _reference(text: str, strip_document_metadata: bool) -> str:
+    cleaned = _clean_response_text(text)
+    return _remove_document_metadata(cleaned) if strip_document_metadata else cleaned
+
+
+def _streamed(text: str, strip_document_metadata: bool, rng: random.Random) -> str:
+    cleaner = AnswerCleaner(strip_document_metadata)
+    out, position = [], 0
+    while position < len(text):
+        size = rng.randint(1, 5)
+        out.append(cleaner.feed(text[position : position + size]))
+        position += size
+    out.append(cleaner.flush())
+    return "".join(out)
+
+
+ANSWERS = [
+    # Linhas em branco dos dois lados do metadado removido continuam (duas passadas nao recolhem).
+    "Resumo executivo\n\nSHA256: 9f2c\n\nValores e pagamento",
+    "Resumo executivo\n\nSHA256: 9f2c\n\nClicksign 4411-aa\n\nValores e pagamento",
+    "Resumo executivo\nAssinaturas: Ana, Joao\n\nValores e pagamento",
+    "Resumo executivo\n\nDocumento número 123\nValores e pagamento",
+    "Clicksign 4411-aa\n\nResumo executivo\n\nValores",
+    "Resumo executivo\n\nValores\n\nhash do documento: abc\n\n",
+    "Resumo\r\n\r\nsha256 abc\r\n\r\n\r\nPrazos\r\nsha256 abc\r\n\r\nPrazos",
+    "Resumo\n\npaginação XYZ\n\nsha256 abc\n\n\n\nPrazos",
+    "  Resumo  \n \t \nAssinaturas: x\n  \nPrazos\x0cassinatura: y\x85Fim",
+]
+
+
+@pytest.mark.parametrize("strip_document_metadata", [False, True])
+@pytest.mark.parametrize("answer", ANSWERS)
+def test_matches_previous_two_pass_cleanup(answer, strip_document_metadata):
+    expected = _reference(answer, strip_document_metadata)
+
+    assert AnswerCleaner(strip_document_metadata).clean(answer) == expected
+    assert _streamed(answer, strip_document_metadata, random.Random(7)) == expected
+
+
+def test_matches_previous_cleanup_on_random_answers():
+    rng = random.Random(2024)
+    pieces = ["A", "B", " B ", "Texto C", "sha256: abc", "Clicksign 123", "Assinaturas: x", "paginação XYZ", "", " ", "\t"]
+    breaks = ["\n", "\r\n", "\r", "\n\n", "\x0c", "\x85", " "]
+    for _ in range(2000):
+        answer = "".join(rng.choice(pieces) + rng.choice(breaks) for _ in range(rng.randint(0, 8)))
+        for strip_document_metadata in (False, True):
+            expected = _reference(answer, strip_document_metadata)
+            assert AnswerCleaner(strip_document_metadata).clean(answer) == expected, repr(answer)
+            assert _streamed(answer, strip_document_metadata, rng) == expected, repr(answer)
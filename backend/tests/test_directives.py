@@ -0,0 +1,47 @@
+import numpy as np
+
+from app.services import directives
+
+
+def _index() -> dict:
+    return {
+        "applied": 3,
+        "global": ["Responda em portugues."],
+        "global_tokens": 4,
+        "texts": ["Cite a pagina da politica de viagens.", "Explique o fluxo de compras."],
+        "tokens": [8, 6],
+        "matrix": np.eye(2, dtype=np.float32),
+        "baseline_tokens": 18,
+    }
+
+
+def _fail_encode(questions):
+    raise AssertionError("a pergunta nao deveria ser codificada de novo")
+
+
+def test_select_directives_reuses_the_query_vector(monkeypatch):
+    monkeypatch.setattr(directives, "load_directive_index", _index)
+    monkeypatch.setattr(directives, "encode_queries", _fail_encode)
+    monkeypatch.setattr(directives.settings, "FEEDBACK_DIRECTIVES_MIN_SCORE", 0.5)
+
+    global_directives, relevant = directives.select_directives(
+        "posso reembolsar a viagem?", np.array([1.0, 0.0], dtype=np.float32)
+    )
+
+    assert global_directives == ["Responda em portugues."]
+    assert relevant == ["Cite a pagina da politica de viagens."]
+
+
+def test_select_directives_batch_uses_one_row_per_question(monkeypatch):
+    monkeypatch.setattr(directives, "load_directive_index", _index)
+    monkeypatch.setattr(directives, "encode_queries", _fail_encode)
+    monkeypatch.setattr(directives.settings, "FEEDBACK_DIRECTIVES_MIN_SCORE", 0.5)
+
+    selected = directives.select_directives_batch(
+        ["viagem?", "compras?"], np.array([[1.0, 0.0], [0.0, 1.0]], dtype=np.float32)
+    )
+
+    assert [relevant for _, relevant in selected] == [
+        ["Cite a pagina da politica de viagens."],
+        ["Explique o fluxo de compras."],
+    ]
@@ -0,0 +1,53 @@
+import numpy as np
+
+from app.services.embeddings import _format_relevant_chunks, _scored_matches
+
+SHARED = "Multa de 10% sobre o valor do contrato em caso de atraso na entrega dos servicos."
+
+
+def _index() -> dict:
+    """Indice com um trecho (canonico 0) que aparece em dois contratos e outros dois trechos."""
+    items = [
+        {
+            "text": SHARED,
+            "occurrences": [
+                {"source": "CONTRATO_ALFA.pdf", "page": 4, "order": 12},
+                {"source": "CONTRATO_BETA.pdf", "page": 7, "order": 30},
+            ],
+        },
+        {"text": "Prazo de vigencia de 12 meses.", "occurrences": [{"source": "CONTRATO_ALFA.pdf", "page": 1, "order": 2}]},
+        {"text": "Pagamento em 30 dias.", "occurrences": [{"source": "CONTRATO_BETA.pdf", "page": 2, "order": 5}]},
+    ]
+    return {"items": items, "matrix": np.eye(3, dtype=np.float32)}
+
+
+def test_cluster_spanning_two_sources_counts_once_towards_k():
+    matches = _scored_matches(_index(), np.array([0.9, 0.5, 0.4], dtype=np.float32), k=2)
+
+    assert len(matches) == 2
+    assert matches[0]["source"] == "CONTRATO_ALFA.pdf"
+    assert matches[0]["duplicates"] == [{"source": "CONTRATO_BETA.pdf", "page": 7, "order": 30}]
+
+
+def test_preferred_source_relabels_the_shared_chunk():
+    matches = _scored_matches(
+        _index(), np.array([0.9, 0.5, 0.4], dtype=np.float32), k=3, prefer_sources={"CONTRATO_BETA.pdf"}
+    )
+
+    shared = matches[0]
+    assert (shared["source"], shared["page"], shared["order"]) == ("CONTRATO_BETA.pdf", 7, 30)
+    assert shared["duplicates"] == [{"source": "CONTRATO_ALFA.pdf", "page": 4, "order": 12}]
+    assert len(matches) == 3
+
+
+def test_question_naming_second_document_cites_it():
+    matches = _scored_matches(_index(), np.array([0.9, 0.5, 0.4], dtype=np.float32), k=3)
+
+    context, citations = _format_relevant_chunks(
+        "qual a multa do documento contrato beta?", matches, max_chars=4000, max_per_source=2, mode="qa"
+    )
+
+    assert SHARED in context
+    assert "Documento: CONTRATO_BETA.pdf | Pagina 7" in context
+    assert {"source": "CONTRATO_BETA.pdf", "page": 7} in [{"source": c["source"], "page": c["page"]} for c in citations]
+    assert all(c["source"] == "CONTRATO_BETA.pdf" for c in citations)
@@ -0,0 +1,23 @@
+import csv
+import io
+from types import SimpleNamespace
+
+from app.routes import admin
+
+
+def _upload(data: bytes) -> SimpleNamespace:
+    return SimpleNamespace(file=io.BytesIO(data))
+
+
+def test_only_newline_splits_rows(monkeypatch):
+    # Blocos de 7 bytes: quebras de linha e caracteres multibyte caem na fronteira dos blocos.
+    monkeypatch.setattr(admin, "UPLOAD_CHUNK_BYTES", 7)
+    data = "email,full_name\r\na@x.com,Ana\x0cMaria\r\nb@x.com,Jo ão\x85Silva\x1eJr\nc@x.com,Caio".encode()
+
+    lines = list(admin.iter_upload_lines(_upload(data)))
+    rows = list(csv.DictReader(lines))
+
+    assert len(lines) == 4
+    assert [r["email"] for r in rows] == ["a@x.com", "b@x.com", "c@x.com"]
+    assert rows[0]["full_name"] == "Ana\x0cMaria"
+    assert rows[1]["full_name"] == "Jo ão\x85Silva\x1eJr"
@@ -0,0 +1,80 @@
+"""
+Roda um lote de perguntas pelo endpoint /admin/ask/batch e grava o JSONL de respostas.
+
+Uso (a partir de backend/):
+    python -m tools.batch_ask perguntas.txt --email admin@athena.com --password change-me -o respostas.jsonl
+
+O arquivo de entrada tem uma pergunta por linha (ou JSONL com o campo "question").
+"""
+
+import argparse
+import json
+import sys
+import time
+
+import httpx
+
+
+def read_questions(path: str) -> list[str]:
+    questions: list[str] = []
+    with open(path, encoding="utf-8") as handle:
+        for line in handle:
+            line = line.strip()
+            if not line:
+                continue
+            if line.startswith("{"):
+                questions.append(str(json.loads(line).get("question") or ""))
+            else:
+                questions.append(line)
+    return questions
+
+
+def parse_args(argv: list[str] | None = None) -> argparse.Namespace:
+    parser = argparse.ArgumentParser(description="Perguntas em lote para a API ATHENA (JSONL).")
+    parser.add_argument("questions_file")
+    parser.add_argument("--base-url", default="http://127.0.0.1:8000")
+    parser.add_argument("--api-prefix", default="/api/v1")
+    parser.add_argument("--email", required=True)
+    parser.add_argument("--password", required=True)
+    parser.add_argument("--concurrency", type=int, help="Geracoes simultaneas (padrao: BATCH_LLM_CONCURRENCY)")
+    parser.add_argument("-o", "--output", help="Arquivo JSONL de saida (padrao: stdout)")
+    parser.add_argument("--timeout", type=float, default=3600.0)
+    return parser.parse_args(argv)
+
+
+def main(argv: list[str] | None = None) -> None:
+    args = parse_args(argv)
+    questions = read_questions(args.questions_file)
+    api = args.base_url.rstrip("/") + args.api_prefix
+
+    with httpx.Client(timeout=httpx.Timeout(args.timeout, connect=10.0)) as client:
+        login = client.post(f"{api}/auth/login", json={"email": args.email, "password": args.password})
+        login.raise_for_status()
+        client.headers["Authorization"] = "Bearer " + login.json()["data"]["token"]["access_token"]
+
+        output = open(args.output, "w", encoding="utf-8") if args.output else sys.stdout
+        started = time.perf_counter()
+        done = errors = 0
+        try:
+            body = {"questions": questions, "concurrency": args.concurrency}
+            with client.stream("POST", f"{api}/admin/ask/batch", json=body) as response:
+                if response.status_code != 200:
+                    response.read()
+                    sys.exit(f"Erro {response.status_code}: {response.text}")
+                for line in response.iter_lines():
+                    if not line:
+                        continue
+                    output.write(line + "\n")
+                    output.flush()
+                    done += 1
+                    errors += json.loads(line).get("error") is not None
+                    print(f"\r{done}/{len(questions)} respondidas ({errors} com erro)", end="", file=sys.stderr)
+        finally:
+            if output is not sys.stdout:
+                output.close()
+        elapsed = time.perf_counter() - started
+        print(f"\n{done} perguntas em {elapsed:.1f}s ({done / elapsed:.2f}/s)", file=sys.stderr)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,212 @@
+"""
+Teste de carga ponta a ponta: usuarios virtuais fazem login, criam um chat e perguntam
+(/ask e /ask/stream) em laco. Ao final imprime, por endpoint, vazao, latencia p50/p95/p99 e TTFB.
+
+Uso (a partir de backend/, com a API rodando contra o mock ou o LM Studio real):
+    python -m tools.loadtest --base-url http://127.0.0.1:8000 --email admin@athena.local \
+        --password admin123 --users 20 --duration 60 --stream-ratio 0.7
+
+O limite por IP (RATE_LIMIT_MAX_REQUESTS) vale para todos os usuarios virtuais juntos:
+aumente-o na API durante o teste para nao medir apenas respostas 429.
+"""
+
+import argparse
+import asyncio
+import json
+import random
+import time
+from collections import defaultdict
+from dataclasses import dataclass, field
+
+import httpx
+
+DEFAULT_QUESTIONS = [
+    "Qual e o limite do cartao corporativo?",
+    "Como funciona o reembolso de despesas de viagem?",
+    "Quantos dias de home office sao permitidos por semana?",
+    "Qual o prazo para solicitar ferias?",
+    "Quem aprova compras acima do limite?",
+    "Oi, tudo bem?",
+]
+
+
+@dataclass
+class EndpointStats:
+    latencies: list[float] = field(default_factory=list)
+    ttfb: list[float] = field(default_factory=list)
+    statuses: dict[int, int] = field(default_factory=lambda: defaultdict(int))
+    errors: int = 0
+
+
+def _percentile(values: list[float], pct: float) -> float:
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    index = min(int(round(pct / 100 * (len(ordered) - 1))), len(ordered) - 1)
+    return ordered[index]
+
+
+class LoadTest:
+    def __init__(self, args: argparse.Namespace, questions: list[str]):
+        self.args = args
+        self.questions = questions
+        self.api = args.base_url.rstrip("/") + args.api_prefix
+        self.stats: dict[str, EndpointStats] = defaultdict(EndpointStats)
+        self.deadline = 0.0
+
+    def _record(self, endpoint: str, started: float, first_byte: float | None, status: int | None) -> None:
+        stats = self.stats[endpoint]
+        now = time.perf_counter()
+        if status is None:
+            stats.errors += 1
+            return
+        stats.statuses[status] += 1
+        if status < 400:
+            stats.latencies.append(now - started)
+            if first_byte is not None:
+                stats.ttfb.append(first_byte - started)
+
+    async def _request(self, client: httpx.AsyncClient, endpoint: str, method: str, path: str, **kwargs) -> httpx.Response | None:
+        started = time.perf_counter()
+        try:
+            response = await client.request(method, self.api + path, **kwargs)
+        except httpx.HTTPError as exc:
+            self._record(endpoint, started, None, None)
+            if self.args.verbose:
+                print(f"[loadtest] {endpoint}: {exc!r}")
+            return None
+        # Respostas nao-streaming: o TTFB e o proprio tempo total.
+        self._record(endpoint, started, time.perf_counter(), response.status_code)
+        return response
+
+    async def _stream(self, client: httpx.AsyncClient, path: str, payload: dict) -> None:
+        started = time.perf_counter()
+        first_byte = None
+        status = None
+        try:
+            async with client.stream("POST", self.api + path, json=payload) as response:
+                status = response.status_code
+                async for chunk in response.aiter_bytes():
+                    if chunk and first_byte is None:
+                        first_byte = time.perf_counter()
+        except httpx.HTTPError as exc:
+            status = None
+            if self.args.verbose:
+                print(f"[loadtest] ask_stream: {exc!r}")
+        self._record("ask_stream", started, first_byte, status)
+
+    async def virtual_user(self, index: int) -> None:
+        timeout = httpx.Timeout(self.args.timeout, connect=10.0)
+        async with httpx.AsyncClient(timeout=timeout) as client:
+            await asyncio.sleep(random.uniform(0, self.args.ramp_up))
+            response = await self._request(
+                client, "login", "POST", "/auth/login",
+                json={"email": self.args.email, "password": self.args.password},
+            )
+            if response is None or response.status_code != 200:
+                print(f"[loadtest] usuario {index}: login falhou ({response.status_code if response else 'erro'})")
+                return
+            token = response.json()["data"]["token"]["access_token"]
+            client.headers["Authorization"] = f"Bearer {token}"
+
+            response = await self._request(client, "create_chat", "POST", "/chats", json={"title": f"loadtest {index}"})
+            if response is None or response.status_code != 200:
+                print(f"[loadtest] usuario {index}: criacao de chat falhou")
+                return
+            chat_id = response.json()["data"]["id"]
+
+            asked = 0
+            while time.perf_counter() < self.deadline:
+                if self.args.questions_per_user and asked >= self.args.questions_per_user:
+                    break
+                payload = {"question": random.choice(self.questions)}
+                if random.random() < self.args.stream_ratio:
+                    await self._stream(client, f"/chats/{chat_id}/ask/stream", payload)
+                else:
+                    await self._request(client, "ask", "POST", f"/chats/{chat_id}/ask", json=payload)
+                asked += 1
+                if self.args.think_time:
+                    await asyncio.sleep(random.expovariate(1 / self.args.think_time))
+
+            if not self.args.keep_chats:
+                await self._request(client, "delete_chat", "DELETE", f"/chats/{chat_id}")
+
+    async def run(self) -> float:
+        started = time.perf_counter()
+        self.deadline = started + self.args.ramp_up + self.args.duration
+        await asyncio.gather(*(self.virtual_user(i) for i in range(self.args.users)))
+        return time.perf_counter() - started
+
+    def report(self, elapsed: float) -> dict:
+        rows = {}
+        for endpoint, stats in self.stats.items():
+            ok = len(stats.latencies)
+            rows[endpoint] = {
+                "requests": sum(stats.statuses.values()) + stats.errors,
+                "ok": ok,
+                "statuses": dict(sorted(stats.statuses.items())),
+                "network_errors": stats.errors,
+                "throughput_rps": round(ok / elapsed, 2) if elapsed else 0.0,
+                "latency_ms": {
+                    f"p{p}": round(_percentile(stats.latencies, p) * 1000, 1) for p in (50, 95, 99)
+                },
+                "ttfb_ms": {f"p{p}": round(_percentile(stats.ttfb, p) * 1000, 1) for p in (50, 95, 99)},
+            }
+        return {"users": self.args.users, "elapsed_s": round(elapsed, 1), "endpoints": rows}
+
+
+def _print_table(result: dict) -> None:
+    print(f"\nUsuarios: {result['users']}  Duracao: {result['elapsed_s']}s")
+    header = f"{'endpoint':<12} {'req':>6} {'ok':>6} {'rps':>7} {'p50':>8} {'p95':>8} {'p99':>8} {'ttfb50':>8} {'ttfb95':>8}  status"
+    print(header)
+    print("-" * len(header))
+    for endpoint, row in result["endpoints"].items():
+        lat, ttfb = row["latency_ms"], row["ttfb_ms"]
+        statuses = " ".join(f"{code}:{count}" for code, count in row["statuses"].items())
+        if row["network_errors"]:
+            statuses += f" erro:{row['network_errors']}"
+        print(
+            f"{endpoint:<12} {row['requests']:>6} {row['ok']:>6} {row['throughput_rps']:>7} "
+            f"{lat['p50']:>8} {lat['p95']:>8} {lat['p99']:>8} {ttfb['p50']:>8} {ttfb['p95']:>8}  {statuses}"
+        )
+    print("(tempos em ms; latencia e TTFB consideram apenas respostas com status < 400)")
+
+
+def parse_args(argv: list[str] | None = None) -> argparse.Namespace:
+    parser = argparse.ArgumentParser(description="Teste de carga da API ATHENA.")
+    parser.add_argument("--base-url", default="http://127.0.0.1:8000")
+    parser.add_argument("--api-prefix", default="/api/v1")
+    parser.add_argument("--email", required=True)
+    parser.add_argument("--password", required=True)
+    parser.add_argument("--users", type=int, default=10, help="Usuarios virtuais simultaneos")
+    parser.add_argument("--duration", type=float, default=60.0, help="Segundos de carga apos o ramp-up")
+    parser.add_argument("--ramp-up", type=float, default=5.0, help="Segundos para todos os usuarios entrarem")
+    parser.add_argument("--questions-per-user", type=int, default=0, help="Para apos N perguntas (0 = ate o fim)")
+    parser.add_argument("--stream-ratio", type=float, default=0.5, help="Fracao das perguntas via /ask/stream")
+    parser.add_argument("--think-time", type=float, default=1.0, help="Pausa media entre perguntas (s)")
+    parser.add_argument("--timeout", type=float, default=120.0)
+    parser.add_argument("--questions-file", help="Arquivo com uma pergunta por linha")
+    parser.add_argument("--keep-chats", action="store_true", help="Nao apaga os chats criados")
+    parser.add_argument("--json", dest="json_out", help="Grava o relatorio em JSON neste caminho")
+    parser.add_argument("--verbose", action="store_true")
+    return parser.parse_args(argv)
+
+
+def main(argv: list[str] | None = None) -> None:
+    args = parse_args(argv)
+    questions = DEFAULT_QUESTIONS
+    if args.questions_file:
+        with open(args.questions_file, encoding="utf-8") as handle:
+            questions = [line.strip() for line in handle if line.strip()]
+
+    test = LoadTest(args, questions)
+    elapsed = asyncio.run(test.run())
+    result = test.report(elapsed)
+    _print_table(result)
+    if args.json_out:
+        with open(args.json_out, "w", encoding="utf-8") as handle:
+            json.dump(result, handle, indent=2)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,151 @@
+"""
+Servidor falso do LM Studio (/v1/responses) para testes de carga sem modelo real.
+
+Uso (a partir de backend/):
+    python -m tools.mock_lmstudio --port 1234 --tokens-per-second 40 --latency-ms 300 --error-rate 0.02
+
+Depois aponte a API para ele: LMSTUDIO_API_URL=http://127.0.0.1:1234/v1/responses
+"""
+
+import argparse
+import asyncio
+import json
+import random
+import time
+import uuid
+
+import uvicorn
+from fastapi import FastAPI, Request
+from fastapi.responses import JSONResponse, StreamingResponse
+
+DEFAULT_ANSWER = (
+    "De acordo com a politica consultada, o limite do cartao corporativo depende do cargo e da "
+    "aprovacao do gestor. Despesas acima do limite exigem autorizacao previa da diretoria e "
+    "devem ser registradas no sistema de reembolso em ate cinco dias uteis, com nota fiscal."
+)
+
+
+def _tokens(text: str) -> list[str]:
+    words = text.split(" ")
+    return [w + (" " if i < len(words) - 1 else "") for i, w in enumerate(words)]
+
+
+def create_app(args: argparse.Namespace) -> FastAPI:
+    app = FastAPI(title="mock-lmstudio")
+    stats = {"requests": 0, "streams": 0, "errors_injected": 0, "in_flight": 0}
+
+    def first_token_delay() -> float:
+        # Latencia ate o primeiro token (prefill) com cauda longa: lognormal em torno da mediana.
+        if args.latency_ms <= 0:
+            return 0.0
+        return random.lognormvariate(0, args.latency_sigma) * args.latency_ms / 1000
+
+    def answer_tokens(payload: dict) -> list[str]:
+        tokens = _tokens(args.text)
+        max_tokens = int(payload.get("max_tokens") or len(tokens))
+        return tokens[: max(max_tokens, 1)]
+
+    def usage(payload: dict, output_tokens: int) -> dict:
+        prompt_chars = sum(len(str(m.get("content") or "")) for m in payload.get("input") or [])
+        input_tokens = max(prompt_chars // 4, 1)
+        return {
+            "input_tokens": input_tokens,
+            "input_tokens_details": {"cached_tokens": int(input_tokens * args.cached_ratio)},
+            "output_tokens": output_tokens,
+            "total_tokens": input_tokens + output_tokens,
+        }
+
+    def inject_error() -> JSONResponse | None:
+        if random.random() < args.error_rate:
+            stats["errors_injected"] += 1
+            return JSONResponse(status_code=args.error_status, content={"error": "erro injetado pelo mock"})
+        return None
+
+    @app.get("/v1/models")
+    async def models():
+        return {"data": [{"id": args.model, "object": "model"}]}
+
+    @app.get("/mock/stats")
+    async def mock_stats():
+        return stats
+
+    @app.post("/v1/responses")
+    async def responses(request: Request):
+        payload = await request.json()
+        stats["requests"] += 1
+        error = inject_error()
+        if error is not None:
+            return error
+
+        tokens = answer_tokens(payload)
+        response_id = f"resp_{uuid.uuid4().hex[:12]}"
+        per_token = 1 / args.tokens_per_second if args.tokens_per_second > 0 else 0.0
+
+        if not payload.get("stream"):
+            stats["in_flight"] += 1
+            try:
+                await asyncio.sleep(first_token_delay() + per_token * len(tokens))
+            finally:
+                stats["in_flight"] -= 1
+            return {
+                "id": response_id,
+                "object": "response",
+                "created_at": int(time.time()),
+                "model": payload.get("model") or args.model,
+                "output": [{"type": "message", "role": "assistant", "content": [{"type": "output_text", "text": "".join(tokens)}]}],
+                "usage": usage(payload, len(tokens)),
+            }
+
+        stats["streams"] += 1
+
+        async def events():
+            stats["in_flight"] += 1
+            try:
+                await asyncio.sleep(first_token_delay())
+                for token in tokens:
+                    if args.drop_rate and random.random() < args.drop_rate / max(len(tokens), 1):
+                        # Simula queda do backend no meio da geracao.
+                        failed = {"type": "response.failed", "error": {"message": "queda simulada"}}
+                        yield f"event: response.failed\ndata: {json.dumps(failed)}\n\n"
+                        return
+                    delta = {"type": "response.output_text.delta", "output_index": 0, "delta": token}
+                    yield f"event: response.output_text.delta\ndata: {json.dumps(delta)}\n\n"
+                    if per_token:
+                        await asyncio.sleep(per_token)
+                completed = {
+                    "type": "response.completed",
+                    "response": {"id": response_id, "status": "completed", "usage": usage(payload, len(tokens))},
+                }
+                yield f"event: response.completed\ndata: {json.dumps(completed)}\n\n"
+            finally:
+                stats["in_flight"] -= 1
+
+        return StreamingResponse(events(), media_type="text/event-stream")
+
+    return app
+
+
+def parse_args(argv: list[str] | None = None) -> argparse.Namespace:
+    parser = argparse.ArgumentParser(description="Servidor falso do LM Studio (/v1/responses).")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=1234)
+    parser.add_argument("--model", default="mock-model")
+    parser.add_argument("--text", default=DEFAULT_ANSWER, help="Texto devolvido (cortado em max_tokens palavras)")
+    parser.add_argument("--tokens-per-second", type=float, default=40.0, help="Taxa de geracao (0 = instantaneo)")
+    parser.add_argument("--latency-ms", type=float, default=300.0, help="Mediana da latencia ate o 1o token")
+    parser.add_argument("--latency-sigma", type=float, default=0.5, help="Dispersao (lognormal) da latencia")
+    parser.add_argument("--error-rate", type=float, default=0.0, help="Fracao de requisicoes que falham com HTTP")
+    parser.add_argument("--error-status", type=int, default=500)
+    parser.add_argument("--drop-rate", type=float, default=0.0, help="Fracao de streams interrompidos no meio")
+    parser.add_argument("--cached-ratio", type=float, default=0.0, help="Fracao de tokens de prompt reportada em cache")
+    return parser.parse_args(argv)
+
+
+def main(argv: list[str] | None = None) -> None:
+    args = parse_args(argv)
+    print(f"[mock-lmstudio] http://{args.host}:{args.port}/v1/responses")
+    uvicorn.run(create_app(args), host=args.host, port=args.port, log_level="warning")
+
+
+if __name__ == "__main__":
+    main()
@@ -26,8 +26,10 @@ export function FeedbackTable({ token }: Props) {
   const handleApprove = async (directive: any) => {
     const text = window.prompt("Texto aprovado para a IA:", directive.text || "");
     if (!text) return;
+    // Globais entram em toda pergunta; as demais so quando forem relevantes para o assunto.
+    const isGlobal = window.confirm("Aplicar esta diretriz a todas as perguntas? (Cancelar = somente quando relevante)");
     try {
-      await adminService.approveFeedbackDirective(directive.id, { text }, token);
+      await adminService.approveFeedbackDirective(directive.id, { text, is_global: isGlobal }, token);
       await refresh();
     } catch (err) {
       console.error(err);
@@ -35,6 +37,16 @@ export function FeedbackTable({ token }: Props) {
     }
   };
 
+  const handleToggleScope = async (directive: any) => {
+    try {
+      await adminService.setFeedbackDirectiveScope(directive.id, !directive.is_global, token);
+      await refresh();
+    } catch (err) {
+      console.error(err);
+      alert("Erro ao alterar escopo da diretriz");
+    }
+  };
+
   const handleReject = async (directive: any) => {
     const ok = window.confirm("Rejeitar esta diretriz?");
     if (!ok) return;
@@ -124,6 +136,7 @@ export function FeedbackTable({ token }: Props) {
             <th>Usuario</th>
             <th>Status</th>
             <th>Texto</th>
+            <th>Escopo</th>
             <th>Aplicado em</th>
           </tr>
         </thead>
@@ -133,12 +146,21 @@ export function FeedbackTable({ token }: Props) {
               <td>{d.created_by_email || d.created_by}</td>
               <td>{d.status}</td>
               <td>{d.text}</td>
+              <td>
+                {d.status === "applied" ? (
+                  <GlassButton variant="ghost" onClick={() => handleToggleScope(d)}>
+                    {d.is_global ? "Global" : "Quando relevante"}
+                  </GlassButton>
+                ) : (
+                  "-"
+                )}
+              </td>
               <td>{d.applied_at ? new Date(d.applied_at).toLocaleString() : "-"}</td>
             </tr>
           ))}
           {history.length === 0 && (
             <tr>
-              <td colSpan={4}>Nenhuma diretriz aplicada ou rejeitada</td>
+              <td colSpan={5}>Nenhuma diretriz aplicada ou rejeitada</td>
             </tr>
           )}
         </tbody>
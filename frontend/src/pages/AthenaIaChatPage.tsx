@@ -3,7 +3,8 @@ import { useNavigate } from "react-router-dom";
 import { ChatWindow } from "../components/chat/ChatWindow";
 import { Sidebar } from "../components/sidebar/Sidebar";
 import { Shell } from "../components/layout/Shell";
-import { getChats, getMessages, createChat, askStream, renameChat, deleteChat } from "../services/api";
+import { getChats, getMessages, createChat, askSse, resumeSse, readSseEvents, renameChat, deleteChat } from "../services/api";
+import type { SseEvent } from "../services/api";
 import type { Chat, ChatMessage, User } from "../types";
 
 type Props = {
@@ -152,6 +153,8 @@ export default function AthenaIaChatPage({ user, token, chatIdParam, onBack, onL
     setLoading(true);
 
     const assistantId = `stream-${Date.now()}`;
+    // Id do stream e ultimo evento recebido: permitem retomar sem gerar a resposta de novo.
+    const stream = { id: null as string | null, lastEventId: 0, finished: false, failed: false };
     try {
       setMessages((prev) => [
         ...prev,
@@ -163,23 +166,48 @@ export default function AthenaIaChatPage({ user, token, chatIdParam, onBack, onL
         },
       ]);
 
-      const res = await askStream(token, selectedChatId, userMessage.content);
+      let acc = "";
+      const onEvent = (event: SseEvent) => {
+        stream.lastEventId = event.id;
+        if (event.event === "meta") {
+          stream.id = String(event.data.stream_id);
+        } else if (event.event === "delta" || event.event === "sources") {
+          acc += String(event.data.text ?? "");
+          setMessages((prev) =>
+            prev.map((m) => (m.id === assistantId ? { ...m, content: acc } : m))
+          );
+        } else if (event.event === "done") {
+          stream.finished = true;
+        } else if (event.event === "error") {
+          stream.finished = true;
+          stream.failed = true;
+          throw new Error(String(event.data.detail ?? "Falha na geracao"));
+        }
+      };
+
+      const res = await askSse(token, selectedChatId, userMessage.content);
       if (!res.ok) throw new Error(`Stream falhou: ${res.status}`);
-      const reader = res.body?.getReader();
-      if (!reader) {
-        throw new Error("Stream indisponivel");
+      try {
+        await readSseEvents(res, onEvent);
+      } catch (e) {
+        if (stream.finished) throw e;
+        console.warn("Conexao do stream caiu; tentando retomar", e);
       }
-      const decoder = new TextDecoder();
-      let acc = "";
 
-      while (true) {
-        const { value, done } = await reader.read();
-        if (done) break;
-        acc += decoder.decode(value, { stream: true });
-        setMessages((prev) =>
-          prev.map((m) => (m.id === assistantId ? { ...m, content: acc } : m))
-        );
+      // Conexao caiu no meio: retoma do ultimo evento (a geracao continua no servidor).
+      for (let attempt = 0; !stream.finished && stream.id && attempt < 5; attempt++) {
+        await new Promise((resolve) => setTimeout(resolve, 500 * 2 ** attempt));
+        try {
+          const resumed = await resumeSse(token, selectedChatId, stream.id, stream.lastEventId);
+          if (resumed.status === 404 || resumed.status === 410) break;
+          if (!resumed.ok) continue;
+          await readSseEvents(resumed, onEvent);
+        } catch (e) {
+          if (stream.finished) throw e;
+          console.warn("Falha ao retomar stream", e);
+        }
       }
+      if (!stream.id) throw new Error("Stream interrompido");
 
       const msgs = await getMessages(token, selectedChatId);
       setMessages(
@@ -193,6 +221,20 @@ export default function AthenaIaChatPage({ user, token, chatIdParam, onBack, onL
     } catch (e) {
       console.error(e);
       try {
+        if (stream.failed) throw e;
+        if (stream.id) {
+          // A geracao ja existia no servidor: mostra o que foi gravado em vez de perguntar de novo.
+          const msgs = await getMessages(token, selectedChatId);
+          setMessages(
+            msgs.map((m) => ({
+              id: String(m.id),
+              role: m.role,
+              content: m.content,
+              createdAt: m.created_at,
+            }))
+          );
+          return;
+        }
         const completion = await (await import("../services/api")).ask(token, selectedChatId, userMessage.content);
         const assistantMessage: ChatMessage = completion.message
           ? {
@@ -93,13 +93,20 @@ export const adminService = {
   async sendFeedbackResponse(data: any, token?: string) {
     return request<ChatCompletionData>("/admin/feedback/respond", { method: "POST", body: JSON.stringify(data), headers: authHeaders(token) }, token);
   },
-  async approveFeedbackDirective(id: number, data: { text?: string }, token?: string) {
+  async approveFeedbackDirective(id: number, data: { text?: string; is_global?: boolean }, token?: string) {
     return request<boolean>(
       `/admin/feedback/directives/${id}/approve`,
       { method: "POST", body: JSON.stringify(data), headers: authHeaders(token) },
       token
     );
   },
+  async setFeedbackDirectiveScope(id: number, isGlobal: boolean, token?: string) {
+    return request<boolean>(
+      `/admin/feedback/directives/${id}/scope`,
+      { method: "POST", body: JSON.stringify({ is_global: isGlobal }), headers: authHeaders(token) },
+      token
+    );
+  },
   async rejectFeedbackDirective(id: number, token?: string) {
     return request<boolean>(
       `/admin/feedback/directives/${id}/reject`,
@@ -148,6 +148,56 @@ export async function askStream(token: string, chatId: number, question: string)
   });
 }
 
+export type SseEvent = {
+  id: number;
+  event: string;
+  data: Record<string, unknown>;
+};
+
+// Stream retomavel (SSE via fetch: EventSource nao envia POST nem Authorization)
+export async function askSse(token: string, chatId: number, question: string) {
+  return fetch(`${API_URL}/chats/${chatId}/ask/sse`, {
+    method: "POST",
+    headers: jsonHeaders(token),
+    body: JSON.stringify({ question }),
+  });
+}
+
+export async function resumeSse(token: string, chatId: number, streamId: string, lastEventId: number) {
+  return fetch(`${API_URL}/chats/${chatId}/ask/sse/${streamId}`, {
+    headers: { ...jsonHeaders(token), "Last-Event-ID": String(lastEventId) },
+  });
+}
+
+export async function readSseEvents(res: Response, onEvent: (event: SseEvent) => void) {
+  const reader = res.body?.getReader();
+  if (!reader) {
+    throw new Error("Stream indisponivel");
+  }
+  const decoder = new TextDecoder();
+  let buffer = "";
+
+  while (true) {
+    const { value, done } = await reader.read();
+    if (done) break;
+    buffer += decoder.decode(value, { stream: true });
+    let boundary = buffer.indexOf("\n\n");
+    while (boundary >= 0) {
+      const block = buffer.slice(0, boundary);
+      buffer = buffer.slice(boundary + 2);
+      boundary = buffer.indexOf("\n\n");
+
+      const event: SseEvent = { id: 0, event: "message", data: {} };
+      for (const line of block.split("\n")) {
+        if (line.startsWith("id:")) event.id = Number(line.slice(3).trim());
+        else if (line.startsWith("event:")) event.event = line.slice(6).trim();
+        else if (line.startsWith("data:")) event.data = JSON.parse(line.slice(5).trim());
+      }
+      if (event.id) onEvent(event);
+    }
+  }
+}
+
 export async function sendFeedback(token: string, chatId: number, messageId: number, rating: number, comment?: string) {
   return request<boolean>(
     `/chats/${chatId}/feedback`,
@@ -11,7 +11,6 @@ export type ChatMessage = {
 export type ChatCompletionData = {
   id: string;
   content: string;
-  raw: unknown;
   sources?: { source: string; page: number; score?: number }[];
   message?: {
     id: number;